@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Bytes on the wire and end to end times for the CBOR API with and without
+Content-Encoding (rest_framework_cbor/compression.py).
+
+Builds a scratch SQLite DB in a temp directory (never the real one),
+fills it like benchindexes.py does, then serves it over HTTP on
+localhost and walks it with the slumber client the way the caches do:
+every packed dump page by page, the streamed market listings dump, a
+partial refresh POSTing its station ids and a 32k row market listings
+replace batch. Each is run with compression off, then gzip, then zstd
+(if zstandard is installed), and the body bytes each way are counted at
+the WSGI layer, i.e. as sent.
+
+Localhost has bandwidth to burn, so the times mostly show what the
+compression costs in CPU. Over a real link the byte counts are what
+matter.
+
+    python benchcompression.py [--stations 4000] [--repeat 3]
+'''
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+PAGEDTABLES = ('systemids', 'bodies', 'atmoscomposition',
+               'materialcomposition', 'stationimports', 'marketlistings')
+PAGELIMIT = 50000
+REPLACESTATIONS = 800       # 40 listings each, so a 32k row batch
+
+
+class WireCounter(object):
+    # WSGI wrapper counting body bytes each way, as sent
+
+    def __init__(self, app):
+        self.app = app
+        self.down = 0
+        self.up = 0
+
+    def __call__(self, environ, start_response):
+        self.up += int(environ.get('CONTENT_LENGTH') or 0)
+        result = self.app(environ, start_response)
+        try:
+            for chunk in result:
+                self.down += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--bodies', type=int, default=20000)
+    parser.add_argument('--stations', type=int, default=4000)
+    parser.add_argument('--systems', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--gzip-level', type=int, default=6)
+    parser.add_argument('--zstd-level', type=int, default=3)
+    return parser.parse_args()
+
+
+def startserver(counter):
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, counter, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def pageall(myresource):
+    # Keyset pages through a dump like CBORJoinCache.loadpages
+    after_pk = 0
+    rows = 0
+    while after_pk is not None:
+        response = myresource.get(after_pk=after_pk, limit=PAGELIMIT)
+        results = response['results']
+        if len(results) > 0:
+            rows += len(results) - results[0] - 1
+        after_pk = response.get('last_pk')
+        if response.get('has_more') is not True:
+            after_pk = None
+    return rows
+
+
+def getworkload(api, stations, replacemap):
+    # (name, function) for each request pattern
+    workload = [('%s pages' % table,
+                 (lambda table=table: pageall(getattr(api.cbor, table))))
+                for table in PAGEDTABLES]
+    workload.append(('marketlistings stream', lambda: sum(
+                        1 for item in api.cbor.marketlistings.iterate(stream=1))))
+    workload.append(('marketlistings partial POST',
+                     lambda: api.cbor.marketlistings.post({
+                        'field': 'station_id', 'v': stations,
+                        'after_pk': 0, 'limit': 500000})))
+    workload.append(('marketlistings replace 32k',
+                     lambda: api.breplace.marketlistings.post(replacemap)))
+    return workload
+
+
+def runworkload(workload, counter, repeat):
+    # {name: (bytes down, bytes up, median seconds)}
+    results = {}
+    for name, function in workload:
+        times = []
+        for count in range(repeat):
+            down = counter.down
+            up = counter.up
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+            down = counter.down - down
+            up = counter.up - up
+        results[name] = (down, up, statistics.median(times))
+    return results
+
+
+def main():
+    args = parseargs()
+    tempdir = tempfile.mkdtemp(prefix='edacbench')
+    # Settings read these, so before Django is set up
+    os.environ['EDAC_DB_ENGINE'] = 'sqlite3'
+    os.environ['EDAC_DB_NAME'] = os.path.join(tempdir, 'bench.sqlite3')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'edacdb.settings')
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    sys.path.append(os.path.join(os.path.dirname(here), 'modules'))
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django.core.wsgi import get_wsgi_application
+    import slumber
+    from benchindexes import populate
+    from edacapi import models
+    from rest_framework_cbor import compression
+    modes = [('off', []), ('gzip', [('gzip', args.gzip_level)])]
+    if 'zstd' in compression.available():
+        modes.append(('zstd', [('zstd', args.zstd_level)]))
+    else:
+        print('No zstandard, skipping zstd.')
+    try:
+        call_command('migrate', verbosity=0)
+        bodies, stations = populate(args)
+        User.objects.create_superuser('bench', '', 'bench')
+        rand = random.Random(args.seed)
+        replacestations = rand.sample(stations,
+                                      min(REPLACESTATIONS, len(stations)))
+        replacemap = {}
+        for row in models.MarketListing.objects.filter(
+                station_id__in=replacestations).values(
+                'station_id', 'commodity_id', 'supply', 'demand',
+                'buy_price', 'sell_price', 'eddb_updated_at', 'duphash'):
+            replacemap.setdefault(row['station_id'], []).append(row)
+        counter = WireCounter(get_wsgi_application())
+        server = startserver(counter)
+        url = 'http://127.0.0.1:%d/edacapi/bulk/' % server.server_port
+        results = {}
+        for mode, levels in modes:
+            settings.CBOR_COMPRESSION = levels
+            api = slumber.API(url, format='cbor', auth=('bench', 'bench'),
+                              compression=levels[0][0] if levels else None)
+            api.cbor.commodities.get(after_pk=0, limit=1)  # Learn encodings
+            workload = getworkload(api, stations, replacemap)
+            print('Running %s...' % mode)
+            results[mode] = runworkload(workload, counter, args.repeat)
+        server.shutdown()
+    finally:
+        from django.db import connection
+        connection.close()
+        shutil.rmtree(tempdir, ignore_errors=True)
+    names = [name for name, function in workload]
+    print('\n%-30s' % '' + ''.join('%28s' % mode for mode, levels in modes))
+    print('%-30s' % '' + ''.join('%10s %8s %8s' % ('down KB', 'up KB', 'ms')
+                                 for mode in modes))
+    for name in names:
+        print('%-30s' % name + ''.join(
+            '%10.0f %8.0f %8.1f' % (results[mode][name][0] / 1024,
+                                    results[mode][name][1] / 1024,
+                                    results[mode][name][2] * 1000)
+            for mode, levels in modes))
+    print('%-30s' % 'total' + ''.join(
+        '%10.0f %8.0f %8.1f' % (
+            sum(results[mode][name][0] for name in names) / 1024,
+            sum(results[mode][name][1] for name in names) / 1024,
+            sum(results[mode][name][2] for name in names) * 1000)
+        for mode, levels in modes))
+
+
+if __name__ == '__main__':
+    main()
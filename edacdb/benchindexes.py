@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Query plans and timings for the partial refresh dumps, before and after
+the indexes in migration 0004_refresh_indexes and the switch from an OR
+per id to a single IN.
+
+Builds a scratch SQLite DB in a temp directory (never the real one),
+fills it with made up bodies, compositions, stations and listings, then
+runs each CBOR dump the way a partial refresh asks for it, 800 ids at a
+time. Prints the plan SQLite picked and the median time, first with the
+schema at 0003 and the old filter, then at 0004 with the view as it is.
+
+    python benchindexes.py [--bodies 20000] [--stations 4000] [--repeat 5]
+'''
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BEFORE = '0003_bulkload_schema'
+AFTER = '0004_refresh_indexes'
+PARTIALVALUES = 800     # As many ids as a partial refresh sends at once
+
+
+class FakeRequest(object):
+    # All the packed dump views look at
+    method = 'GET'
+
+    def __init__(self, GET):
+        self.GET = GET
+
+
+class LegacyFilter(object):
+    # getfilteredobjects as it was, an OR of one Q per value
+    def getfilteredobjects(self, request, table):
+        from django.db.models import Q
+        filterfield = request.GET.get('field')
+        filtervalues = request.GET.getlist('v')
+        myobjects = table.objects
+        if (filterfield and filtervalues) is not None:
+            myfilterqs = Q()
+            for value in filtervalues:
+                myfilterqs = myfilterqs | Q(**{filterfield: value})
+            myobjects = myobjects.filter(myfilterqs)
+        return myobjects
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--bodies', type=int, default=20000)
+    parser.add_argument('--stations', type=int, default=4000)
+    parser.add_argument('--systems', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def populate(args):
+    from edacapi import models
+    rand = random.Random(args.seed)
+    bigint = lambda: rand.randint(-2 ** 63, 2 ** 63 - 1)
+    print('Filling the scratch DB...')
+    models.System.objects.bulk_create(
+        [models.System(edsmid=n, eddbid=n, name='System %d' % n,
+                       duphash=bigint())
+         for n in range(1, args.systems + 1)], batch_size=500)
+    models.AtmosComponent.objects.bulk_create(
+        [models.AtmosComponent(eddbid=n, name='Atmos %d' % n)
+         for n in range(1, 13)])
+    models.SolidType.objects.bulk_create(
+        [models.SolidType(eddbid=n, name='Solid %d' % n) for n in range(1, 4)])
+    models.MaterialType.objects.bulk_create(
+        [models.MaterialType(eddbid=n, name='Material %d' % n)
+         for n in range(1, 26)])
+    models.Commodity.objects.bulk_create(
+        [models.Commodity(eddbid=n, name='Commodity %d' % n, duphash=bigint())
+         for n in range(1, 301)])
+    # bulk_create doesn't hand back pks on SQLite
+    atmos = list(models.AtmosComponent.objects.values_list('pk', flat=True))
+    solids = list(models.SolidType.objects.values_list('pk', flat=True))
+    materials = list(models.MaterialType.objects.values_list('pk', flat=True))
+    commodities = list(models.Commodity.objects.values_list('pk', flat=True))
+    # Bodies, then their compositions and rings, in the order an import
+    # writes them
+    models.Body.objects.bulk_create(
+        [models.Body(eddbid=n, edsmid=n, name='Body %d' % n,
+                     system_id=rand.randint(1, args.systems), duphash=bigint())
+         for n in range(1, args.bodies + 1)], batch_size=500)
+    bodies = list(models.Body.objects.values_list('pk', flat=True))
+    atmosrows = []
+    solidrows = []
+    materialrows = []
+    ringrows = []
+    for body in bodies:
+        for component in rand.sample(atmos, 3):
+            atmosrows.append(models.AtmosComposition(
+                related_body_id=body, component_id=component,
+                share=rand.random()))
+        for component in solids:
+            solidrows.append(models.SolidComposition(
+                related_body_id=body, component_id=component,
+                share=rand.random()))
+        for component in rand.sample(materials, 8):
+            materialrows.append(models.MaterialComposition(
+                related_body_id=body, component_id=component,
+                share=rand.random()))
+        if rand.random() < 0.3:
+            ringrows.append(models.Ring(
+                eddbid=len(ringrows) + 1, related_body_id=body,
+                name='Ring', duphash=bigint()))
+    models.AtmosComposition.objects.bulk_create(atmosrows, batch_size=500)
+    models.SolidComposition.objects.bulk_create(solidrows, batch_size=500)
+    models.MaterialComposition.objects.bulk_create(materialrows, batch_size=500)
+    models.Ring.objects.bulk_create(ringrows, batch_size=500)
+    models.Station.objects.bulk_create(
+        [models.Station(eddbid=n, name='Station %d' % n,
+                        system_id=rand.randint(1, args.systems),
+                        duphash=bigint())
+         for n in range(1, args.stations + 1)], batch_size=500)
+    stations = list(models.Station.objects.values_list('pk', flat=True))
+    importrows = []
+    listingrows = []
+    for station in stations:
+        for commodity in rand.sample(commodities, 6):
+            importrows.append(models.StationImport(
+                station_id=station, commodity_id=commodity))
+        for commodity in rand.sample(commodities, 40):
+            listingrows.append(models.MarketListing(
+                station_id=station, commodity_id=commodity,
+                supply=rand.randint(0, 10000), demand=rand.randint(0, 10000),
+                buy_price=rand.randint(0, 5000),
+                sell_price=rand.randint(0, 5000),
+                eddb_updated_at=rand.randint(0, 2 ** 31), duphash=bigint()))
+    models.StationImport.objects.bulk_create(importrows, batch_size=500)
+    models.MarketListing.objects.bulk_create(listingrows, batch_size=500)
+    print('%d systems, %d bodies, %d compositions, %d rings, %d stations, '
+          '%d imports, %d listings.'
+          % (args.systems, len(bodies),
+             len(atmosrows) + len(solidrows) + len(materialrows),
+             len(ringrows), len(stations), len(importrows), len(listingrows)))
+    return bodies, stations
+
+
+def getpaths(bodies, stations, args):
+    # (name, view, query) for each dump a refresh makes
+    from django.http import QueryDict
+    from edacapi import views
+    rand = random.Random(args.seed)
+    somebodies = rand.sample(bodies, min(PARTIALVALUES, len(bodies)))
+    somestations = rand.sample(stations, min(PARTIALVALUES, len(stations)))
+
+    def query(field=None, values=(), after_pk=0, limit=9999):
+        mydict = QueryDict(mutable=True)
+        if field is not None:
+            mydict['field'] = field
+            mydict.setlist('v', [str(value) for value in values])
+        mydict['after_pk'] = str(after_pk)
+        mydict['limit'] = str(limit)
+        return mydict
+
+    return [
+        ('atmoscomposition by body', views.CBORAtmosCompositionView,
+         query('related_body_id', somebodies)),
+        ('solidcomposition by body', views.CBORSolidCompositionView,
+         query('related_body_id', somebodies)),
+        ('materialcomposition by body', views.CBORMaterialCompositionView,
+         query('related_body_id', somebodies)),
+        ('rings by body', views.CBORRingView,
+         query('related_body_id', somebodies)),
+        ('bodies by eddbid', views.CBORBodyView,
+         query('eddbid', somebodies)),
+        ('stationimports by station', views.CBORStationImportView,
+         query('station_id', somestations)),
+        ('marketlistings by station', views.CBORMarketListingView,
+         query('station_id', somestations)),
+        ('systemids page', views.CBORSysIDView,
+         query(after_pk=args.systems // 2, limit=10000)),
+    ]
+
+
+def runpath(view, GET, repeat):
+    # Returns the plan of each query the dump ran and the median seconds
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    myview = view()
+    request = FakeRequest(GET)
+    times = []
+    for count in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            myview.getpackedlist(request)
+            times.append(time.perf_counter() - start)
+    plans = []
+    cursor = connection.cursor()
+    for myquery in captured.captured_queries:
+        cursor.execute('EXPLAIN QUERY PLAN ' + myquery['sql'])
+        # An OR or IN of 800 ids repeats the same step 800 times, show
+        # each step once with a count
+        steps = []
+        for row in cursor.fetchall():
+            step = row[-1]
+            if step.startswith('INDEX '):
+                continue
+            if len(steps) > 0 and steps[-1][0] == step:
+                steps[-1][1] += 1
+            else:
+                steps.append([step, 1])
+        plans.append(['%s (x%d)' % (step, count) if count > 1 else step
+                      for step, count in steps])
+    return plans, statistics.median(times)
+
+
+def runpaths(paths, repeat, legacy=False):
+    from django.db import connection
+    connection.cursor().execute('ANALYZE')
+    results = {}
+    for name, view, GET in paths:
+        if legacy:
+            view = type(view.__name__, (LegacyFilter, view), {})
+        results[name] = runpath(view, GET, repeat)
+    return results
+
+
+def main():
+    args = parseargs()
+    tempdir = tempfile.mkdtemp(prefix='edacbench')
+    # Settings read these, so before Django is set up
+    os.environ['EDAC_DB_ENGINE'] = 'sqlite3'
+    os.environ['EDAC_DB_NAME'] = os.path.join(tempdir, 'bench.sqlite3')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'edacdb.settings')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import django
+    django.setup()
+    from django.core.management import call_command
+    try:
+        call_command('migrate', 'edacapi', BEFORE, verbosity=0)
+        bodies, stations = populate(args)
+        paths = getpaths(bodies, stations, args)
+        before = runpaths(paths, args.repeat, legacy=True)
+        call_command('migrate', 'edacapi', AFTER, verbosity=0)
+        after = runpaths(paths, args.repeat)
+    finally:
+        from django.db import connection
+        connection.close()
+        shutil.rmtree(tempdir, ignore_errors=True)
+    for name, view, GET in paths:
+        print('\n%s' % name)
+        for label, results in (('before', before), ('after', after)):
+            plans, seconds = results[name]
+            print('  %s: %.1fms' % (label, seconds * 1000))
+            for plan in plans:
+                print('    ' + ' / '.join(plan))
+    print('\n%-30s %10s %10s' % ('', 'before ms', 'after ms'))
+    for name, view, GET in paths:
+        print('%-30s %10.1f %10.1f' % (name, before[name][1] * 1000,
+                                      after[name][1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
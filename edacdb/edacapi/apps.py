@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class EdacapiConfig(AppConfig):
     name = 'edacapi'
+
+    def ready(self):
+        from . import dbtuning
+        connection_created.connect(dbtuning.setupconnection,
+                                   dispatch_uid='edacapi_sqliteprofile')
@@ -0,0 +1,99 @@
+'''
+SQLite connection profile, applied by the connection_created signal
+(see apps.py) to every new connection. The PRAGMAs come from
+SQLITE_PROFILE in settings.py, WAL lets the CBOR dump views read while the
+bulk endpoints write.
+
+Import mode layers SQLITE_IMPORT_PROFILE on top (synchronous=OFF) while an
+importer holds it. Django opens a connection per request so new requests
+pick the change up. The holds are kept in the DB (ImportMode) rather than
+in memory, so with several server processes it doesn't matter which one
+an importer's start and end reach, they all see the same holds. It lapses
+on its own after a while in case the importer never says it's finished.
+'''
+
+import time
+
+from django.conf import settings
+from django.db import transaction, DatabaseError, OperationalError
+
+from .models import ImportMode
+
+IMPORTSECONDS = 3600    # Longest an import mode hold lasts
+
+
+def importmodeactive(connection):
+    # Read on the new connection itself, as it's being set up. No table
+    # yet (not migrated) means no holds.
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT holders, until FROM %s WHERE id = 1'
+                       % connection.ops.quote_name(ImportMode._meta.db_table))
+        row = cursor.fetchone()
+    except DatabaseError:
+        return False
+    return (row is not None) and (row[0] > 0) and (row[1] >= time.time())
+
+
+def applyprofile(connection, profile):
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.cursor()
+    for name, value in profile.items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+def setupconnection(sender, connection, **kwargs):
+    # connection_created receiver
+    if connection.vendor != 'sqlite':
+        return
+    applyprofile(connection, getattr(settings, 'SQLITE_PROFILE', {}))
+    if importmodeactive(connection):
+        applyprofile(connection, getattr(settings, 'SQLITE_IMPORT_PROFILE', {}))
+
+
+def changeholders(change, seconds=0):
+    # Adds change to the holders, in one transaction so two processes
+    # can't both count from the same value. A lapsed hold counts as none.
+    # Returns the number of holders.
+    retrycount = 20
+    while True:
+        try:
+            with transaction.atomic():
+                now = time.time()
+                hold, created = ImportMode.objects.get_or_create(pk=1)
+                if hold.holders > 0 and hold.until < now:
+                    print('SQLite import mode lapsed, restoring the profile.')
+                    hold.holders = 0
+                hold.holders = max(0, hold.holders + change)
+                if change > 0:
+                    hold.until = max(hold.until, now + seconds)
+                hold.save()
+                return hold.holders
+        except OperationalError:
+            retrycount -= 1
+            if retrycount <= 0:
+                raise
+            # Try again
+            print('Operational Error: DB Locked? Retrying...')
+            time.sleep(0.5)
+
+
+def startimportmode(connection, seconds=None):
+    # Each importer takes a hold, the profile comes back when they've all
+    # let go. Returns the number of holders.
+    if seconds is None:
+        seconds = IMPORTSECONDS
+    holders = changeholders(1, seconds)
+    applyprofile(connection, getattr(settings, 'SQLITE_IMPORT_PROFILE', {}))
+    return holders
+
+
+def endimportmode(connection):
+    holders = changeholders(-1)
+    if holders == 0:
+        applyprofile(connection, getattr(settings, 'SQLITE_PROFILE', {}))
+        if connection.vendor == 'sqlite':
+            # Fold the import back into the main file
+            connection.cursor().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return holders
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# duphash moves from an 8 char base64 string to a 64 bit int fingerprint
+# (modules/fingerprint.py). The old values can't be converted, they were
+# MD5 over a different encoding, so the column is dropped and re-added
+# empty. The next import sees every record as changed and writes the new
+# fingerprint back, once.
+FINGERPRINTED = ('body', 'commodity', 'ring', 'station', 'system')
+
+
+def swapduphash(model_name):
+    return [
+        migrations.RemoveField(
+            model_name=model_name,
+            name='duphash',
+        ),
+        migrations.AddField(
+            model_name=model_name,
+            name='duphash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edacapi', '0001_initial'),
+    ]
+
+    operations = [operation for model_name in FINGERPRINTED
+                  for operation in swapduphash(model_name)]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 10:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Brings the migrations up to the models so a new database (PostgreSQL
+# especially) can be built with migrate. The station join tables and
+# market listings get their (station, lookup) unique indexes, which the
+# replace-set diff and the packed row lookups by station rely on.
+
+
+def clearstationmodules(apps, schema_editor):
+    # The old rows have no module, they can't be kept once it's required.
+    # The next import puts them back.
+    StationModule = apps.get_model('edacapi', 'StationModule')
+    StationModule.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edacapi', '0002_duphash_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketListing',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('supply', models.IntegerField(blank=True, null=True)),
+                ('demand', models.IntegerField(blank=True, null=True)),
+                ('buy_price', models.IntegerField(blank=True, null=True)),
+                ('sell_price', models.IntegerField(blank=True, null=True)),
+                ('eddb_updated_at', models.IntegerField(blank=True, null=True)),
+                ('duphash', models.BigIntegerField(blank=True, null=True)),
+                ('commodity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='edacapi.Commodity')),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StationExport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('commodity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='edacapi.Commodity')),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StationImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('commodity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='edacapi.Commodity')),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StationProhibited',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('commodity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='edacapi.Commodity')),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station')),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='stationcommodity',
+            name='commodity',
+        ),
+        migrations.RemoveField(
+            model_name='stationcommodity',
+            name='station',
+        ),
+        migrations.RunPython(clearstationmodules, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='stationmodule',
+            name='module',
+            field=models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Module'),
+            preserve_default=False,
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationeconomy',
+            unique_together=set([('station', 'economy')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationmodule',
+            unique_together=set([('station', 'module')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationship',
+            unique_together=set([('station', 'shiptype')]),
+        ),
+        migrations.DeleteModel(
+            name='StationCommodity',
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationprohibited',
+            unique_together=set([('station', 'commodity')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationimport',
+            unique_together=set([('station', 'commodity')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationexport',
+            unique_together=set([('station', 'commodity')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='marketlisting',
+            unique_together=set([('station', 'commodity')]),
+        ),
+    ]
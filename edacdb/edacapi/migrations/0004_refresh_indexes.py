@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 11:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The composition tables get a (related_body, component) index, then the
+# single column foreign key indexes that a composite one leads on are
+# dropped, they only slowed the bulk loads down. For the station joins
+# and market listings that's the (station, lookup) unique index.
+# benchindexes.py shows the partial refresh plans either side of this.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edacapi', '0003_bulkload_schema'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='atmoscomposition',
+            index_together=set([('related_body', 'component')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='materialcomposition',
+            index_together=set([('related_body', 'component')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='solidcomposition',
+            index_together=set([('related_body', 'component')]),
+        ),
+        migrations.AlterField(
+            model_name='atmoscomposition',
+            name='related_body',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Body'),
+        ),
+        migrations.AlterField(
+            model_name='marketlisting',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station'),
+        ),
+        migrations.AlterField(
+            model_name='materialcomposition',
+            name='related_body',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Body'),
+        ),
+        migrations.AlterField(
+            model_name='solidcomposition',
+            name='related_body',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Body'),
+        ),
+        migrations.AlterField(
+            model_name='stationeconomy',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station'),
+        ),
+        migrations.AlterField(
+            model_name='stationexport',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station'),
+        ),
+        migrations.AlterField(
+            model_name='stationimport',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station'),
+        ),
+        migrations.AlterField(
+            model_name='stationmodule',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station'),
+        ),
+        migrations.AlterField(
+            model_name='stationprohibited',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station'),
+        ),
+        migrations.AlterField(
+            model_name='stationship',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='edacapi.Station'),
+        ),
+    ]
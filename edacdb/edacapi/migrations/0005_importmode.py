@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 18:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edacapi', '0004_refresh_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportMode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('holders', models.IntegerField(default=0)),
+                ('until', models.FloatField(default=0.0)),
+            ],
+        ),
+    ]
@@ -263,7 +263,7 @@ class System(models.Model):
     # {'Control': 698, 'Exploited': 7531, 'Contested': 385}
     primary_economy = models.ForeignKey(Economy, models.SET_NULL, blank=True, null=True)
     #
-    duphash = models.CharField(max_length=8, blank=True, default='')
+    duphash = models.BigIntegerField(blank=True, null=True)
 
 
 class AtmosType(models.Model):      # Overall Type
@@ -449,26 +449,38 @@ class Body(models.Model):
     volcanism_type_id = models.ForeignKey(VolcanismType, models.SET_NULL, blank=True, null=True)
     eddb_created_at = models.IntegerField(blank=True, null=True)
     eddb_updated_at = models.IntegerField(blank=True, null=True)
-    duphash = models.CharField(max_length=8, blank=True, default='')
+    duphash = models.BigIntegerField(blank=True, null=True)
 
 
 class SolidComposition(models.Model):
     component = models.ForeignKey(SolidType, models.CASCADE)
-    related_body = models.ForeignKey(Body, models.CASCADE)
+    # Indexed by index_together, which leads on it
+    related_body = models.ForeignKey(Body, models.CASCADE, db_index=False)
     share = models.FloatField(blank=True, null=True)
 
+    class Meta:
+        index_together = ('related_body', 'component',)
+
 
 class AtmosComposition(models.Model):
     component = models.ForeignKey(AtmosComponent, models.CASCADE)
-    related_body = models.ForeignKey(Body, models.CASCADE)
+    # Indexed by index_together, which leads on it
+    related_body = models.ForeignKey(Body, models.CASCADE, db_index=False)
     share = models.FloatField(blank=True, null=True)
 
+    class Meta:
+        index_together = ('related_body', 'component',)
+
 
 class MaterialComposition(models.Model):
     component = models.ForeignKey(MaterialType, models.CASCADE)
-    related_body = models.ForeignKey(Body, models.CASCADE)
+    # Indexed by index_together, which leads on it
+    related_body = models.ForeignKey(Body, models.CASCADE, db_index=False)
     share = models.FloatField(blank=True, null=True)
 
+    class Meta:
+        index_together = ('related_body', 'component',)
+
 
 class Ring(models.Model):
     eddbid = models.IntegerField(unique=True, blank=True, null=True)
@@ -481,7 +493,7 @@ class Ring(models.Model):
     semi_major_axis = models.FloatField(blank=True, null=True)
     eddb_created_at = models.IntegerField(blank=True, null=True)
     eddb_updated_at = models.IntegerField(blank=True, null=True)
-    duphash = models.CharField(max_length=8, blank=True, default='')
+    duphash = models.BigIntegerField(blank=True, null=True)
 
 
 #  Commodity Section
@@ -504,7 +516,7 @@ class Commodity(models.Model):
     category = models.ForeignKey(CommodityCategory, models.SET_NULL, blank=True, null=True)
     average_price = models.IntegerField(blank=True, null=True)
     is_rare = models.NullBooleanField(blank=True, null=True)   # Y N ?
-    duphash = models.CharField(max_length=8, blank=True, default='')
+    duphash = models.BigIntegerField(blank=True, null=True)
 
 
 #  Stations Section
@@ -540,7 +552,7 @@ class Station(models.Model):
     eddb_shipyard_updated_at = models.IntegerField(blank=True, null=True)
     eddb_outfitting_updated_at = models.IntegerField(blank=True, null=True)
     eddb_market_updated_at = models.IntegerField(blank=True, null=True)
-    duphash = models.CharField(max_length=8, blank=True, default='')
+    duphash = models.BigIntegerField(blank=True, null=True)
 '''
 {"id":14,"name":"Bounds Hub","system_id":773,"max_landing_pad_size":"L",
 "distance_to_star":910,"faction":"Blood Brothers from Alrai",
@@ -566,7 +578,8 @@ class Station(models.Model):
 
 class StationImport(models.Model):
     commodity = models.ForeignKey(Commodity, models.CASCADE)
-    station = models.ForeignKey(Station, models.CASCADE)
+    # unique_together leads on station, that's its index
+    station = models.ForeignKey(Station, models.CASCADE, db_index=False)
 
     class Meta:
         unique_together = ('station', 'commodity',)
@@ -574,7 +587,8 @@ class StationImport(models.Model):
 
 class StationExport(models.Model):
     commodity = models.ForeignKey(Commodity, models.CASCADE)
-    station = models.ForeignKey(Station, models.CASCADE)
+    # unique_together leads on station, that's its index
+    station = models.ForeignKey(Station, models.CASCADE, db_index=False)
 
     class Meta:
         unique_together = ('station', 'commodity',)
@@ -582,7 +596,8 @@ class StationExport(models.Model):
 
 class StationProhibited(models.Model):
     commodity = models.ForeignKey(Commodity, models.CASCADE)
-    station = models.ForeignKey(Station, models.CASCADE)
+    # unique_together leads on station, that's its index
+    station = models.ForeignKey(Station, models.CASCADE, db_index=False)
 
     class Meta:
         unique_together = ('station', 'commodity',)
@@ -591,7 +606,8 @@ class StationProhibited(models.Model):
 class StationEconomy(models.Model):
     # Buy Sell Don't bring?
     economy = models.ForeignKey(Economy, models.CASCADE)
-    station = models.ForeignKey(Station, models.CASCADE)
+    # unique_together leads on station, that's its index
+    station = models.ForeignKey(Station, models.CASCADE, db_index=False)
 
     class Meta:
         unique_together = ('station', 'economy',)
@@ -599,7 +615,8 @@ class StationEconomy(models.Model):
 
 class StationShip(models.Model):
     shiptype = models.ForeignKey(ShipType, models.CASCADE)
-    station = models.ForeignKey(Station, models.CASCADE)
+    # unique_together leads on station, that's its index
+    station = models.ForeignKey(Station, models.CASCADE, db_index=False)
 
     class Meta:
         unique_together = ('station', 'shiptype',)
@@ -607,21 +624,30 @@ class StationShip(models.Model):
 
 class StationModule(models.Model):
     module = models.ForeignKey(Module, models.CASCADE)
-    station = models.ForeignKey(Station, models.CASCADE)
+    # unique_together leads on station, that's its index
+    station = models.ForeignKey(Station, models.CASCADE, db_index=False)
 
     class Meta:
         unique_together = ('station', 'module',)
 
 
 class MarketListing(models.Model):
-    station = models.ForeignKey(Station, models.CASCADE)
+    # unique_together leads on station, that's its index
+    station = models.ForeignKey(Station, models.CASCADE, db_index=False)
     commodity = models.ForeignKey(Commodity, models.CASCADE)
     supply = models.IntegerField(blank=True, null=True)
     demand = models.IntegerField(blank=True, null=True)
     buy_price = models.IntegerField(blank=True, null=True)
     sell_price = models.IntegerField(blank=True, null=True)
     eddb_updated_at = models.IntegerField(blank=True, null=True)
-    duphash = models.CharField(max_length=8, blank=True, default='')
+    duphash = models.BigIntegerField(blank=True, null=True)
 
     class Meta:
         unique_together = ('station', 'commodity',)
+
+
+class ImportMode(models.Model):
+    # A single row (pk 1), the SQLite import mode holds (dbtuning.py). In
+    # the DB so every server process sees the same ones.
+    holders = models.IntegerField(default=0)
+    until = models.FloatField(default=0.0)      # time.time() they lapse at
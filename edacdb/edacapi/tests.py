@@ -1,3 +1,140 @@
-from django.test import TestCase
+import cbor2
+from django.contrib.auth.models import User
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from .models import Commodity, ImportMode, Station, StationExport, System
+from .views import islocked
+
+
+class ImportModeTests(TransactionTestCase):
+    """
+    Tests for the importers' import mode endpoint. Not a TestCase, SQLite
+    won't change its PRAGMAs inside the transaction that would wrap it.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_superuser('importer', '', 'importer'))
+
+    def post(self, data):
+        response = self.client.post('/edacapi/bulk/importmode/',
+                                    cbor2.dumps(data),
+                                    content_type='application/cbor')
+        return response.status_code, cbor2.loads(response.content)
+
+    def test_enable_disable(self):
+        status, data = self.post({'enabled': True, 'seconds': 60})
+        self.assertEquals(status, 200)
+        self.assertEquals(data, {'importmode': True, 'holders': 1})
+        hold = ImportMode.objects.get(pk=1)
+        self.assertEquals(hold.holders, 1)
+        self.assertGreater(hold.until, 0)
+        status, data = self.post({'enabled': True})
+        self.assertEquals(data['holders'], 2)
+        status, data = self.post({'enabled': False})
+        self.assertEquals(data, {'importmode': True, 'holders': 1})
+        status, data = self.post({'enabled': False})
+        self.assertEquals(status, 200)
+        self.assertEquals(data, {'importmode': False, 'holders': 0})
+        self.assertEquals(ImportMode.objects.get(pk=1).holders, 0)
+
+    def test_bad_request(self):
+        status, data = self.post({'seconds': 60})
+        self.assertEquals(status, 400)
+        self.assertFalse(ImportMode.objects.exists())
+
+    def test_needs_permission(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('reader'))
+        response = client.post('/edacapi/bulk/importmode/',
+                               cbor2.dumps({'enabled': True}),
+                               content_type='application/cbor')
+        self.assertEquals(response.status_code, 403)
+        self.assertFalse(ImportMode.objects.exists())
+
+
+class CBORPackedFilterTests(TestCase):
+    """
+    Tests for the filters on the packed CBOR dumps
+    """
+
+    url = '/edacapi/bulk/cbor/systemids/'
+
+    def setUp(self):
+        self.client = APIClient()
+        # POSTs are gets with the parameters in the body, but still a POST
+        self.client.force_authenticate(
+            User.objects.create_superuser('importer', '', 'importer'))
+        System.objects.bulk_create([System(eddbid=n, name='S%d' % n)
+                                    for n in range(1, 1501)])
+        self.pks = list(System.objects.order_by('pk')
+                        .values_list('pk', flat=True))
+
+    def test_count_up_to_hwm(self):
+        # As the caches' getcountuptohwm does for their snapshots
+        hwm = self.pks[999]
+        response = self.client.get(self.url, {'field': 'pk__lte', 'v': hwm,
+                                              'offset': 0, 'limit': 0})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(cbor2.loads(response.content)['count'], 1000)
+
+    def test_pk_partial(self):
+        # More keys than fit one statement, they go by the temp table
+        response = self.client.post(self.url,
+                                    cbor2.dumps({'field': 'pk',
+                                                 'v': self.pks[:1200],
+                                                 'offset': 0, 'limit': 0}),
+                                    content_type='application/cbor')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(cbor2.loads(response.content)['count'], 1200)
+
+    def test_unknown_field(self):
+        response = self.client.get(self.url, {'field': 'nosuchfield__lte',
+                                              'v': 1})
+        self.assertEquals(response.status_code, 400)
+
+
+class BulkCreateTests(TestCase):
+    """
+    Tests for the streamed bulk creates
+    """
+
+    url = '/edacapi/bulk/stationexports/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_superuser('importer', '', 'importer'))
+        self.station = Station.objects.create(name='St1')
+        self.commodities = [Commodity.objects.create(name='C%d' % n).pk
+                            for n in range(0, 3)]
+
+    def post(self, data):
+        response = self.client.post(self.url, cbor2.dumps(data),
+                                    content_type='application/cbor')
+        return response.status_code, cbor2.loads(response.content)
+
+    def test_station_rows(self):
+        status, data = self.post([{'station_id': self.station.pk,
+                                   'commodity_id': commodity}
+                                  for commodity in self.commodities])
+        self.assertEquals(status, 201)
+        self.assertEquals(data['count'], 3)
+        self.assertEquals(StationExport.objects.count(), 3)
+
+    def test_unknown_columns(self):
+        # The client's mistake, not a lock to retry
+        status, data = self.post([{'station_id': self.station.pk,
+                                   'commodity_id': commodity,
+                                   'colour': 1, 'size': 2}
+                                  for commodity in self.commodities])
+        self.assertEquals(status, 400)
+        self.assertIn('colour, size', data)
+        self.assertEquals(StationExport.objects.count(), 0)
+
+    def test_islocked(self):
+        self.assertTrue(islocked(OperationalError('database is locked')))
+        self.assertFalse(islocked(OperationalError('no such column: x')))
@@ -111,5 +111,13 @@ urlpatterns = [
     url(r'^bulk/bcreatesystems/', views.SystemBulkCreateViewSet.as_view()),
     url(r'^bulk/bupdatesystems/', views.SystemBulkUpdateViewSet.as_view()),
     url(r'^bulk/bstationmodules/', views.SuperStationModuleBulkViewSet.as_view()),
+    url(r'^bulk/importmode/', views.ImportModeView.as_view()),
+    url(r'^bulk/breplace/stationimports/', views.StationImportReplaceView.as_view()),
+    url(r'^bulk/breplace/stationexports/', views.StationExportReplaceView.as_view()),
+    url(r'^bulk/breplace/stationprohibited/', views.StationProhibitedReplaceView.as_view()),
+    url(r'^bulk/breplace/stationeconomies/', views.StationEconomyReplaceView.as_view()),
+    url(r'^bulk/breplace/stationships/', views.StationShipReplaceView.as_view()),
+    url(r'^bulk/breplace/stationmodules/', views.StationModuleReplaceView.as_view()),
+    url(r'^bulk/breplace/marketlistings/', views.MarketListingReplaceView.as_view()),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework'))
 ]
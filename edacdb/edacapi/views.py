@@ -5,9 +5,12 @@ from django.shortcuts import get_object_or_404
 from django.db import transaction, connection
 from django.db import IntegrityError, OperationalError
 from django.db.models import Q
-from django.http import HttpResponse
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.http import HttpResponse, StreamingHttpResponse
 from django.forms.models import model_to_dict
 import json
+import io
+import datetime
 import cbor2 as cbor
 import sys
 import gc
@@ -26,14 +29,15 @@ from .models import StationShip, StationModule, ShipType, Module
 from .models import ModuleMountType, ModuleGuidanceType, ModuleCategory
 from .models import ModuleGroup, StationShip, StationModule, StationImport
 from .models import StationExport, StationProhibited, MarketListing
-from rest_framework import viewsets, views
+from .models import ImportMode
+from rest_framework import viewsets, views, mixins
 from rest_framework import status
 from rest_framework_bulk import BulkModelViewSet
 from rest_framework.response import Response
 from rest_framework.renderers import JSONRenderer
 from rest_framework.negotiation import BaseContentNegotiation
 from rest_framework_cbor.renderers import CBORRenderer
-from rest_framework_cbor.parsers import CBORParser
+from rest_framework_cbor.parsers import CBORParser, CBORArrayStream
 from .serializers import CMDRSerializer, ShipSerializer, SystemSerializer
 from .serializers import ModuleSlotSerializer, HardpointMountSerializer
 from .serializers import SecurityLevelSerializer, AllegianceSerializer
@@ -67,138 +71,384 @@ from .serializers import StationProhibitedSerializer, StationModuleBulkSerialize
 from .serializers import StationImportBulkSerializer, StationExportBulkSerializer
 from .serializers import StationProhibitedBulkSerializer, MarketListingSerializer
 from .serializers import MarketListingBulkSerializer
-
-
+from . import dbtuning
+
+
+SQLITEMAXVARS = 900     # SQLite's default limit of variables per statement
+STREAMCHUNK = 2000      # Rows taken off a streamed request body at a time
+LOCKMESSAGES = ('database is locked', 'database table is locked',   # SQLite
+                'could not obtain lock', 'deadlock detected')       # PostgreSQL
+
+
+def dblocked():
+    # Ran out of retries, 503 tells the client it's worth trying again
+    print('Operational Error: DB Locked, giving up on this request.')
+    return Response('Database locked, try again later.',
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={'Retry-After': '5'})
+
+
+def islocked(exc):
+    # OperationalError is bad SQL (no such column...) as well as a lock,
+    # only a lock is worth the client sending the batch again
+    message = str(exc).lower()
+    return any(text in message for text in LOCKMESSAGES)
+
+
+def chunked(items, size=SQLITEMAXVARS):
+    # Splits a list so each piece fits in a single SQLite statement
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def copyvalue(value):
+    # One value in COPY's text format
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def insertrows(tablename, columns, rows):
+    # Bulk INSERT of row tuples into tablename (columns are column names).
+    # PostgreSQL gets a single COPY, anything else an executemany.
+    quote = connection.ops.quote_name
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        mybuffer = io.StringIO()
+        for row in rows:
+            mybuffer.write('\t'.join([copyvalue(value) for value in row]))
+            mybuffer.write('\n')
+        mybuffer.seek(0)
+        # copy_expert isn't one of the cursor calls Django wraps, so its
+        # errors are turned into Django's (IntegrityError...) here
+        with connection.wrap_database_errors:
+            cursor.copy_expert('COPY %s (%s) FROM STDIN'
+                               % (quote(tablename),
+                                  ', '.join([quote(column)
+                                             for column in columns])),
+                               mybuffer)
+    else:
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)'
+                           % (quote(tablename),
+                              ', '.join([quote(column) for column in columns]),
+                              ', '.join(['%s'] * len(columns))),
+                           rows)
+
+
+def packcreated(table, fields, lookups):
+    # Looks freshly created rows back up by their natural key and packs
+    # them the same way as the CBOR dumps, so the client can load the new
+    # pks straight into its caches instead of refreshing them.
+    # lookups is a list of (keyfield, keys)
+    fields = list(fields)
+    items = []
+    for keyfield, keys in lookups:
+        keys = list(set([key for key in keys if key is not None]))
+        for chunk in chunked(keys):
+            items.extend(table.objects.filter(**{keyfield + '__in': chunk})
+                         .values_list(*fields))
+    list_items = []
+    if len(items) > 0:
+        list_items = [len(fields)] + fields + items
+    return {
+        'count': len(items),
+        'results': list_items
+    }
+
+
+def bulkupdaterows(table, rows):
+    # Set based update. rows are dicts of field name: value, each with an
+    # 'id'. The batch is loaded into a temp table and a single UPDATE per
+    # set of fields copies it across, all in one transaction, instead of
+    # an UPDATE per row.
+    # Returns the number of rows updated and the ids that weren't found.
+    quote = connection.ops.quote_name
+    tablename = quote(table._meta.db_table)
+    pkcol = quote(table._meta.pk.column)
+    temptable = quote('edac_bulkupdate')
+    # Rows may not all carry the same fields, group them so a missing
+    # field is left alone rather than set to NULL.
+    groups = {}
+    for row in rows:
+        names = tuple(sorted(name for name in row if name != 'id'))
+        groups.setdefault(names, []).append(row)
+    updated = 0
+    missing = []
+    cursor = connection.cursor()
+    with transaction.atomic():
+        for names, grouprows in groups.items():
+            fields = []
+            for name in names:
+                try:
+                    fields.append(table._meta.get_field(name))
+                except FieldDoesNotExist:
+                    pass        # As the serializer did, ignore extras
+            columns = [quote(field.column) for field in fields]
+            querylist = [
+                tuple([row['id']] + [
+                    field.get_db_prep_save(field.to_python(row[field.name]
+                                           if field.name in row
+                                           else row[field.attname]),
+                                           connection)
+                    for field in fields])
+                for row in grouprows]
+            cursor.execute('DROP TABLE IF EXISTS %s' % temptable)
+            cursor.execute('CREATE TEMP TABLE %s AS SELECT %s FROM %s LIMIT 0'
+                           % (temptable, ', '.join([pkcol] + columns),
+                              tablename))
+            cursor.execute('CREATE INDEX %s ON %s (%s)'
+                           % (quote('edac_bulkupdate_pk'), temptable, pkcol))
+            insertrows('edac_bulkupdate',
+                       [table._meta.pk.column] + [field.column
+                                                  for field in fields],
+                       querylist)
+            if len(columns) > 0 and connection.vendor == 'postgresql':
+                # A join rather than a subquery per column
+                setters = ['%s = %s.%s' % (column, temptable, column)
+                           for column in columns]
+                cursor.execute('UPDATE %s SET %s FROM %s WHERE %s.%s = %s.%s'
+                               % (tablename, ', '.join(setters), temptable,
+                                  tablename, pkcol, temptable, pkcol))
+                updated += cursor.rowcount
+            elif len(columns) > 0:
+                setters = ['%s = (SELECT %s FROM %s WHERE %s.%s = %s.%s)'
+                           % (column, column, temptable, temptable, pkcol,
+                              tablename, pkcol)
+                           for column in columns]
+                cursor.execute('UPDATE %s SET %s WHERE %s IN (SELECT %s FROM %s)'
+                               % (tablename, ', '.join(setters), pkcol, pkcol,
+                                  temptable))
+                updated += cursor.rowcount
+            cursor.execute('SELECT %s FROM %s WHERE %s NOT IN (SELECT %s FROM %s)'
+                           % (pkcol, temptable, pkcol, pkcol, tablename))
+            missing.extend([row[0] for row in cursor.fetchall()])
+            cursor.execute('DROP TABLE %s' % temptable)
+    return updated, missing
+
+
+def bulkdeleterows(table, pklist):
+    # Chunked pk__in deletes, all in one transaction. Tables nothing else
+    # points at get a raw DELETE, skipping Django's collector, the rest
+    # still go through it so the cascades happen.
+    # Returns the number of rows deleted from this table.
+    quote = connection.ops.quote_name
+    pklist = list(set(pklist))
+    rawdelete = len(table._meta.related_objects) == 0
+    deleted = 0
+    cursor = connection.cursor()
+    with transaction.atomic():
+        for chunk in chunked(pklist):
+            if rawdelete:
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)'
+                               % (quote(table._meta.db_table),
+                                  quote(table._meta.pk.column),
+                                  ', '.join(['%s'] * len(chunk))),
+                               chunk)
+                deleted += cursor.rowcount
+            else:
+                total, counts = table.objects.filter(pk__in=chunk).delete()
+                deleted += counts.get(table._meta.label, 0)
+    return deleted
+
+
+def packedcolumns(table, headers):
+    # Checks the header of a packed (columnar) upload against the table,
+    # once for the whole batch. Headers may be field names or attnames,
+    # foreign keys come as the already resolved ids.
+    # Returns the fields in header order, raises KeyError listing any that
+    # aren't known
+    fields = []
+    unknown = []
+    for header in headers:
+        try:
+            field = table._meta.get_field(header)
+        except FieldDoesNotExist:
+            field = None
+            for thisfield in table._meta.concrete_fields:
+                if thisfield.attname == header:
+                    field = thisfield
+        if field is None or not field.concrete or field.primary_key:
+            unknown.append(str(header))
+        else:
+            fields.append(field)
+    if len(unknown) > 0:
+        raise KeyError('Not columns of %s: %s'
+                       % (table.__name__, ', '.join(unknown)))
+    if len(set(fields)) != len(fields):
+        raise KeyError('Duplicate columns for %s' % table.__name__)
+    return fields
+
+
+def insertpackedrows(table, fields, rows):
+    # insertrows of row tuples, no model instances. Only fields that
+    # don't store their python value as is (dates) are converted.
+    # Defaults are Django's not the DB's, so columns left out of the
+    # batch that have one get it added here, as bulk_create would.
+    defaults = [field for field in table._meta.concrete_fields
+                if field not in fields and not field.primary_key
+                and field.has_default()]
+    if len(defaults) > 0:
+        extra = [field.get_db_prep_save(field.get_default(), connection)
+                 for field in defaults]
+        fields = list(fields) + defaults
+        rows = [list(row) + extra for row in rows]
+    converters = []
+    for index, field in enumerate(fields):
+        if field.get_internal_type() in ('DateTimeField', 'DateField',
+                                         'TimeField', 'DecimalField'):
+            converters.append((index, field))
+    if len(converters) > 0:
+        newrows = []
+        for row in rows:
+            row = list(row)
+            for index, field in converters:
+                row[index] = field.get_db_prep_save(field.to_python(row[index]),
+                                                    connection)
+            newrows.append(row)
+        rows = newrows
+    with transaction.atomic():
+        insertrows(table._meta.db_table, [field.column for field in fields],
+                   rows)
+    return len(rows)
+
+
+def packedsystemkeys(fields, rows):
+    # The natural keys of packed System rows, to look the new pks up by.
+    # Systems without an eddbid are found by edsmid.
+    names = [field.name for field in fields]
+    eddbids = []
+    edsmids = []
+    if 'eddbid' in names:
+        eddbcol = names.index('eddbid')
+        eddbids = [row[eddbcol] for row in rows]
+    if 'edsmid' in names:
+        edsmcol = names.index('edsmid')
+        edsmids = [row[edsmcol] for row in rows
+                   if 'eddbid' not in names or row[eddbcol] is None]
+    return eddbids, edsmids
+
+
+def bulkupdateresponse(table, rows):
+    # bulkupdaterows with the usual retries if the DB is locked.
+    # Responds with the count updated and the ids that weren't there,
+    # any row not listed in missing was updated.
+    retrycount = 20
+    while True:
+        try:
+            updated, missing = bulkupdaterows(table, rows)
+            break
+        except OperationalError:
+            retrycount -= 1
+            if retrycount <= 0:
+                return dblocked()
+            # Try again
+            print('Operational Error: DB Locked? Retrying...')
+            time.sleep(0.5)
+        except (KeyError, ValidationError) as exc:
+            print("Unexpected error: %s : %s" % (sys.exc_info()[0], sys.exc_info()[1]))
+            return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+    if len(missing) > 0:
+        print('Bulk update of %s: %d ids not found'
+              % (table.__name__, len(missing)))
+    return Response({'updated': updated, 'missing': missing},
+                    status=status.HTTP_200_OK)
 
 
 class UpdatingBulkViewSet(BulkModelViewSet):
     """
     API endpoint that allows things to be bulk created or updated.
+    Set createdkey (the natural key) and createdfields to have bulk
+    creates return the new rows, packed, rather than just a count.
+    Bulk creates are decoded as they're written, STREAMCHUNK rows at a
+    time, see create.
     """
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
+    streammethods = ('POST', )
+    createdkey = None
+    createdfields = None
     # TODO control Bulk Deletes
 
     def create(self, request, *args, **kwargs):
-        bulk = isinstance(request.data, list)
-        if not bulk:
-            return super(BulkCreateModelMixin, self).create(request, *args, **kwargs)
-        elif len(request.data) == 0:
+        # A bulk create comes as the parser decodes it (CBORArrayStream)
+        # and is taken a chunk at a time, so only a chunk of the batch is
+        # ever held. It's all one transaction, a bad row anywhere and none
+        # of it is written. If the DB is locked it's a 503, the body can't
+        # be read again so the client retries.
+        if not isinstance(request.data, CBORArrayStream):
+            # A single object
+            return mixins.CreateModelMixin.create(self, request, *args,
+                                                  **kwargs)
+        items = request.data
+        first = items.peek()
+        if first is None:
             return Response(status=status.HTTP_204_NO_CONTENT)
-        elif 'station_id' in request.data[0]:   # Speed up
-            table = self.queryset.model
-            tablename = table._meta.db_table
-            fields = list(request.data[0])      # Python 3 list of keys
-            try:
-                # Try raw TODO insert correct table and fields
-                #print('Attempting direct inserts.')
-                cursor = connection.cursor()
-                queryp1 = ('INSERT INTO %s (%s, %s) VALUES'
-                            % (tablename, fields[0], fields[1]))
-                queryp2 = ''' (%s,%s) '''
-                query = queryp1 + queryp2
-                querylist = [(thisdict[fields[0]], thisdict[fields[1]]) for
-                            thisdict in request.data
-                            ]
-                with transaction.atomic():
-                    cursor.executemany(query, querylist)
-                connection.commit()             # Not sure if this is required.
-            except OperationalError:
-                # Try again
-                print('Operational Error: DB Locked?, retrying')
-                time.sleep(2)
-                with transaction.atomic():
-                    cursor.executemany(query, querylist)
-                connection.commit()
-            except Exception as exc:
-                print(exc)
-                return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
-            return Response(status=status.HTTP_204_NO_CONTENT)
-        else:
-            serializer = self.get_serializer(data=request.data, many=True)
-            serializer.is_valid(raise_exception=True)
-            retrycount = 20
-            while retrycount > 0:
-                try:
-                    self.perform_bulk_create(serializer)
-                    break
-                except OperationalError:
-                    # Try again
-                    print('Operational Error: DB Locked? Retrying...')
-                    time.sleep(0.5)
-                    retrycount -= 1
-                except Exception as exc:
-                    raise
-                    print("Unexpected error: %s : %s" % (sys.exc_info()[0], sys.exc_info()[1]))
-                    return HttpResponse(exc, status=400)
-            return Response(len(serializer.data), status=status.HTTP_201_CREATED)
+        table = self.queryset.model
+        created = 0
+        keys = set()
+        try:
+            with transaction.atomic():
+                if isinstance(first, dict) and 'station_id' in first:
+                    fields = list(first)        # Python 3 list of keys
+                    # Keys straight from the client, checked once
+                    columns = [field.column
+                               for field in packedcolumns(table, fields)]
+                    for chunk in items.chunks(STREAMCHUNK):
+                        querylist = [tuple(thisdict[field] for field in fields)
+                                     for thisdict in chunk]
+                        insertrows(table._meta.db_table, columns, querylist)
+                        keys.update(thisdict['station_id']
+                                    for thisdict in chunk)
+                else:
+                    for chunk in items.chunks(STREAMCHUNK):
+                        serializer = self.get_serializer(data=chunk, many=True)
+                        serializer.is_valid(raise_exception=True)
+                        self.perform_bulk_create(serializer)
+                        created += len(chunk)
+                        if self.createdkey is not None:
+                            keys.update(item.get(self.createdkey)
+                                        for item in chunk)
+        except OperationalError as exc:
+            if islocked(exc):
+                return dblocked()
+            print(exc)
+            return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        except (KeyError, TypeError, AttributeError, IntegrityError) as exc:
+            print(exc)
+            return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        if isinstance(first, dict) and 'station_id' in first:
+            # Hand back every row for these stations, the old ones have
+            # already been deleted so that's the set we just wrote.
+            createdfields = ['id'] + [field[:-3] if field.endswith('_id')
+                                      else field for field in fields]
+            return Response(packcreated(table, createdfields,
+                                        [('station_id', keys)]),
+                            status=status.HTTP_201_CREATED)
+        if self.createdkey is None:
+            return Response(created, status=status.HTTP_201_CREATED)
+        return Response(packcreated(table, self.createdfields,
+                                    [(self.createdkey, keys)]),
+                        status=status.HTTP_201_CREATED)
 
     def bulk_update(self, request, *args, **kwargs):
-        partial = kwargs.pop('partial', False)
         if len(request.data) == 0:
             return Response(status=status.HTTP_204_NO_CONTENT)
-        elif 'station_id' in request.data[0]:
-            try:
-                for thisdict in request.data:
+        try:
+            for thisdict in request.data:
+                if 'pk' in thisdict:
                     thisdict['id'] = thisdict.pop('pk')     # Why why why ?????
-                    #thisdict['module'] = Module.objects.get(pk=thisdict['module'])
-                    #thisdict['station'] = Station.objects.get(pk=thisdict['station'])
-            except Exception as exc:
-                print(exc)
-                return Response(exc, status=status.HTTP_400_BAD_REQUEST)
-            retrycount = 20
-            for thisitem in request.data:
-                while retrycount > 0:
-                    try:
-                        StationModule.objects.filter(id=thisitem['id']).update(**thisitem)
-                        break
-                    except OperationalError:
-                        # Try again
-                        print('Operational Error: DB Locked?, retrying')
-                        time.sleep(0.5)
-                        retrycount -= 1
-                    except Exception as exc:
-                        print("Unexpected error: %s : %s" % (sys.exc_info()[0], sys.exc_info()[1]))
-                        return HttpResponse(str(exc), status=400)
-        else:
-            # restrict the update to the filtered queryset
-            serializer = self.get_serializer(
-                self.filter_queryset(self.get_queryset()),
-                data=request.data,
-                many=True,
-                partial=partial,
-            )
-            validated_data = []
-            validation_errors = []
-            results = []
-            for item in request.data:
-                item_serializer = self.get_serializer(
-                    get_object_or_404(self.filter_queryset(self.get_queryset()),
-                                      pk=item['id']),
-                    data=item,
-                    partial=partial,
-                )
-                if not item_serializer.is_valid():
-                    validation_errors.append(item_serializer.errors)
-                retrycount = 20
-                result = None
-                while retrycount > 0:
-                    try:
-                        result = self.get_queryset().filter(id=item['id']).update(
-                                        **item_serializer.validated_data)
-                        break
-                    except OperationalError:
-                        # Try again
-                        print('Operational Error: DB Locked? Retrying...')
-                        time.sleep(0.5)
-                        retrycount -= 1
-                    except Exception as exc:
-                        print("Unexpected error: %s : %s" % (sys.exc_info()[0], sys.exc_info()[1]))
-                        return HttpResponse(exc, status=400)
-                # results.append(result)
-            if validation_errors:
-                raise ValidationError(validation_errors)
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        except Exception as exc:
+            print(exc)
+            return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        # One set based UPDATE for the whole batch
+        return bulkupdateresponse(self.queryset.model, request.data)
 
     def allow_bulk_destroy(self, qs, filtered):
         # custom logic here
@@ -216,16 +466,126 @@ class UpdatingBulkViewSet(BulkModelViewSet):
         #if not self.allow_bulk_destroy(qs, filtered):
         #    return Response(status=status.HTTP_400_BAD_REQUEST)
         pklist = request.data
-        pklistlen = len(pklist)
         print('bulk_destroy got %d items to destroy' % len(pklist))
-        #if pklistlen == 0:
-        #    return Response(status=status.HTTP_400_BAD_REQUEST)
-        # Need to limit the number of objects we try and destroy
-        # at once.
-        for pk in pklist:
-            self.get_queryset().filter(id=pk).delete()
+        table = self.queryset.model
+        retrycount = 20
+        while True:
+            try:
+                deleted = bulkdeleterows(table, pklist)
+                break
+            except OperationalError:
+                retrycount -= 1
+                if retrycount <= 0:
+                    return dblocked()
+                # Try again
+                print('Operational Error: DB Locked? Retrying...')
+                time.sleep(0.5)
+            except Exception as exc:
+                print("Unexpected error: %s : %s" % (sys.exc_info()[0], sys.exc_info()[1]))
+                return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        # Counts so the client can check nothing went missing
+        return Response({'deleted': deleted, 'requested': len(set(pklist))},
+                        status=status.HTTP_200_OK)
 
-        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class StationJoinReplaceView(views.APIView):
+    """
+    Replaces the join set of each station given, for use as a subclass.
+    POST {station_id: [lookup ids...], ...}
+    The diff against the DB is done here, in one transaction, so only new
+    joins are inserted and only those that have gone are deleted.
+    Set datafields for joins that carry data (market listings), each entry
+    is then a dict with the lookup id and those fields, changed ones are
+    updated in place.
+    Returns the counts and the stations' rows packed like the CBOR dumps.
+    """
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
+    lookupfield = None      # e.g. 'commodity'
+    datafields = ()
+
+    def post(self, request, *args, **kwargs):
+        return self.replace(request, *args, **kwargs)
+
+    def getwanted(self, request):
+        # {station: {lookup id: data or None}}
+        lookupcol = self.lookupfield + '_id'
+        wanted = {}
+        for station, things in request.data.items():
+            mythings = {}
+            for thing in things:
+                if thing is None:
+                    continue
+                if self.datafields:
+                    mythings[thing[lookupcol]] = tuple(
+                        thing.get(field) for field in self.datafields)
+                else:
+                    mythings[thing] = None
+            wanted[int(station)] = mythings
+        return wanted
+
+    def replacesets(self, table, wanted):
+        lookupcol = self.lookupfield + '_id'
+        datafields = list(self.datafields)
+        todelete = []
+        toinsert = []
+        toupdate = []
+        existing = {}
+        with transaction.atomic():
+            for chunk in chunked(list(wanted)):
+                for row in (table.objects.filter(station_id__in=chunk)
+                            .values_list('id', 'station_id', lookupcol,
+                                         *datafields)):
+                    existing.setdefault(row[1], {})[row[2]] = row
+            for station, mythings in wanted.items():
+                current = existing.get(station, {})
+                for thing, row in current.items():
+                    if thing not in mythings:
+                        todelete.append(row[0])
+                    elif datafields and (tuple(row[3:]) != mythings[thing]):
+                        update = dict(zip(datafields, mythings[thing]))
+                        update['id'] = row[0]
+                        toupdate.append(update)
+                for thing, data in mythings.items():
+                    if thing not in current:
+                        toinsert.append((station, thing) + (data or ()))
+            # Deletes first, the station/lookup pair is unique
+            bulkdeleterows(table, todelete)
+            if len(toinsert) > 0:
+                insertrows(table._meta.db_table,
+                           ['station_id', lookupcol] + datafields, toinsert)
+            if len(toupdate) > 0:
+                bulkupdaterows(table, toupdate)
+        return len(todelete), len(toinsert), len(toupdate)
+
+    def replace(self, request, *args, **kwargs):
+        table = self.queryset.model
+        try:
+            wanted = self.getwanted(request)
+        except Exception as exc:
+            print(exc)
+            return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        retrycount = 20
+        while True:
+            try:
+                deleted, inserted, updated = self.replacesets(table, wanted)
+                break
+            except OperationalError:
+                retrycount -= 1
+                if retrycount <= 0:
+                    return dblocked()
+                # Try again
+                print('Operational Error: DB Locked? Retrying...')
+                time.sleep(0.5)
+            except Exception as exc:
+                print("Unexpected error: %s : %s" % (sys.exc_info()[0], sys.exc_info()[1]))
+                return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        fields = ['id', 'station', self.lookupfield] + list(self.datafields)
+        response = packcreated(table, fields, [('station_id', list(wanted))])
+        response['deleted'] = deleted
+        response['inserted'] = inserted
+        response['updated'] = updated
+        return Response(response, status=status.HTTP_200_OK)
 
 
 class CBORPackedItemView(views.APIView):
@@ -234,37 +594,133 @@ class CBORPackedItemView(views.APIView):
     For use as a subclass.
     I've also added the capability to request of items by an arbitrary field
     ?field=fieldname&v=123(etc)
+    Use ?after_pk=0&limit=n to page by primary key, then pass the
+    returned last_pk as the next after_pk while has_more is True. Only the
+    first page (after_pk=0, or add count=1) carries the total count.
+    Add ?stream=1 to get the whole (filtered) table as a streamed,
+    indefinite length CBOR array instead of a page.
+    The same parameters can be POSTed as a CBOR map instead, with v as a
+    list, for partial refreshes with more values than fit in a URL.
     """
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
+    packedfields = None     # Override to dump a subset of fields
+    streamchunkrows = 2000  # Rows encoded per chunk written to the socket
+
+    def getfields(self, table):
+        if self.packedfields is not None:
+            return list(self.packedfields)
+        return [f.name for f in table._meta.get_fields()
+                if f.concrete and (
+                  not f.is_relation
+                  or f.one_to_one
+                  or (f.many_to_one and f.related_model)
+                  )]
+
+    def getpkindex(self, table, fields):
+        # Where the primary key is in a row, so a keyset page can report
+        # the last pk it returned. Adds the pk column if it isn't there.
+        for name in ('pk', table._meta.pk.name):
+            if name in fields:
+                return fields.index(name)
+        fields.append(table._meta.pk.name)
+        return len(fields) - 1
+
+    def getparams(self, request):
+        # The query string, or the CBOR body of a POST
+        if request.method == 'POST':
+            params = dict(request.data)
+            values = params.get('v')
+            if values is None:
+                values = []
+            elif not isinstance(values, list):
+                values = [values]
+        else:
+            params = request.GET.dict()
+            values = request.GET.getlist('v')
+        params['v'] = values
+        return params
+
+    def getfilteredobjects(self, request, table):
+        # Check for filtering
+        params = self.getparams(request)
+        filterfield = params.get('field')
+        filtervalues = params['v']
+        myobjects = table.objects
+        if (filterfield and filtervalues) is not None:
+            # print('Making a filter...')
+            if '__' in filterfield:
+                # A lookup (e.g. pk__lte), only ever a value or two
+                myfilterqs = Q()
+                for value in filtervalues:
+                    myfilterqs = myfilterqs | Q(**{filterfield: value})
+                myobjects = myobjects.filter(myfilterqs)
+            elif len(filtervalues) <= SQLITEMAXVARS:
+                # One IN rather than an OR per value, a partial refresh
+                # sends hundreds and building the Q chain cost more than
+                # the query.
+                myobjects = myobjects.filter(**{filterfield + '__in':
+                                                filtervalues})
+            else:
+                myobjects = self.jointempkeys(table, myobjects, filterfield,
+                                              filtervalues)
+        return myobjects
+
+    def jointempkeys(self, table, myobjects, filterfield, filtervalues):
+        # Too many values for one statement, they go in a temp table (on
+        # this connection, so it's still there while a stream is read)
+        # and the dump is restricted to rows with a match in it.
+        quote = connection.ops.quote_name
+        column = self.getfilterfield(table, filterfield).column
+        tablename = quote(table._meta.db_table)
+        temptable = quote('edac_partialkeys')
+        cursor = connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS %s' % temptable)
+        cursor.execute('CREATE TEMP TABLE %s AS SELECT %s AS partialkey '
+                       'FROM %s LIMIT 0'
+                       % (temptable, quote(column), tablename))
+        insertrows('edac_partialkeys', ['partialkey'],
+                   [(value, ) for value in set(filtervalues)])
+        return myobjects.extra(where=['%s.%s IN (SELECT partialkey FROM %s)'
+                                      % (tablename, quote(column),
+                                         temptable)])
 
     def getpackedlist(self, request, table=None, fields=None):
         if table is None:
             table = self.queryset.model
             # print('Model is set to: %s' % table.__name__)
         if fields is None:
-            fields = [f.name for f in table._meta.get_fields()
-                      if f.concrete and (
-                        not f.is_relation
-                        or f.one_to_one
-                        or (f.many_to_one and f.related_model)
-                        )]
-        # Check for filtering
-        filterfield = request.GET.get('field')
-        filtervalues = request.GET.getlist('v')
-        myobjects = table.objects
-        if (filterfield and filtervalues) is not None:
-            # print('Making a filter...')
-            myfilterqs = Q()
-            for value in filtervalues:
-                 myfilterqs = myfilterqs | Q(**{filterfield:value})
-            myobjects = myobjects.filter(myfilterqs)
-        count = myobjects.count()
-        # print('I\'m counting %d objects' % count)
-        offset = int(request.GET.get('offset', 0))
-        limit = int(request.GET.get('limit', 9999)) + offset
-        # items = myobjects.values(*fields)[offset:limit]
-        items = myobjects.values_list(*fields)[offset:limit]
+            fields = self.getfields(table)
+        params = self.getparams(request)
+        myobjects = self.getfilteredobjects(request, table)
+        after_pk = params.get('after_pk')
+        last_pk = None
+        has_more = False
+        if after_pk is not None:
+            # Keyset mode, walk the pk index rather than re-scanning
+            # every earlier row the way OFFSET does. Counting is a scan
+            # of its own, so only the first page does it.
+            count = None
+            if int(after_pk) == 0 or params.get('count'):
+                count = myobjects.count()
+            limit = int(params.get('limit', 9999))
+            fields = list(fields)
+            pkindex = self.getpkindex(table, fields)
+            # One extra row says whether there's another page
+            items = list(myobjects.filter(pk__gt=int(after_pk))
+                         .order_by('pk').values_list(*fields)[:limit + 1])
+            if len(items) > limit:
+                has_more = True
+                items = items[:limit]
+            if len(items) > 0:
+                last_pk = items[-1][pkindex]
+        else:
+            count = myobjects.count()
+            # print('I\'m counting %d objects' % count)
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', 9999)) + offset
+            # items = myobjects.values(*fields)[offset:limit]
+            items = myobjects.values_list(*fields)[offset:limit]
         # optimise by changing to a long list with headers and tuples
         list_items = []
         noofitems = len(items)
@@ -279,18 +735,91 @@ class CBORPackedItemView(views.APIView):
                 list_items = [len(list_headers)] + list_headers + list(items)
                 # print(list_items[0:30])
         response = {
-            'count': count,
             'results': list_items
         }
+        if count is not None:
+            response['count'] = count
+        if after_pk is not None:
+            response['last_pk'] = last_pk   # None when nothing left
+            response['has_more'] = has_more
         # print(response)
         #print('CBOR Packer returning %d/%d items, tot. length %d'
         #      % (noofitems, count, len(list_items)))
         return response
 
+    def getpackedstream(self, request, table=None, fields=None):
+        # Same packed layout as getpackedlist's 'results', i.e.
+        # [cols, header1, header2, ..., (row), (row), ...]
+        # but written as an indefinite length CBOR array, a chunk of rows
+        # at a time, straight off the DB cursor. Neither the queryset nor
+        # the encoded response is ever held in full.
+        if table is None:
+            table = self.queryset.model
+        if fields is None:
+            fields = self.getfields(table)
+        params = self.getparams(request)
+        myobjects = self.getfilteredobjects(request, table)
+        after_pk = params.get('after_pk')
+        if after_pk is not None:
+            myobjects = myobjects.filter(pk__gt=int(after_pk))
+        items = myobjects.values_list(*fields).order_by('pk')
+        offset = int(params.get('offset', 0))
+        limit = params.get('limit')
+        if limit is not None:
+            items = items[offset:int(limit) + offset]
+        elif offset > 0:
+            items = items[offset:]
+        chunkrows = self.streamchunkrows
+        # 0x9f starts an indefinite length array, 0xff is the break code
+        header = [b'\x9f', cbor.dumps(len(fields))]
+        header.extend(cbor.dumps(field) for field in fields)
+        yield b''.join(header)
+        chunk = []
+        for row in items.iterator():
+            chunk.append(cbor.dumps(row))
+            if len(chunk) >= chunkrows:
+                yield b''.join(chunk)
+                chunk = []
+        chunk.append(b'\xff')
+        yield b''.join(chunk)
+
+    def getfilterfield(self, table, filterfield):
+        # The field a filter is on, filterfield may have a lookup
+        # (pk__lte). pk isn't a field name, it's whatever the pk is.
+        name = str(filterfield).split('__')[0]
+        if name == 'pk':
+            return table._meta.pk
+        return table._meta.get_field(name)
+
+    def checkfilterfield(self, request):
+        # An unknown filter field is the client's mistake, so a 400 now,
+        # before a stream has started, rather than a 500 from the query.
+        # Returns the error response, or None if it's fine.
+        filterfield = self.getparams(request).get('field')
+        if not filterfield:
+            return None
+        try:
+            self.getfilterfield(self.queryset.model, filterfield)
+        except FieldDoesNotExist:
+            return Response('%s is not a field of %s'
+                            % (filterfield, self.queryset.model.__name__),
+                            status=status.HTTP_400_BAD_REQUEST)
+        return None
+
     def get(self, request, format=None):
+        error = self.checkfilterfield(request)
+        if error is not None:
+            return error
+        if self.getparams(request).get('stream'):
+            return StreamingHttpResponse(self.getpackedstream(request),
+                                         content_type='application/cbor')
         response = self.getpackedlist(request)
         return Response(response, content_type='application/cbor')
 
+    def post(self, request, format=None):
+        # Nothing is written, it's a get with the parameters in the body
+        return self.get(request, format)
+
 
 class CMDRViewSet(viewsets.ModelViewSet):
     """
@@ -538,7 +1067,9 @@ class SystemBulkCreateViewSet(views.APIView):
     queryset = System.objects.all()
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
+    streammethods = ('POST', )
     serializer_class = MyBulkSystemSerializer
+    createdfields = ('pk', 'edsmid', 'eddbid', 'duphash')   # As CBORSysIDView
     # TODO control Bulk Deletes
 
     # Stripped down for initial load events
@@ -588,20 +1119,67 @@ class SystemBulkCreateViewSet(views.APIView):
             return Response(exc, status=status.HTTP_400_BAD_REQUEST)
         # print('Doing Bulk Save')
         '''
+        # The body comes as the parser decodes it (CBORArrayStream) and is
+        # taken STREAMCHUNK rows at a time, so only a chunk of the batch is
+        # ever held. Either packed the same way as the CBOR dumps,
+        # [ncols, headers..., rows...] with the lookups already resolved to
+        # ids by the client, where the header is checked once and the rows
+        # go straight to an executemany, or dicts.
+        # It's all one transaction, a bad row anywhere and none of it is
+        # written. If the DB is locked it's a 503, the body can't be read
+        # again so the client retries.
+        if not isinstance(request.data, CBORArrayStream):
+            return Response('Expected a list of systems',
+                            status=status.HTTP_400_BAD_REQUEST)
+        items = request.data
+        first = items.peek()
+        if first is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
         idstrings = ['security', 'state', 'allegiance', 'faction', 'power',
                      'government', 'power_state', 'primary_economy']
-        for thisdict in request.data:
-            for idstring in idstrings:
-                newid = idstring + '_id'
-                thisdict[newid] = thisdict.pop(idstring)
+        eddbids = []
+        edsmids = []
         try:
-            System.objects.bulk_create([System(**thisdict) for thisdict in request.data])
-        except Exception as exc:
+            with transaction.atomic():
+                if isinstance(first, int):
+                    ncols = next(items)
+                    headers = [next(items) for i in range(0, ncols)]
+                    fields = packedcolumns(System, headers)
+                    for rows in items.chunks(STREAMCHUNK):
+                        if any(len(row) != ncols for row in rows):
+                            raise KeyError('Rows must have %d columns' % ncols)
+                        insertpackedrows(System, fields, rows)
+                        chunkeddbids, chunkedsmids = packedsystemkeys(fields,
+                                                                      rows)
+                        eddbids.extend(chunkeddbids)
+                        edsmids.extend(chunkedsmids)
+                else:
+                    for chunk in items.chunks(STREAMCHUNK):
+                        for thisdict in chunk:
+                            for idstring in idstrings:
+                                newid = idstring + '_id'
+                                thisdict[newid] = thisdict.pop(idstring)
+                        System.objects.bulk_create([System(**thisdict)
+                                                    for thisdict in chunk])
+                        eddbids.extend(thisdict['eddbid'] for thisdict in chunk)
+                        edsmids.extend(thisdict['edsmid'] for thisdict in chunk
+                                       if thisdict['eddbid'] is None)
+        except OperationalError as exc:
+            if islocked(exc):
+                return dblocked()
             print(exc)
-            return Response(exc, status=status.HTTP_400_BAD_REQUEST)
-        # print('Returning Response')
-        # Should really put some stuff in here.
-        return Response(status=status.HTTP_204_NO_CONTENT)
+            return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        except StopIteration:
+            return Response('Packed header is short',
+                            status=status.HTTP_400_BAD_REQUEST)
+        except (KeyError, TypeError, AttributeError, IntegrityError,
+                ValidationError) as exc:
+            print(exc)
+            return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        return Response(packcreated(System, self.createdfields,
+                                    [('eddbid', eddbids),
+                                     ('edsmid', edsmids)]),
+                        status=status.HTTP_201_CREATED)
 
 
 class SystemBulkUpdateViewSet(views.APIView):
@@ -631,26 +1209,36 @@ class SystemBulkUpdateViewSet(views.APIView):
             for idstring in idstrings:
                 newid = idstring + '_id'
                 thisdict[newid] = thisdict.pop(idstring)
-        # print('Doing Bulk Save')
-        #System.objects.bulk_create([System(**thisdict) for thisdict in request.data])
-        retrycount = 120
-        for thisitem in request.data:
-            while retrycount > 0:
-                try:
-                    System.objects.filter(id=thisitem['id']).update(**thisitem)
-                    break
-                except OperationalError:
-                    # Try again
-                    print('Operational Error: DB Locked?, retrying')
-                    time.sleep(0.5)
-                    retrycount -= 1
-                except Exception as exc:
-                    print("Unexpected error: %s : %s" % (sys.exc_info()[0], sys.exc_info()[1]))
-                    return HttpResponse(exc, status=400)
-        # print('Returning Response')
-        # Should really put some stuff in here.
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        # One set based UPDATE for the whole batch
+        return bulkupdateresponse(System, request.data)
+
+
+class ImportModeView(views.APIView):
+    """
+    Hidden endpoint for the importers, relaxes SQLite's durability while
+    a bulk load runs (see dbtuning.py).
+    POST {'enabled': True, 'seconds': n} to take a hold, {'enabled': False}
+    to let it go. seconds is optional, the hold lapses after it.
+    """
+    queryset = ImportMode.objects.all()
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
 
+    def post(self, request, *args, **kwargs):
+        try:
+            enabled = bool(request.data['enabled'])
+            seconds = request.data.get('seconds')
+        except (KeyError, TypeError, AttributeError) as exc:
+            return Response(str(exc), status=status.HTTP_400_BAD_REQUEST)
+        try:
+            if enabled:
+                holders = dbtuning.startimportmode(connection, seconds)
+            else:
+                holders = dbtuning.endimportmode(connection)
+        except OperationalError:
+            return dblocked()
+        return Response({'importmode': holders > 0, 'holders': holders},
+                        status=status.HTTP_200_OK)
 
 class SystemIDViewSet(viewsets.ReadOnlyModelViewSet):
     """
@@ -751,11 +1339,7 @@ class CBORSysIDView(CBORPackedItemView):
     queryset = System.objects.all()
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
-
-    def get(self, request, format=None):
-        fields = ('pk', 'edsmid', 'eddbid', 'duphash')
-        response = self.getpackedlist(request, fields=fields)
-        return Response(response, content_type='application/cbor')
+    packedfields = ('pk', 'edsmid', 'eddbid', 'duphash')
 
 class SecurityLevelViewSet(viewsets.ModelViewSet):
     """
@@ -862,6 +1446,8 @@ class AtmosCompositionBulkViewSet(UpdatingBulkViewSet):
     """
     queryset = AtmosComposition.objects.all()
     serializer_class = AtmosCompositionBulkSerializer
+    createdkey = 'related_body'
+    createdfields = ('id', 'related_body', 'component', 'share')
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
     # TODO control Bulk Deletes
@@ -938,6 +1524,8 @@ class BodyBulkViewSet(UpdatingBulkViewSet):
     """
     queryset = Body.objects.all()
     serializer_class = BodyBulkSerializer
+    createdkey = 'eddbid'
+    createdfields = ('id', 'eddbid', 'edsmid', 'duphash')
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
     # TODO control Bulk Deletes
@@ -966,6 +1554,8 @@ class SolidCompositionBulkViewSet(UpdatingBulkViewSet):
     """
     queryset = SolidComposition.objects.all()
     serializer_class = SolidCompositionBulkSerializer
+    createdkey = 'related_body'
+    createdfields = ('id', 'related_body', 'component', 'share')
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
     # TODO control Bulk Deletes
@@ -994,6 +1584,8 @@ class MaterialCompositionBulkViewSet(UpdatingBulkViewSet):
     """
     queryset = MaterialComposition.objects.all()
     serializer_class = MaterialCompositionBulkSerializer
+    createdkey = 'related_body'
+    createdfields = ('id', 'related_body', 'component', 'share')
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
     # TODO control Bulk Deletes
@@ -1022,6 +1614,8 @@ class RingBulkViewSet(UpdatingBulkViewSet):
     """
     queryset = Ring.objects.all()
     serializer_class = RingBulkSerializer
+    createdkey = 'eddbid'
+    createdfields = ('id', 'eddbid', 'duphash')
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
     # TODO control Bulk Deletes
@@ -1083,6 +1677,8 @@ class StationBulkViewSet(UpdatingBulkViewSet):
     """
     queryset = Station.objects.all()
     serializer_class = StationBulkSerializer
+    createdkey = 'eddbid'
+    createdfields = ('id', 'eddbid', 'duphash')
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
     # TODO control Bulk Deletes
@@ -1125,6 +1721,16 @@ class CBORStationImportView(CBORPackedItemView):
     parser_classes = (CBORParser, )
 
 
+class StationImportReplaceView(StationJoinReplaceView):
+    """
+    Replaces the StationImport join sets of the stations given.
+    """
+    queryset = StationImport.objects.all()
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
+    lookupfield = 'commodity'
+
+
 class StationExportViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows Ships to be viewed or edited.
@@ -1153,6 +1759,16 @@ class CBORStationExportView(CBORPackedItemView):
     parser_classes = (CBORParser, )
 
 
+class StationExportReplaceView(StationJoinReplaceView):
+    """
+    Replaces the StationExport join sets of the stations given.
+    """
+    queryset = StationExport.objects.all()
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
+    lookupfield = 'commodity'
+
+
 class StationProhibitedViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows Ships to be viewed or edited.
@@ -1181,6 +1797,16 @@ class CBORStationProhibitedView(CBORPackedItemView):
     parser_classes = (CBORParser, )
 
 
+class StationProhibitedReplaceView(StationJoinReplaceView):
+    """
+    Replaces the StationProhibited join sets of the stations given.
+    """
+    queryset = StationProhibited.objects.all()
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
+    lookupfield = 'commodity'
+
+
 class StationEconomyViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows Ships to be viewed or edited.
@@ -1209,6 +1835,16 @@ class CBORStationEconomyView(CBORPackedItemView):
     parser_classes = (CBORParser, )
 
 
+class StationEconomyReplaceView(StationJoinReplaceView):
+    """
+    Replaces the StationEconomy join sets of the stations given.
+    """
+    queryset = StationEconomy.objects.all()
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
+    lookupfield = 'economy'
+
+
 class StationShipViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows Ships to be viewed or edited.
@@ -1237,6 +1873,16 @@ class CBORStationShipView(CBORPackedItemView):
     parser_classes = (CBORParser, )
 
 
+class StationShipReplaceView(StationJoinReplaceView):
+    """
+    Replaces the StationShip join sets of the stations given.
+    """
+    queryset = StationShip.objects.all()
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
+    lookupfield = 'shiptype'
+
+
 class StationModuleViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows Ships to be viewed or edited.
@@ -1265,6 +1911,16 @@ class CBORStationModuleView(CBORPackedItemView):
     parser_classes = (CBORParser, )
 
 
+class StationModuleReplaceView(StationJoinReplaceView):
+    """
+    Replaces the StationModule join sets of the stations given.
+    """
+    queryset = StationModule.objects.all()
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
+    lookupfield = 'module'
+
+
 class MarketListingViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows MarketListing to be viewed or edited.
@@ -1291,3 +1947,15 @@ class CBORMarketListingView(CBORPackedItemView):
     queryset = MarketListing.objects.all()
     renderer_classes = (CBORRenderer, )
     parser_classes = (CBORParser, )
+
+
+class MarketListingReplaceView(StationJoinReplaceView):
+    """
+    Replaces the MarketListing join sets of the stations given.
+    """
+    queryset = MarketListing.objects.all()
+    renderer_classes = (CBORRenderer, )
+    parser_classes = (CBORParser, )
+    lookupfield = 'commodity'
+    datafields = ('supply', 'demand', 'buy_price', 'sell_price',
+                  'eddb_updated_at', 'duphash')
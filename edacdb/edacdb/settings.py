@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'rest_framework_cbor.compression.CBORCompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,17 +76,68 @@ WSGI_APPLICATION = 'edacdb.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-        'OPTIONS': {
-            'timeout': 30,
+# SQLite by default. For a server DB (several importers writing at once)
+# set EDAC_DB_ENGINE=postgresql and the EDAC_DB_* variables below, then
+# run migrate. Needs psycopg2 older than 2.9, with 2.9 Django 1.10 fails
+# its "database connection isn't set to UTC" check on every datetime read.
+# The bulk endpoints use COPY there.
+EDAC_DB_ENGINE = os.environ.get('EDAC_DB_ENGINE', 'sqlite3')
+
+if EDAC_DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('EDAC_DB_NAME', 'edacdb'),
+            'USER': os.environ.get('EDAC_DB_USER', 'edac'),
+            'PASSWORD': os.environ.get('EDAC_DB_PASSWORD', ''),
+            'HOST': os.environ.get('EDAC_DB_HOST', 'localhost'),
+            'PORT': os.environ.get('EDAC_DB_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('EDAC_DB_CONN_MAX_AGE', '60')),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('EDAC_DB_NAME',
+                                   os.path.join(BASE_DIR, 'db.sqlite3')),
+            'OPTIONS': {
+                'timeout': 30,
+            }
+#            'ATOMIC_REQUESTS': True,
         }
-#        'ATOMIC_REQUESTS': True,
     }
+
+# PRAGMAs for every new SQLite connection (edacapi/dbtuning.py), {} for
+# none. WAL lets readers carry on while the bulk endpoints write.
+SQLITE_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,     # 256MB
+    'cache_size': -65536,       # Negative is KB, so 64MB
+    'temp_store': 'MEMORY',
 }
 
+# Layered on top while an importer holds import mode (bulk/importmode/).
+# A power cut mid import can lose the last writes, re-run the import.
+SQLITE_IMPORT_PROFILE = {
+    'synchronous': 'OFF',
+}
+
+# Content-Encoding for the CBOR API (rest_framework_cbor/compression.py),
+# as encoding:level in order of preference, e.g.
+# EDAC_CBOR_COMPRESSION=zstd:3,gzip:6. Unset is off. zstd needs the
+# zstandard package and is skipped without it.
+CBOR_COMPRESSION = [
+    (item.split(':')[0].strip(), int(item.split(':')[1]))
+    for item in os.environ.get('EDAC_CBOR_COMPRESSION', '').split(',')
+    if ':' in item]
+
+# Most a compressed request body may decompress to, bigger is a 400. The
+# uploader keeps its batches under 16MB so this is plenty.
+CBOR_MAX_DECOMPRESSED = int(os.environ.get('EDAC_CBOR_MAX_DECOMPRESSED',
+                                           64 * 1024 * 1024))
+
 # Seen a few issues with the cache
 #CACHES = {
 #    'default': {
@@ -0,0 +1,191 @@
+'''
+Content-Encoding for the CBOR API, both ways.
+
+The packed dumps and bulk batches are very repetitive (small ints, the
+same duphash prefixes over and over) so they shrink a lot. It's opt in,
+settings.CBOR_COMPRESSION lists the encodings to use as (encoding, level)
+in order of preference, empty means off.
+
+CBORCompressionMiddleware compresses CBOR responses, streamed ones as
+they go, for clients that send a matching Accept-Encoding. It also says
+which encodings the server takes on request bodies with an
+Accept-Encoding response header (RFC 7694), so the client knows it can
+compress what it sends. CBORParser decodes those, up to
+settings.CBOR_MAX_DECOMPRESSED bytes so a small body can't expand into
+gigabytes (a decompression bomb).
+
+gzip is always there, zstd needs the zstandard package.
+'''
+
+import gzip
+import io
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from rest_framework.exceptions import ParseError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MINSIZE = 1024      # Not worth it below this
+MAXDECOMPRESSED = 64 * 1024 * 1024  # If CBOR_MAX_DECOMPRESSED isn't set
+READSIZE = 65536    # Reading to EOF goes this much at a time
+
+
+def available():
+    # Encodings we can do at all, best first
+    if zstandard is not None:
+        return ['zstd', 'gzip']
+    return ['gzip']
+
+
+def getlevels():
+    # [(encoding, level)] from settings that we can actually do
+    return [(encoding, level) for encoding, level
+            in getattr(settings, 'CBOR_COMPRESSION', None) or []
+            if encoding in available()]
+
+
+def chooseencoding(acceptencoding, levels):
+    # The first of ours the client will take, (encoding, level) or None
+    accepted = set()
+    for part in acceptencoding.split(','):
+        params = part.strip().split(';')
+        name = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, sep, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(name)
+    for encoding, level in levels:
+        if (encoding in accepted) or ('*' in accepted):
+            return encoding, level
+    return None
+
+
+def getcompressor(encoding, level):
+    # Something with compress(data) and flush(), for streaming
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    raise ValueError('Unsupported encoding %s' % encoding)
+
+
+def compress(data, encoding, level):
+    if encoding == 'gzip':
+        return gzip.compress(data, level)
+    compressor = getcompressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compressstream(chunks, encoding, level):
+    # Compresses a streamed response as it goes
+    compressor = getcompressor(encoding, level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class LimitedReader(io.RawIOBase):
+    """
+    Reads a decompressing reader through, counting what comes out, and
+    raises ParseError once it's past limit rather than carrying on.
+    """
+
+    def __init__(self, fp, limit):
+        self.fp = fp
+        self.limit = limit
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            data = self.read(READSIZE)
+            while len(data) > 0:
+                chunks.append(data)
+                data = self.read(READSIZE)
+            return b''.join(chunks)
+        # Never more than one byte past the limit
+        data = self.fp.read(min(size, self.limit - self.count + 1))
+        self.count += len(data)
+        if self.count > self.limit:
+            raise ParseError('Request body is over %d bytes decompressed'
+                             % self.limit)
+        return data
+
+
+def decompressreader(stream, encoding):
+    # A file object that reads a request body with the given
+    # Content-Encoding back out as it was, no more than
+    # CBOR_MAX_DECOMPRESSED bytes of it
+    encoding = encoding.strip().lower()
+    limit = getattr(settings, 'CBOR_MAX_DECOMPRESSED', MAXDECOMPRESSED)
+    if encoding in ('', 'identity'):
+        return stream
+    if encoding in ('gzip', 'x-gzip'):
+        return LimitedReader(gzip.GzipFile(fileobj=stream, mode='rb'), limit)
+    if (encoding == 'zstd') and (zstandard is not None):
+        return LimitedReader(zstandard.ZstdDecompressor().stream_reader(stream),
+                             limit)
+    raise ValueError('Unsupported Content-Encoding %s' % encoding)
+
+
+class CBORCompressionMiddleware(object):
+    # Only touches application/cbor responses, and only when
+    # CBOR_COMPRESSION is set.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        levels = getlevels()
+        if len(levels) == 0:
+            return response
+        if not response.get('Content-Type', '').startswith('application/cbor'):
+            return response
+        # What request bodies can be sent as
+        response['Accept-Encoding'] = ', '.join(available())
+        if response.has_header('Content-Encoding'):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        chosen = chooseencoding(request.META.get('HTTP_ACCEPT_ENCODING', ''),
+                                levels)
+        if chosen is None:
+            return response
+        encoding, level = chosen
+        if response.streaming:
+            response.streaming_content = compressstream(
+                                            response.streaming_content,
+                                            encoding, level)
+            if response.has_header('Content-Length'):
+                del response['Content-Length']
+        else:
+            if len(response.content) < MINSIZE:
+                return response
+            compressed = compress(response.content, encoding, level)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        return response
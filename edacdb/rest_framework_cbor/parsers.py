@@ -7,7 +7,9 @@ https://pypi.org/project/cbor2/
 '''
 
 import decimal
+import io
 #import msgpack
+import struct
 import sys
 import cbor2        # In my tests this appeared to give better perf than cbor
 #from dateutil.parser import parse
@@ -15,6 +17,8 @@ import cbor2        # In my tests this appeared to give better perf than cbor
 from rest_framework.parsers import BaseParser
 from rest_framework.exceptions import ParseError
 
+from . import compression
+
 
 class CBORDecoder(object):
 
@@ -40,9 +44,154 @@ class CBORDecoder(object):
         return decimal.Decimal(obj['as_str'])
 
 
+class PushbackReader(io.RawIOBase):
+    """
+    Just enough of a file object for cbor2 to read from, but lets us look
+    at the next initial byte (is it the break code?) and put it back
+    before the decoder sees it. Same as the slumber client's.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pushback = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def unread(self, data):
+        self.pushback = data + self.pushback
+
+    def read(self, size=-1):
+        if len(self.pushback) == 0:
+            if size < 0:
+                return self.fp.read()
+            return self.fill(size)
+        if size < 0:
+            data = self.pushback + self.fp.read()
+            self.pushback = b''
+            return data
+        data = self.pushback[:size]
+        self.pushback = self.pushback[size:]
+        if len(data) < size:
+            data += self.fill(size - len(data))
+        return data
+
+    def fill(self, size):
+        # Decompressing readers can come back short, keep going to EOF
+        data = self.fp.read(size)
+        while 0 < len(data) < size:
+            more = self.fp.read(size - len(data))
+            if len(more) == 0:
+                break
+            data += more
+        return data
+
+
+class CBORArrayStream(object):
+    """
+    A top level CBOR array decoded an item at a time, as it's read off the
+    request stream. Iterate it once, or take it a list at a time with
+    chunks(). Bad or truncated CBOR raises ParseError when it's reached.
+    """
+
+    def __init__(self, reader, length):
+        self.reader = reader
+        self.length = length        # None if indefinite
+        self.decoder = cbor2.CBORDecoder(reader)
+        self.decoded = 0
+        self.peeked = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self.peeked) > 0:
+            return self.peeked.pop()
+        if self.length is None:
+            nextbyte = self.reader.read(1)
+            if nextbyte == b'\xff':
+                self.length = self.decoded
+                raise StopIteration
+            if len(nextbyte) == 0:
+                raise ParseError('CBOR parse error - array not terminated')
+            self.reader.unread(nextbyte)
+        elif self.decoded >= self.length:
+            raise StopIteration
+        try:
+            item = self.decoder.decode()
+        except ParseError:
+            raise
+        except Exception as exc:
+            print(exc)
+            if isinstance(exc.__cause__, ParseError):
+                # The reader's own (over CBOR_MAX_DECOMPRESSED), cbor2
+                # wraps it
+                raise exc.__cause__
+            raise ParseError('CBOR parse error - %s' % exc)
+        self.decoded += 1
+        return item
+
+    def peek(self):
+        # The next item without taking it, None at the end
+        if len(self.peeked) == 0:
+            try:
+                self.peeked.append(next(self))
+            except StopIteration:
+                return None
+        return self.peeked[0]
+
+    def chunks(self, size):
+        # Lists of up to size items
+        chunk = []
+        for item in self:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+
+def streamarray(stream):
+    # A CBORArrayStream if the body is an array, anything else is decoded
+    # whole as usual. Only the array header is read here.
+    reader = PushbackReader(stream)
+    initial = reader.read(1)
+    if len(initial) == 0:
+        raise ValueError('Empty body')
+    major = initial[0] >> 5
+    info = initial[0] & 31
+    if major != 4:
+        reader.unread(initial)
+        return cbor2.CBORDecoder(reader).decode()
+    if info == 31:
+        length = None       # Indefinite, runs until the break code
+    elif info < 24:
+        length = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        length = struct.unpack('>' + {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}[size],
+                               reader.read(size))[0]
+    else:
+        raise ValueError('Invalid CBOR array header')
+    return CBORArrayStream(reader, length)
+
+
 class CBORParser(BaseParser):
     """
     Parses CBOR-serialized data.
+    Bodies sent with a Content-Encoding (gzip, zstd) are decoded first.
+    Views can list methods in streammethods to have a top level array
+    handed over as a CBORArrayStream, decoded as they read it, instead
+    of the whole list.
     """
 
     media_type = 'application/cbor'
@@ -57,6 +206,14 @@ class CBORParser(BaseParser):
             # print("CBOR PARSE START")
             # encoding = 'utf-8'
             # data = stream.read().decode(encodoing)
+            request = (parser_context or {}).get('request')
+            view = (parser_context or {}).get('view')
+            if request is not None:
+                stream = compression.decompressreader(
+                            stream,
+                            request.META.get('HTTP_CONTENT_ENCODING', ''))
+                if request.method in getattr(view, 'streammethods', ()):
+                    return streamarray(stream)
             data = stream.read()
             # print(sys.getsizeof(data))
             myout = cbor2.loads(data)
@@ -0,0 +1,92 @@
+from io import BytesIO
+import cbor2
+from django.test import TestCase, override_settings
+from rest_framework.exceptions import ParseError
+from rest_framework_cbor import compression
+from rest_framework_cbor.parsers import CBORParser, streamarray
+from rest_framework_cbor.test_parsers import FakeRequest, FakeView
+
+
+class CBORCompressionTests(TestCase):
+    """
+    Tests for compressed request bodies
+    """
+
+    obj = [3, 'id', 'eddbid', 'name'] + [[n, n, 'S%d' % n]
+                                         for n in range(0, 1000)]
+
+    def test_gzip_roundtrip(self):
+        content = compression.compress(cbor2.dumps(self.obj), 'gzip', 6)
+        self.assertLess(len(content), len(cbor2.dumps(self.obj)))
+        reader = compression.decompressreader(BytesIO(content), 'gzip')
+        self.assertEquals(cbor2.loads(reader.read()), self.obj)
+
+    def test_gzip_stream(self):
+        # Compressed a chunk at a time, read back an item at a time
+        content = b''.join(compression.compressstream(
+                    [b'\x9f'] + [cbor2.dumps(item) for item in self.obj] +
+                    [b'\xff'], 'gzip', 6))
+        reader = compression.decompressreader(BytesIO(content), 'gzip')
+        self.assertEquals(list(streamarray(reader)), self.obj)
+
+    def test_identity(self):
+        stream = BytesIO(cbor2.dumps(self.obj))
+        self.assertIs(compression.decompressreader(stream, ''), stream)
+        self.assertIs(compression.decompressreader(stream, 'identity'),
+                      stream)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, compression.decompressreader,
+                          BytesIO(b''), 'br')
+
+    def test_parser_gzip(self):
+        content = compression.compress(cbor2.dumps(self.obj), 'gzip', 6)
+        parser = CBORParser()
+        data = parser.parse(BytesIO(content),
+                            parser_context={'request': FakeRequest('POST',
+                                                                   'gzip'),
+                                            'view': FakeView()})
+        self.assertEquals(list(data), self.obj)
+        data = parser.parse(BytesIO(content),
+                            parser_context={'request': FakeRequest('PUT',
+                                                                   'gzip'),
+                                            'view': FakeView()})
+        self.assertEquals(data, self.obj)
+
+
+@override_settings(CBOR_MAX_DECOMPRESSED=1024 * 1024)
+class CBORDecompressLimitTests(TestCase):
+    """
+    Tests that compressed bodies can't decompress past the limit
+    """
+
+    def test_at_limit(self):
+        content = compression.compress(b'\0' * 1024 * 1024, 'gzip', 6)
+        reader = compression.decompressreader(BytesIO(content), 'gzip')
+        self.assertEquals(len(reader.read()), 1024 * 1024)
+
+    def test_bomb(self):
+        # 8MB of zeros is 8KB gzipped
+        content = compression.compress(b'\0' * 8 * 1024 * 1024, 'gzip', 9)
+        self.assertLess(len(content), 16 * 1024)
+        reader = compression.decompressreader(BytesIO(content), 'gzip')
+        self.assertRaises(ParseError, reader.read)
+        reader = compression.decompressreader(BytesIO(content), 'gzip')
+        self.assertRaises(ParseError, reader.read, 2 * 1024 * 1024)
+
+    def test_parser_bomb(self):
+        obj = [b'\0' * 65536] * 128      # 8MB
+        content = compression.compress(cbor2.dumps(obj), 'gzip', 9)
+        parser = CBORParser()
+        # Read whole
+        self.assertRaises(ParseError, parser.parse, BytesIO(content),
+                          parser_context={'request': FakeRequest('PUT',
+                                                                 'gzip'),
+                                          'view': FakeView()})
+        # Streamed, stops at the item that goes past it
+        data = parser.parse(BytesIO(content),
+                            parser_context={'request': FakeRequest('POST',
+                                                                   'gzip'),
+                                            'view': FakeView()})
+        with self.assertRaisesRegex(ParseError, 'decompressed'):
+            list(data)
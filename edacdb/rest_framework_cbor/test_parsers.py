@@ -0,0 +1,95 @@
+from io import BytesIO
+import cbor2
+from django.test import TestCase
+from rest_framework.exceptions import ParseError
+from rest_framework_cbor.parsers import (CBORArrayStream, CBORParser,
+                                         streamarray)
+
+
+def indefinite(items):
+    # cbor2 only writes definite arrays
+    return b'\x9f' + b''.join(cbor2.dumps(item) for item in items) + b'\xff'
+
+
+class FakeRequest(object):
+    def __init__(self, method='POST', encoding=''):
+        self.method = method
+        self.META = {'HTTP_CONTENT_ENCODING': encoding}
+
+
+class FakeView(object):
+    streammethods = ('POST',)
+
+
+class CBORArrayStreamTests(TestCase):
+    """
+    Tests for the streamed top level array
+    """
+
+    def test_definite(self):
+        obj = [3, 'id', 'eddbid', 'name'] + [[n, n, 'S%d' % n]
+                                             for n in range(0, 1000)]
+        items = streamarray(BytesIO(cbor2.dumps(obj)))
+        self.assertIsInstance(items, CBORArrayStream)
+        self.assertEquals(items.length, len(obj))
+        self.assertEquals(list(items), obj)
+
+    def test_indefinite(self):
+        obj = [{'foo': n} for n in range(0, 100)]
+        items = streamarray(BytesIO(indefinite(obj)))
+        self.assertIsNone(items.length)
+        self.assertEquals(list(items), obj)
+        self.assertEquals(items.length, len(obj))
+
+    def test_peek(self):
+        items = streamarray(BytesIO(cbor2.dumps([1, 2])))
+        self.assertEquals(items.peek(), 1)
+        self.assertEquals(items.peek(), 1)
+        self.assertEquals(list(items), [1, 2])
+        self.assertIsNone(items.peek())
+
+    def test_chunks(self):
+        obj = list(range(0, 25))
+        items = streamarray(BytesIO(indefinite(obj)))
+        chunks = list(items.chunks(10))
+        self.assertEquals([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEquals(sum(chunks, []), obj)
+
+    def test_empty_array(self):
+        self.assertEquals(list(streamarray(BytesIO(cbor2.dumps([])))), [])
+        self.assertIsNone(streamarray(BytesIO(indefinite([]))).peek())
+
+    def test_not_an_array(self):
+        obj = {'foo': ['bar', 'baz']}
+        self.assertEquals(streamarray(BytesIO(cbor2.dumps(obj))), obj)
+
+    def test_empty_body(self):
+        self.assertRaises(ValueError, streamarray, BytesIO(b''))
+
+    def test_truncated_definite(self):
+        content = cbor2.dumps([[n, 'S%d' % n] for n in range(0, 100)])
+        items = streamarray(BytesIO(content[:-5]))
+        self.assertRaises(ParseError, list, items)
+
+    def test_truncated_indefinite(self):
+        # No break code
+        content = indefinite([[n, 'S%d' % n] for n in range(0, 100)])
+        items = streamarray(BytesIO(content[:-1]))
+        self.assertRaises(ParseError, list, items)
+        # Cut inside an item
+        items = streamarray(BytesIO(content[:-5]))
+        self.assertRaises(ParseError, list, items)
+
+    def test_parser_streams(self):
+        obj = [[n, 'S%d' % n] for n in range(0, 100)]
+        parser = CBORParser()
+        data = parser.parse(BytesIO(cbor2.dumps(obj)),
+                            parser_context={'request': FakeRequest(),
+                                            'view': FakeView()})
+        self.assertIsInstance(data, CBORArrayStream)
+        self.assertEquals(list(data), obj)
+        # Methods the view doesn't list get the whole list
+        data = parser.parse(BytesIO(cbor2.dumps(obj)),
+                            parser_context={'request': FakeRequest('PUT'),
+                                            'view': FakeView()})
+        self.assertEquals(data, obj)
@@ -21,13 +21,23 @@ import base64
 import sys
 import gc
 import copy
-from multiprocessing import Process, Queue, JoinableQueue
+import os
+from array import array
+from collections import deque
+from multiprocessing import Process
 from coreapi.compat import b64encode
 from urllib import parse as parse
+try:
+    from modules import fingerprint
+    from modules import edacdb_uploader
+except:
+    import fingerprint
+    import edacdb_uploader
 
 DEBUG = True
 ERROR = True
 VERSION = '2.2 Beta'
+SNAPSHOTVERSION = 2     # Bump to invalidate existing cache snapshot files
 
 
 def printdebug(mystring, inplace=False):
@@ -44,211 +54,214 @@ def printerror(mystring):
         print("ERROR edacdb_cache: %s" % mystring)
 
 
-class CompositionBulkUpdateProcess(Process):
-    # Based on https://pymotw.com/2/multiprocessing/communication.html
-    # Also supports rings (HashedItemCache)
-    # and bodies (BodyCache)
-    def __init__(self, bulkapi, mylist, task_queue, result_queue):
-        Process.__init__(self)
-        self.slumapi = slumber.API(bulkapi['url'],
-                                   format='cbor',
-                                   auth=(bulkapi['username'],
-                                         bulkapi['password']))
-        self.task_queue = task_queue
-        self.result_queue = result_queue
-        self.mylist = mylist
-        printdebug('Created Composition Bulk Update Process for %s'
-                   % self.mylist)
-
-    def run(self):
-        proc_name = self.name
-        printdebug('Starting run of %s for %s' % (proc_name, self.mylist))
-        while True:
-            next_task = self.task_queue.get()
-            if next_task is None:
-                # Poison pill means shutdown
-                printdebug('%s-%s: Exiting' % (proc_name, self.mylist))
-                self.task_queue.task_done()
-                self.result_queue.close()
-                break
-            # print('%s: %d' % (proc_name, len(next_task)))
-            try:
-                # More complex this, need to pop type and mode from  next_task
-                jobtype = next_task.pop('jobtype')     # 'atmos', 'materials', etc
-                jobmode = next_task.pop('jobmode')   # 'update' or 'create'
-                                                     # or 'delete'
-                content = next_task.pop('content')
-                if jobmode == 'create':
-                    if jobtype == 'atmoscomposition':
-                        result = self.slumapi.atmoscomposition.post(content)
-                    elif jobtype == 'materialcomposition':
-                        result = self.slumapi.materialcomposition.post(content)
-                    elif jobtype == 'solidcomposition':
-                        result = self.slumapi.solidcomposition.post(content)
-                    elif jobtype == 'rings':
-                        result = self.slumapi.rings.post(content)
-                    elif jobtype == 'bodies':
-                        result = self.slumapi.bodies.post(content)
-                    elif jobtype == 'stations':
-                        result = self.slumapi.stations.post(content)
-                    elif jobtype == 'stationimports':
-                        result = self.slumapi.stationimports.post(content)
-                    elif jobtype == 'stationexports':
-                        result = self.slumapi.stationexports.post(content)
-                    elif jobtype == 'stationprohibited':
-                        result = self.slumapi.stationprohibited.post(content)
-                    elif jobtype == 'stationeconomies':
-                        result = self.slumapi.stationeconomies.post(content)
-                    elif jobtype == 'stationships':
-                        result = self.slumapi.stationships.post(content)
-                    elif jobtype == 'stationmodules':
-                        result = self.slumapi.bstationmodules.post(content)
-                    elif jobtype == 'systemids':
-                        result = self.slumapi.bcreatesystems.post(content)
-                    else:
-                        printerror('Composition Bulk Updater - Unknown Target')
-                        result = 0
-
-                elif jobmode == 'update':
-                    if jobtype == 'atmoscomposition':
-                        result = self.slumapi.atmoscomposition.put(content)
-                    elif jobtype == 'materialcomposition':
-                        result = self.slumapi.materialcomposition.put(content)
-                    elif jobtype == 'solidcomposition':
-                        result = self.slumapi.solidcomposition.put(content)
-                    elif jobtype == 'rings':
-                        result = self.slumapi.rings.put(content)
-                    elif jobtype == 'bodies':
-                        result = self.slumapi.bodies.put(content)
-                    elif jobtype == 'stations':
-                        result = self.slumapi.stations.put(content)
-                    elif jobtype == 'stationimports':
-                        result = self.slumapi.stationimports.put(content)
-                    elif jobtype == 'stationexports':
-                        result = self.slumapi.stationexports.put(content)
-                    elif jobtype == 'stationprohibited':
-                        result = self.slumapi.stationprohibited.put(content)
-                    elif jobtype == 'stationeconomies':
-                        result = self.slumapi.stationeconomies.put(content)
-                    elif jobtype == 'stationships':
-                        result = self.slumapi.stationships.put(content)
-                    elif jobtype == 'stationmodules':
-                        result = self.slumapi.bstationmodules.put(content)
-                    elif jobtype == 'systemids':
-                        result = self.slumapi.bupdatesystems.post(content)
-                        # TODO bring this more into line
-                    else:
-                        printerror('Composition Bulk Updater - Unknown Target')
-                        result = 0
-
-                elif jobmode == 'delete':
-                    if jobtype == 'stations':
-                        result = self.slumapi.stations.delete(content)
-                    elif jobtype == 'stationimports':
-                        result = self.slumapi.stationimports.delete(content)
-                    elif jobtype == 'stationexports':
-                        result = self.slumapi.stationexports.delete(content)
-                    elif jobtype == 'stationprohibited':
-                        result = self.slumapi.stationprohibited.delete(content)
-                    elif jobtype == 'stationeconomies':
-                        result = self.slumapi.stationeconomies.delete(content)
-                    elif jobtype == 'stationships':
-                        result = self.slumapi.stationships.delete(content)
-                    elif jobtype == 'stationmodules':
-                        result = self.slumapi.stationmodules.delete(content)
-                    else:
-                        printerror('Composition Bulk Updater - Unknown Target')
-                        result = 0
-
-                else:
-                    printerror('Composition Bulk Updater - Unknown Target')
-                    result = 0
-                self.result_queue.put(result)
-            except Exception as exc:
-                printerror('Error in %s for %s' % (proc_name, self.mylist))
-                #printerror('%s : %s : %s' % (jobmode, jobtype, content))
-                printerror('%s : %s' % (jobmode, jobtype))
-                printerror(exc)
-                exctype, value = sys.exc_info()[:2]
-                print("Unexpected error: %s :: %s" % (exctype, value))
-                # TODO I need to manage IntegrityErrors from the DB here
-                # Perhaps blank the related duphash for joins???
-
-                # printerror(content)
-                raise
-            finally:
-                self.task_queue.task_done()
-                # Yes, even if the data is lost... just rerun...
+def iterpackedrows(myiter):
+    # Turns a packed CBOR dump [cols, head1, head2..., (row), (row)...]
+    # into a stream of dicts, without holding the full list.
+    # myiter yields the dump's elements, e.g. from Resource.iterate
+    myiter = iter(myiter)
+    cols = next(myiter, None)
+    if cols is None:
         return
-
-
-class SystemBulkUpdateProcess(Process):
-    # Based on https://pymotw.com/2/multiprocessing/communication.html
-    def __init__(self, bulkapi, mode, task_queue, result_queue):
-        Process.__init__(self)
-        self.slumapi = slumber.API(bulkapi['url'],
-                                   format='cbor',
-                                   auth=(bulkapi['username'],
-                                         bulkapi['password']))
-        self.mode = mode
-        self.task_queue = task_queue
-        self.result_queue = result_queue
-        printdebug('Created System Bulk Update Process')
-
-    def run(self):
-        proc_name = self.name
-        printdebug('Starting run of %s' % proc_name)
+    heads = [next(myiter) for i in range(0, cols)]
+    for row in myiter:
+        yield dict(zip(heads, row))
+
+
+def unpackresults(packedlist):
+    # Reconstruct the data from a packed CBOR page
+    # [4, 'pk', 'edsmid', 'eddbid', 'duphash',
+    # (9397648, 60, 17, 'sENZY4K/'), ..etc..
+    # into a list of dicts
+    if len(packedlist) == 0:
+        return []
+    cols = packedlist[0]
+    heads = packedlist[1:cols + 1]
+    return [dict(zip(heads, row)) for row in packedlist[cols + 1:]]
+
+
+class CompactIndex(object):
+    # Int to int lookup (eddbid/edsmid -> pk) with the same interface as
+    # the dicts it replaces, but held in two array('q') columns with open
+    # addressing. That's 16 bytes a slot rather than the ~100 bytes a
+    # dict entry plus two int objects cost, so 2.5M systems fit in a
+    # 32 bit process. None values (precreate placeholders) are kept as -1.
+    EMPTY = -(1 << 63)
+
+    def __init__(self, capacity=0):
+        self.used = 0
+        self.setsize(self.sizefor(capacity))
+
+    def sizefor(self, count):
+        size = 1024
+        while size * 0.6 < count:     # Keep the load factor down
+            size <<= 1
+        return size
+
+    def setsize(self, size, keycol=None, valcol=None):
+        self.size = size
+        self.mask = size - 1
+        self.shift = 64 - size.bit_length() + 1
+        if keycol is None:
+            keycol = array('q', [self.EMPTY]) * size
+            valcol = array('q', [-1]) * size
+        self.keycol = keycol
+        self.valcol = valcol
+
+    def findslot(self, key):
+        # Fibonacci hashing, then linear probing
+        i = ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self.shift
+        keycol = self.keycol
+        mask = self.mask
         while True:
-            next_task = self.task_queue.get()
-            if next_task is None:
-                # Poison pill means shutdown
-                printdebug('%s: Exiting' % proc_name)
-                self.task_queue.task_done()
-                self.result_queue.close()
-                break
-            # print('%s: %d' % (proc_name, len(next_task)))
-            try:
-                if self.mode == 'create':
-                    result = self.slumapi.bcreatesystems.post(next_task)
-                else:
-                    result = self.slumapi.bupdatesystems.post(next_task)
-                self.result_queue.put(result)
-            except Exception as exc:
-                printerror(exc)
-            finally:
-                self.task_queue.task_done()
-        return
-
+            k = keycol[i]
+            if (k == key) or (k == self.EMPTY):
+                return i
+            i = (i + 1) & mask
+
+    def reserve(self, count):
+        # Grow once up front rather than repeatedly during a load
+        if count * 1.0 > self.size * 0.6:
+            oldkeys = self.keycol
+            oldvals = self.valcol
+            self.setsize(self.sizefor(count))
+            for i in range(0, len(oldkeys)):
+                if oldkeys[i] != self.EMPTY:
+                    j = self.findslot(oldkeys[i])
+                    self.keycol[j] = oldkeys[i]
+                    self.valcol[j] = oldvals[i]
+
+    def __contains__(self, key):
+        if type(key) is not int:
+            return False
+        return self.keycol[self.findslot(key)] != self.EMPTY
+
+    def __getitem__(self, key):
+        if type(key) is not int:
+            raise KeyError(key)
+        i = self.findslot(key)
+        if self.keycol[i] == self.EMPTY:
+            raise KeyError(key)
+        value = self.valcol[i]
+        if value == -1:
+            return None
+        return value
 
-class FactionBulkUpdateProcess(Process):
-    # Based on https://pymotw.com/2/multiprocessing/communication.html
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if type(key) is not int:
+            return      # None keys were never looked up anyway
+        if value is None:
+            value = -1
+        i = self.findslot(key)
+        if self.keycol[i] == self.EMPTY:
+            if (self.used + 1) > self.size * 0.6:
+                self.reserve(self.used * 2)
+                i = self.findslot(key)
+            self.keycol[i] = key
+            self.used += 1
+        self.valcol[i] = value
+
+    def update(self, other):
+        self.reserve(self.used + len(other))
+        for key, value in other.items():
+            self[key] = value
+
+    def __len__(self):
+        return self.used
+
+    def items(self):
+        for i in range(0, self.size):
+            if self.keycol[i] != self.EMPTY:
+                value = self.valcol[i]
+                yield self.keycol[i], (None if value == -1 else value)
+
+    def keys(self):
+        return (key for key, value in self.items())
+
+    def getstate(self):
+        return {'used': self.used,
+                'keys': self.keycol.tobytes(),
+                'vals': self.valcol.tobytes()}
+
+    def setstate(self, state):
+        keycol = array('q')
+        keycol.frombytes(state['keys'])
+        valcol = array('q')
+        valcol.frombytes(state['vals'])
+        self.setsize(len(keycol), keycol, valcol)
+        self.used = state['used']
+
+
+class CompactHashes(object):
+    # pk -> duphash, in an array('q') addressed by pk. A duphash is a
+    # 64 bit fingerprint (see fingerprint.py) so each pk costs 9 bytes
+    # (8 of hash and one saying if we have it) instead of a dict entry
+    # and an int object.
+
+    def __init__(self):
+        self.data = array('q')
+        self.known = bytearray()    # 0 unknown, 1 known but no hash, 2 hash
+        self.used = 0
+
+    def grow(self, pk):
+        size = max(pk + 1, len(self.known) * 2, 1024)
+        self.data.extend(array('q', [0]) * (size - len(self.known)))
+        self.known.extend(bytes(size - len(self.known)))
+
+    def reserve(self, pk):
+        if pk >= len(self.known):
+            self.grow(pk)
+
+    def __contains__(self, pk):
+        if type(pk) is not int:
+            return False
+        return (0 <= pk < len(self.known)) and (self.known[pk] != 0)
 
-    def __init__(self, bulkapi, task_queue, result_queue):
-        Process.__init__(self)
-        self.slumapi = slumber.API(bulkapi['url'],
-                                   format='cbor',
-                                   auth=(bulkapi['username'],
-                                         bulkapi['password']))
-        self.task_queue = task_queue
-        self.result_queue = result_queue
-        printdebug('Created Faction Bulk Update Process')
+    def __getitem__(self, pk):
+        if pk not in self:
+            raise KeyError(pk)
+        if self.known[pk] == 1:
+            return None
+        return self.data[pk]
 
-    def run(self):
-        proc_name = self.name
-        printdebug('Starting run of %s' % proc_name)
-        while True:
-            next_task = self.task_queue.get()
-            if next_task is None:
-                # Poison pill means shutdown
-                printdebug('%s: Exiting' % proc_name)
-                self.task_queue.task_done()
-                self.result_queue.close()
-                break
-            # print('%s: %d' % (proc_name, len(next_task)))
-            result = self.slumapi.factions.post(next_task)
-            self.task_queue.task_done()
-            self.result_queue.put(result)
-        return
+    def get(self, pk, default=None):
+        try:
+            return self[pk]
+        except KeyError:
+            return default
+
+    def __setitem__(self, pk, duphash):
+        if pk not in self:
+            self.reserve(pk)
+            self.used += 1
+        if duphash is None:
+            self.known[pk] = 1
+            return
+        self.data[pk] = duphash
+        self.known[pk] = 2
+
+    def update(self, other):
+        for pk, duphash in other.items():
+            self[pk] = duphash
+
+    def __len__(self):
+        return self.used
+
+    def getstate(self):
+        return {'used': self.used,
+                'data': self.data.tobytes(),
+                'known': bytes(self.known)}
+
+    def setstate(self, state):
+        self.data = array('q')
+        self.data.frombytes(state['data'])
+        self.known = bytearray(state['known'])
+        self.used = state['used']
 
 
 class SystemIDImporter(Process):
@@ -306,28 +319,31 @@ class FactionCache(object):
             self.bulklist.append(myparams)
             self.bulkcount += 1
             if self.bulkcount > 256:
-                self.bulkqueue.put(self.bulklist)
-                self.bulklist = []
-                self.bulkcount = 0
+                self.queuejob()
             # TODO update cache
             self.items[item] = 0   # Means I know it but not really
 
+    def queuejob(self):
+        # Hands the batch to the shared uploader, which blocks while the
+        # factions window is full. The list goes, we start a new one.
+        if len(self.bulklist) > 0:
+            self.pending.append(self.uploader.submit(self.mylist, 'create',
+                                                     self.bulklist,
+                                                     window=self.bulkprocesses))
+        self.bulklist = []
+        self.bulkcount = 0
+
     def flushbulkupdate(self):
-        # Empties any queue and tells process to end.
-        # Can only be called once as it stops the process
-        # Must be called for a clean close.
-        self.bulkqueue.put(self.bulklist)
-        for myid in range(0, self.bulkprocesses):
-            self.bulkqueue.put(None)
-        self.bulkqueue.close()
+        # Sends what's left and waits for every batch to be committed.
+        # The caller refreshes the factions ItemCache afterwards.
+        self.queuejob()
         printdebug('FactionCache: Queuing complete. Waiting for DB commit.')
-        self.bulkqueue.join()
-        while self.resultqueue.empty() is not True:
-            garbage = self.resultqueue.get()
+        while len(self.pending) > 0:
+            reply = self.pending.popleft().result()
+            if reply.get('deadletter') is not None:
+                printerror('FactionCache: batch dead-lettered, replay with'
+                           ' edacdb_uploader.py --replay')
         printdebug('FactionCache: DB committed.')
-        for myid in range(0, self.bulkprocesses):
-            self.bulkprocess[myid].join()
-        printdebug('Flushed Faction Bulk Update Process.')
 
     # As per the ItemCache, I could be cleverer with inheritence here
     def refresh(self):
@@ -356,211 +372,30 @@ class FactionCache(object):
         self.refresh()
         self.bulklist = []
         self.bulkcount = 0
-        self.bulkthreads = 0
-        self.bulkqueue = JoinableQueue()
-        self.resultqueue = Queue()
+        # Shared with the other caches, bulkprocesses is how many of our
+        # batches it will have in flight
+        self.uploader = edacdb_uploader.getuploader(self.bulkapi)
         self.bulkprocesses = 2
-        self.bulkprocess = {}
-        # Create processes
-        for myid in range(0, self.bulkprocesses):
-            self.bulkprocess[myid] = FactionBulkUpdateProcess(
-                                        self.bulkapi,
-                                        self.bulkqueue,
-                                        self.resultqueue)
-            self.bulkprocess[myid].start()
+        self.pending = deque()
         #print(self.items)
 
 
-class BodyCache(object):
-    # This could probably be refactored alongside Composition Cache
-
-    def getpkfromeddbid(self, eddbid):
-        if eddbid in self.eddb:
-            return self.eddb[eddbid]
-        else:
-            return None
-
-    def addtobulkupdate(self, origcomposition, mode):
-        composition = copy.deepcopy(origcomposition)
-        if mode not in self.bulklist:
-            self.bulklist[mode] = []
-        if mode not in self.bulkcount:
-            self.bulkcount[mode] = 0
-        self.bulklist[mode].append(composition)
-        self.bulkcount[mode] += 1
-        if self.bulkcount[mode] > 1000:
-            # This hands in bulk to other process via queue
-            # wrap up in dict to indicate target in API
-            mydict = {}
-            mydict['content'] = self.bulklist[mode]
-            mydict['jobtype'] = self.mylist
-            mydict['jobmode'] = mode
-            self.bulkqueue.put(mydict)
-            self.bulklist[mode] = []
-            self.bulkcount[mode] = 0
-            while self.bulkqueue.qsize() > self.bulkprocesses:
-                # no point letting the queue get too big
-                # This blocks
-                time.sleep(0.1)
-            # TODO update cache
-
-    def addtocache(self, newsys):
-        # We send pk but get id! grrr
-        if 'id' in newsys.keys():
-            newsys['pk'] = newsys['id']
-        if newsys['eddbid'] is not None:
-            self.eddb[newsys['eddbid']] = newsys['pk']
-        if newsys['edsmid'] is not None:
-            self.edsm[newsys['edsmid']] = newsys['pk']
-        self.duphash[newsys['pk']] = newsys['duphash']
-
-    def findoradd(self, body):
-        dbid = None
-        if body['eddbid'] is not None:
-            if body['eddbid'] in self.eddb.keys():
-                dbid = self.eddb[body['eddbid']]
-            elif 'edsmid' in body:
-                if body['edsmid'] is not None:
-                    if body['edsmid'] in self.edsm.keys():
-                        dbid = self.edsm[body['edsmid']]
-        if dbid is None:
-            try:
-                if self.bulkmode is True:
-                    self.addtobulkupdate(body, 'create')
-                    return None
-                else:
-                    newitem = self.client.action(
-                                    self.schema,
-                                    [self.mylist, 'create'],
-                                    params=body)
-                    self.addtocache(newitem)
-                    return newitem['pk']
-            except Exception as e:
-                print('Exception in Body FoA create.')
-                print(str(e))
-                print(body)
-                return None
-        else:
-            # check if we need to update
-            if self.duphash[dbid] != body['duphash']:
-                body['pk'] = dbid
-                try:        # TODO make a bulk updater?
-                    if self.bulkmode is True:
-                        body['id'] = body.pop('pk')   # ANNOYING!
-                        self.addtobulkupdate(body, 'update')
-                        return None
-                    else:
-                        newitem = self.client.action(self.schema,
-                                                    [self.mylist, 'update'],
-                                                    params=body)
-                        self.addtocache(newitem)    # to update duphash
-                except Exception as e:
-                    printdebug('Exception in Body FoA update.')
-                    printdebug(str(e))
-                    printdebug(body)
-                return dbid
-            else:
-                return dbid
-
-    def startbulkmode(self):
-        # Start Bulk Upload processes
-        if self.bulkmode is False:
-            self.bulklist = {}  # Dict for different batch types
-            self.bulkcount = {}
-            self.bulkqueue = JoinableQueue()
-            self.resultqueue = Queue()
-            self.bulkprocesses = 2
-            self.bulkprocess = {}
-            # Create processes
-            for myid in range(0, self.bulkprocesses):
-                self.bulkprocess[myid] = CompositionBulkUpdateProcess(
-                                            self.bulkapi,
-                                            self.mylist,
-                                            self.bulkqueue,
-                                            self.resultqueue)
-                self.bulkprocess[myid].start()
-            self.bulkmode = True
-        else:
-            printerror('Body Cache %s Bulkmode already enabled'
-                       % self.mylist)
-
-    def endbulkmode(self):
-        # Start Bulk Upload processes
-        if self.bulkmode is True:
-            for mode in self.bulklist:
-                mydict = {}
-                mydict['content'] = self.bulklist[mode]
-                mydict['jobtype'] = self.mylist
-                mydict['jobmode'] = mode
-                self.bulkqueue.put(mydict)
-            for myid in range(0, self.bulkprocesses):
-                self.bulkqueue.put(None)
-            self.bulkqueue.close()
-            printdebug('Body Cache: Queuing complete. Waiting for DB commit.')
-            self.bulkqueue.join()
-            while self.resultqueue.empty() is not True:
-                garbage = self.resultqueue.get()
-            printdebug('Body Cache: DB committed.')
-            for myid in range(0, self.bulkprocesses):
-                self.bulkprocess[myid].join()
-            printdebug('Flushed Body Cache Bulk Update Process.')
-            self.bulkmode = False
-            self.refresh()
-        else:
-            printerror('Body Cache %s Bulkmode not running.'
-                       % self.mylist)
-
-    def refresh(self):
-        mylist = self.client.action(self.schema, [self.mylist, 'list'])
-        self.count = mylist['count']
-        limit = 10000
-        offset = 0
-        # mydict = {}
-        while offset < self.count:
-            mylist = self.client.action(
-                                self.schema,
-                                [self.mylist, 'list'],
-                                params={'limit': limit, 'offset': offset})
-            if len(mylist) > 0:
-                for odict in mylist['results']:
-                    # print(odict)
-                    eddbid = odict['eddbid']
-                    edsmid = odict['edsmid']       # Does EDSM track bodies?
-                    duphash = odict['duphash']
-                    pk = odict['id']    # WHY IS THIS NOT PK ???????
-                    if eddbid is not None:
-                        self.eddb[eddbid] = pk
-                    if edsmid is not None:
-                        self.edsm[edsmid] = pk
-                    if duphash is not None:
-                        self.duphash[pk] = duphash
-            offset += limit
-        # self.items = mydict
-
-    def __init__(self, client, schema, bulkapi, mylist):
-        printdebug('Loading %s Cache' % mylist)
-        self.client = client
-        self.schema = schema
-        self.mylist = mylist
-        self.bulkapi = bulkapi
-        self.bulkmode = False
-        self.eddb = {}
-        self.edsm = {}
-        self.duphash = {}
-        self.refresh()
-        # print(self.items)
-
-
 class CBORJoinCache(object):
     # Refactoring other items
     # This is now a base for many classes
 
-    def addtobulkupdate(self, origitem, mode):
-        thisitem = copy.deepcopy(origitem)
+    def addtobulkupdate(self, thisitem, mode):
+        # Takes ownership of thisitem, it goes into the batch as it is
+        # rather than as a copy, so the caller mustn't change it after.
+        # Every caller builds a fresh dict per row anyway.
         # We can signal the record needs refreshing later here
         if (self.partialfield is not None) and (mode != 'delete'):
             if self.partialfield in thisitem:
                 self.partiallist.append(thisitem[self.partialfield])
+        if mode == 'update':
+            # We already know what the row will look like, so the cache
+            # is updated now rather than by a refresh afterwards
+            self.cacheloaditem(dict(thisitem))
         #
         if mode not in self.bulklist:
             self.bulklist[mode] = []
@@ -568,32 +403,58 @@ class CBORJoinCache(object):
             self.bulkcount[mode] = 0
         self.bulklist[mode].append(thisitem)
         self.bulkcount[mode] += 1
-        if self.bulkcount[mode] > self.bulklimit:    # Higher as these are small records
+        if self.bulkcount[mode] > self.sizer.size:  # Tuned from bulklimit
             # We need to make sure that if there is any delete queue
             # that it is processed first.
             if 'delete' in self.bulklist:
                 if len(self.bulklist['delete']) > 0:
-                    mydictd = {}
-                    mydictd['content'] = copy.copy(self.bulklist['delete'])
-                    mydictd['jobtype'] = self.mylist
-                    mydictd['jobmode'] = 'delete'
-                    self.bulkqueue.put(mydictd)
+                    self.queuejob('delete', self.bulklist['delete'])
                     self.bulklist['delete'] = []
                     self.bulkcount['delete'] = 0
-            # This hands in bulk to other process via queue
-            # wrap up in dict to indicate target in API
-            mydict = {}
-            mydict['content'] = copy.copy(self.bulklist[mode])
-            mydict['jobtype'] = self.mylist
-            mydict['jobmode'] = mode
-            self.bulkqueue.put(mydict)
+            # This hands in bulk to the uploader, which blocks while
+            # this table has its window of uploads in flight. The list
+            # itself goes, we start a new one rather than copying it.
+            self.queuejob(mode, self.bulklist[mode])
             self.bulklist[mode] = []
             self.bulkcount[mode] = 0
-            while self.bulkqueue.qsize() > (self.bulkprocesses * 2):
-                # no point letting the queue get too big
-                # This blocks
-                time.sleep(0.1)
-            # TODO update cache
+            self.collectresults()
+
+    def queuejob(self, mode, content):
+        self.pending.append(self.uploader.submit(self.mylist, mode, content,
+                                                 window=self.bulkprocesses))
+
+    def loadreply(self, reply):
+        # Loads any newly created rows handed back by an upload
+        if reply['complete'] is not True:
+            self.bulkresolved = False
+        if ((reply['jobmode'] in ('create', 'replace'))
+                and (type(reply['result']) is dict)):
+            mylist = unpackresults(reply['result'].get('results', []))
+            if len(mylist) > 0:
+                self.bulkloaded += len(mylist)
+                self.precreate(mylist)
+                for odict in mylist:
+                    self.cacheloaditem(odict)
+
+    def collectresults(self, wait=False):
+        # Loads the replies of finished uploads, in the order they were
+        # queued. With wait, waits for everything still in flight.
+        # bulkresolved stays True while every job has come back complete,
+        # i.e. the cache matches the DB and there's nothing to refresh.
+        while len(self.pending) > 0:
+            if (wait is False) and (self.pending[0].done() is False):
+                break
+            future = self.pending.popleft()
+            try:
+                reply = future.result()
+            except Exception as exc:
+                printerror('Cache: %s: Bulk upload failed.' % self.mylist)
+                printerror(str(exc))
+                self.bulkresolved = False
+                continue
+            if reply.get('deadletter') is not None:
+                self.bulkdeadletters += 1
+            self.loadreply(reply)
 
     def clearcache(self):
         self.items = {}
@@ -629,14 +490,9 @@ class CBORJoinCache(object):
         slumapi = slumber.API(bulkapi['url'],
                               format='cbor',
                               auth=(bulkapi['username'],
-                              bulkapi['password']))
-        response = getattr(slumapi.cbor, self.mylist).get(
-                            offset=0, limit=1)
-        count = response['count']       # Total number of records
-        printdebug('CBORJoinCache:refresh:dbcount:%d' % count)
+                              bulkapi['password']),
+                              compression=bulkapi.get('compression'))
         totalcount = 0
-        limit = 500000                  # These are small records, get lots
-        offset = 0                      # Start here
         rdict = self.getitemstorefresh()   # Need to do this always to populate
                                            # dependants if necessary, but only
                                            # used in partial refreshes
@@ -650,81 +506,221 @@ class CBORJoinCache(object):
                 return      # Nothing to get, nothing to do.
             if partialcount == 1:
                 print(myvalues)
-            partialoffset = 0
-            partiallimit = 800     # Step through in chunks
+            # One streamed POST, however long the list, so the server
+            # builds its key table and joins against it once, not a page
+            # at a time.
+            totalcount, lastpk = self.streamrows(
+                                    getattr(slumapi.cbor, self.mylist).iterate(
+                                        'POST', {'field': myfield,
+                                                 'v': myvalues,
+                                                 'stream': 1}))
         else:
             printdebug('CBORJoinCache:%s:refresh: Fetching packed CBOR full dump.' % self.mylist)
-            partialcount = 1
-            partialoffset = 0
+            # limit=0 means we only get the count back
+            response = getattr(slumapi.cbor, self.mylist).get(
+                                offset=0, limit=0)
+            count = response['count']       # Total number of records
+            printdebug('CBORJoinCache:refresh:dbcount:%d' % count)
+            if self.cacheloaded is False:
+                # Start-up, try the local snapshot before the full dump
+                if self.loadsnapshot(slumapi, count) is True:
+                    return
             self.clearcache()               # Clear existing cache entries
-        while (offset < count) and (partialoffset < partialcount):
-            printdebug('Please wait. Loading. Loaded %d of %d....' % (
-                    offset, count), inplace=True)
-            if partial is True:
-                # get chunk of values
-                endlimit = partialoffset + partiallimit
-                valuechunk = myvalues[partialoffset:endlimit]
-                #
-                response = getattr(slumapi.cbor, self.mylist).get(
-                                offset=offset, limit=limit,
-                                field=myfield, v=valuechunk)
-                count = response['count']
-            else:
-                response = getattr(slumapi.cbor, self.mylist).get(
-                                offset=offset, limit=limit)
-            packedlist = response['results']
-            # Reconstruct the data
-            # [4, 'pk', 'edsmid', 'eddbid', 'duphash',
-            # (9397648, 60, 17, 'sENZY4K/'), ..etc..
-            mylist = []
-            if len(packedlist) > 0:
-                cols = packedlist.pop(0)
-                heads = [packedlist.pop(0) for i in range(0, cols)]
-                mylist = [{heads[il]:ol[il]
-                           for il in range(0, cols)}
-                          for ol in packedlist]
-                # Done - now I have a list of dicts
-            del packedlist      # free up the memory
-            idsprocessed = 0
+            self.hwm = 0
+            if self.streamrefresh is True:
+                self.streamload(getattr(slumapi.cbor, self.mylist), count)
+                self.savesnapshot(slumapi)
+                return
+            totalcount, self.hwm = self.loadpages(slumapi, count)
+        self.cacheloaded = True
+        self.partiallist = []   # Reset any partiallist
+        printdebug('Load complete. Loaded %d records.                ' % totalcount)
+        if partial is not True:
+            self.savesnapshot(slumapi)
+
+    def loadpages(self, slumapi, count, after_pk=0):
+        # Keyset pages through the packed dump from after_pk, loading
+        # each page into the cache. Only the first page is counted by the
+        # server, pass count=None to use that for the progress line.
+        # Returns the number of rows loaded and the last pk seen.
+        limit = 500000                  # These are small records, get lots
+        totalcount = 0
+        lastpk = after_pk
+        while after_pk is not None:
+            if count is not None:
+                printdebug('Please wait. Loading. Loaded %d of %d....' % (
+                        totalcount, count), inplace=True)
+            response = getattr(slumapi.cbor, self.mylist).get(
+                                after_pk=after_pk, limit=limit)
+            if count is None:
+                count = response.get('count')
+            after_pk = response.get('last_pk')
+            if after_pk is not None:
+                lastpk = after_pk
+            hasmore = response.get('has_more')
+            mylist = unpackresults(response['results'])
+            del response        # free up the memory
+            if hasmore is False or len(mylist) < limit:
+                after_pk = None     # That was the last page
             # Populate dict
             if len(mylist) > 0:
                 totalcount += len(mylist)
                 self.precreate(mylist)
                 for odict in mylist:
                     self.cacheloaditem(odict)
-            if partial is True:
-                printdebug('offset: %d, limit: %d, count: %d'
-                            % (offset, limit, count))
-                printdebug('Partial mode: adding offset')
-                offset += limit
-                if offset > count:
-                    printdebug('Partial mode: resetting offset for next chunk')
-                    printdebug('partialoffset: %d, partiallimit: %d'
-                                % (partialoffset, partiallimit))
-                    partialoffset += partiallimit
-                    offset = 0
-            else:
-                offset += limit
+        return totalcount, lastpk
+
+    def getsnapshotpath(self):
+        snapshotdir = self.bulkapi.get('snapshotdir')
+        if (snapshotdir is None) or (self.snapshotattrs is None):
+            return None
+        return os.path.join(snapshotdir, '%s.cbor' % self.mylist)
+
+    def getcountuptohwm(self, slumapi):
+        # How many rows the DB holds up to our high-water mark.
+        # limit=0 means we only get the count back.
+        response = getattr(slumapi.cbor, self.mylist).get(
+                            field='pk__lte', v=self.hwm, offset=0, limit=0)
+        return response['count']
+
+    def getsnapshotstate(self):
+        return {attr: getattr(self, attr) for attr in self.snapshotattrs}
+
+    def loadsnapshotstate(self, state):
+        for attr in self.snapshotattrs:
+            setattr(self, attr, state[attr])
+
+    def savesnapshot(self, slumapi):
+        # Writes the cache contents out, along with the highest pk we've
+        # loaded in full and the DB count up to there so the next start
+        # can check nothing below it was added or removed by someone else.
+        path = self.getsnapshotpath()
+        if path is None:
+            return
+        try:
+            snapshot = {
+                'version': SNAPSHOTVERSION,
+                'url': self.bulkapi['url'],
+                'mylist': self.mylist,
+                'saved': time.time(),
+                'hwm': self.hwm,
+                'count': self.getcountuptohwm(slumapi),
+                'state': self.getsnapshotstate(),
+            }
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temppath = path + '.tmp'
+            with open(temppath, 'wb') as f:
+                cbor.dump(snapshot, f)
+            os.replace(temppath, path)      # Never leave a half written one
+            printdebug('CBORJoinCache:%s:savesnapshot: Saved to %s (hwm %d).'
+                       % (self.mylist, path, self.hwm))
+        except Exception as e:
+            printerror('CBORJoinCache:%s:savesnapshot: Failed.' % self.mylist)
+            printerror(str(e))
+
+    def loadsnapshot(self, slumapi, count):
+        # Loads the snapshot, then fetches rows added since it was saved.
+        # Returns False if there's no usable snapshot and a full
+        # refresh is needed.
+        # Rows changed in place by something other than this client
+        # can't be seen from here, so snapshotmaxage limits how long we
+        # trust one.
+        path = self.getsnapshotpath()
+        if (path is None) or (os.path.exists(path) is False):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                snapshot = cbor.load(f)
+        except Exception as e:
+            printerror('CBORJoinCache:%s:loadsnapshot: Unreadable snapshot.'
+                       % self.mylist)
+            printerror(str(e))
+            return False
+        if ((snapshot.get('version') != SNAPSHOTVERSION)
+                or (snapshot.get('url') != self.bulkapi['url'])
+                or (snapshot.get('mylist') != self.mylist)):
+            printdebug('CBORJoinCache:%s:loadsnapshot: Snapshot is stale.'
+                       % self.mylist)
+            return False
+        maxage = self.bulkapi.get('snapshotmaxage')
+        if (maxage is not None) and (time.time() - snapshot['saved'] > maxage):
+            printdebug('CBORJoinCache:%s:loadsnapshot: Snapshot is too old.'
+                       % self.mylist)
+            return False
+        self.hwm = snapshot['hwm']
+        if self.getcountuptohwm(slumapi) != snapshot['count']:
+            printdebug('CBORJoinCache:%s:loadsnapshot: DB changed below hwm.'
+                       % self.mylist)
+            self.hwm = 0
+            return False
+        self.clearcache()
+        self.loadsnapshotstate(snapshot['state'])
+        del snapshot
+        # The delta, anything added since
+        loaded, lastpk = self.loadpages(slumapi, count, after_pk=self.hwm)
+        self.hwm = lastpk
         self.cacheloaded = True
         self.partiallist = []   # Reset any partiallist
-        printdebug('Load complete. Loaded %d records.                ' % totalcount)
+        printdebug('Snapshot loaded. Fetched %d new records.           '
+                   % loaded)
+        if loaded > 0:
+            self.savesnapshot(slumapi)
+        return True
+
+    def streamrows(self, myiter, count=None):
+        # Loads a streamed dump. Rows are decoded as they arrive and
+        # handed to precreate/cacheloaditem in chunks, so only one chunk
+        # of the table is ever held here.
+        # Returns the number of rows loaded and the last pk seen.
+        totalcount = 0
+        lastpk = None
+        chunk = []
+        for odict in iterpackedrows(myiter):
+            lastpk = odict.get('id', odict.get('pk'))      # Rows in pk order
+            chunk.append(odict)
+            if len(chunk) >= self.streamchunk:
+                totalcount += len(chunk)
+                self.precreate(chunk)
+                for item in chunk:
+                    self.cacheloaditem(item)
+                chunk = []
+                if count is None:
+                    printdebug('Please wait. Loading. Loaded %d....'
+                               % totalcount, inplace=True)
+                else:
+                    printdebug('Please wait. Loading. Loaded %d of %d....' % (
+                            totalcount, count), inplace=True)
+        if len(chunk) > 0:
+            totalcount += len(chunk)
+            self.precreate(chunk)
+            for item in chunk:
+                self.cacheloaditem(item)
+        return totalcount, lastpk
+
+    def streamload(self, myresource, count):
+        # Full load from a streamed dump
+        totalcount, lastpk = self.streamrows(myresource.iterate(stream=1),
+                                             count)
+        if lastpk is not None:
+            self.hwm = lastpk
+        self.cacheloaded = True
+        self.partiallist = []   # Reset any partiallist
+        printdebug('Load complete. Streamed %d records.                ' % totalcount)
 
     def startbulkmode(self):
         # Start Bulk Upload processes
         if self.bulkmode is False:
             self.bulklist = {}  # Dict for different batch types
             self.bulkcount = {}
-            self.bulkqueue = JoinableQueue()
-            self.resultqueue = Queue()
-            self.bulkprocess = {}
-            # Create processes
-            for myid in range(0, self.bulkprocesses):
-                self.bulkprocess[myid] = CompositionBulkUpdateProcess(
-                                            self.bulkapi,
-                                            self.mylist,
-                                            self.bulkqueue,
-                                            self.resultqueue)
-                self.bulkprocess[myid].start()
+            # Shared with the other caches, bulkprocesses is now how many
+            # of our batches it will have in flight
+            self.uploader = edacdb_uploader.getuploader(self.bulkapi)
+            # Batch sizes start at bulklimit and follow the server's pace
+            self.sizer = self.uploader.getsizer(self.mylist, self.bulklimit)
+            self.pending = deque()
+            self.bulkresolved = True
+            self.bulkloaded = 0
+            self.bulkdeadletters = 0
             self.bulkmode = True
         else:
             printerror('CBOR Join Cache %s Bulkmode already enabled'
@@ -734,24 +730,36 @@ class CBORJoinCache(object):
         # Start Bulk Upload processes
         if self.bulkmode is True:
             for mode in self.bulklist:
-                mydict = {}
-                mydict['content'] = self.bulklist[mode]
-                mydict['jobtype'] = self.mylist
-                mydict['jobmode'] = mode
-                self.bulkqueue.put(mydict)
-            for myid in range(0, self.bulkprocesses):
-                self.bulkqueue.put(None)
-            self.bulkqueue.close()
+                self.queuejob(mode, self.bulklist[mode])
             printdebug('Cache: %s: Queuing complete. Waiting for DB commit.'
                        % self.mylist)
-            self.bulkqueue.join()
-            while self.resultqueue.empty() is not True:
-                garbage = self.resultqueue.get()
-            printdebug('Cache: %s: DB committed.' % self.mylist)
-            for myid in range(0, self.bulkprocesses):
-                self.bulkprocess[myid].join()
-            printdebug('Flushed Cache %s Bulk Update Process.' % self.mylist)
+            self.collectresults(wait=True)
+            printdebug('Cache: %s: DB committed. Loaded %d created rows.'
+                       % (self.mylist, self.bulkloaded))
+            if self.sizer.batches > 0:
+                printdebug('Cache: %s: Batch size now %s, %d changes.'
+                           % (self.mylist, self.sizer.describe(),
+                              self.sizer.changes))
+            if self.bulkdeadletters > 0:
+                printerror('Cache: %s: %d batches dead-lettered, replay with'
+                           ' edacdb_uploader.py --replay'
+                           % (self.mylist, self.bulkdeadletters))
             self.bulkmode = False
+            if self.bulkresolved is True:
+                # Creates came back with their pks and updates were
+                # applied as they were queued, nothing to reload.
+                printdebug('CBORJoinCache:%s:endbulkmode:Cache resolved, no refresh needed.' % self.mylist)
+                self.getitemstorefresh()    # Still passes on dependants
+                self.foreignpartials = []
+                self.partiallist = []
+                if self.partialfield is not None:
+                    bulkapi = self.bulkapi
+                    self.savesnapshot(slumber.API(bulkapi['url'],
+                                      format='cbor',
+                                      auth=(bulkapi['username'],
+                                      bulkapi['password']),
+                                      compression=bulkapi.get('compression')))
+                return
             # Now for the reloading...
             # Resolve any forign keyed partiallist requests into our partiallist
             # e.g.
@@ -787,6 +795,14 @@ class CBORJoinCache(object):
             else:
                 printdebug('CBORJoinCache:%s:endbulkmode:Going for a full refresh (partial not requested).' % self.mylist)
                 self.refresh()
+            if self.partialfield is not None:
+                # A full refresh saved already, doesn't hurt to save twice
+                bulkapi = self.bulkapi
+                self.savesnapshot(slumber.API(bulkapi['url'],
+                                  format='cbor',
+                                  auth=(bulkapi['username'],
+                                  bulkapi['password']),
+                                  compression=bulkapi.get('compression')))
         else:
             printerror('Composition Cache %s Bulkmode not running.'
                        % self.mylist)
@@ -808,11 +824,16 @@ class CBORJoinCache(object):
         self.bulkapi = bulkapi
         self.bulkmode = False
         self.bulklimit = 32000
+        self.streamrefresh = True       # Full refreshes use streamed dumps
+        self.streamchunk = 50000        # Rows per precreate when streaming
+        self.snapshotattrs = ['items']  # What savesnapshot writes out
+        self.hwm = 0                    # Highest pk loaded by a full refresh
         self.partialfield = None        # Used to add to partiallists
         self.partialfielddb = None      # If exists override for DB search
         self.partiallist = []
         self.foreignpartials = []
         self.dependants = []
+        self.cacheloaded = False
         self.clearcache()   # Without refresh this is required
         self.initadd()
         #self.refresh()     # Defer full loading by default
@@ -974,45 +995,47 @@ class StationJoinCache(CBORJoinCache):
                               if v is not None]
                     # Don't forget to remove the entries in the cache now!
                     self.items[station] = {}
+        if self.bulkmode is True:
+            # Send the whole new set, the server works out what to add and
+            # remove so only the difference is written
+            things = [thing for thing in indict[self.lookupf]
+                      if thing is not None]
+            self.items[station] = {}
+            self.addtobulkupdate({'station': station, 'items': things},
+                                 'replace')
+            dbfield = self.lookupf + '_id'
+            for thisthing in things:
+                self.cacheloaditem({'station_id': station, dbfield: thisthing})
+            return True
         # Delete the previous list if there is one
         for pk in pklist:
-            if self.bulkmode is True:
-                mydelparams = pk
-                self.addtobulkupdate(mydelparams, 'delete')
-            else:
-                try:
-                    self.client.action(
-                                    self.schema,
-                                    [self.mylist, 'destroy'],
-                                    params={'pk': pk})
-                except Exception as e:
-                    printerror('Exception in %s StationJoin FoA' % self.mylist)
-                    printerror(str(e))
-                    printerror(myparams)
-                    return None
+            try:
+                self.client.action(
+                                self.schema,
+                                [self.mylist, 'destroy'],
+                                params={'pk': pk})
+            except Exception as e:
+                printerror('Exception in %s StationJoin FoA' % self.mylist)
+                printerror(str(e))
+                printerror(myparams)
+                return None
         # Make the new one(s)
         for thisthing in indict[self.lookupf]:
             if thisthing is None:
                 continue   # No point putting THAT in DB so fall through
             dbfield = self.lookupf + '_id'   # Tell DB to use key directly
             myparams[dbfield] = thisthing
-            if self.bulkmode is True:
-                # For these we need to delete (as above) and create new
-                # So we always create
-                self.addtobulkupdate(myparams, 'create')
-                self.cacheloaditem(myparams)
-            else:
-                try:
-                    odict = self.client.action(
-                                    self.schema,
-                                    [self.mylist, 'create'],
-                                    params=myparams)
-                    self.cacheloaditem(odict)
-                except Exception as e:
-                    printerror('Exception in %s StationJoin FoA' % self.mylist)
-                    printerror(str(e))
-                    printerror(myparams)
-                    return None
+            try:
+                odict = self.client.action(
+                                self.schema,
+                                [self.mylist, 'create'],
+                                params=myparams)
+                self.cacheloaditem(odict)
+            except Exception as e:
+                printerror('Exception in %s StationJoin FoA' % self.mylist)
+                printerror(str(e))
+                printerror(myparams)
+                return None
         return True
 
     def precreate(self, mylist):
@@ -1062,7 +1085,8 @@ class StationJoinCache(CBORJoinCache):
     def initadd(self):
         # Can add init commands here.
         # Run just before refresh
-        self.bulkprocesses = 1      # Ensures DELETES are sent before POSTS
+        # Bulk changes are whole set replaces, no deletes to keep in order
+        self.bulkprocesses = 2
         # Setting a partial field will enable partial refresh after bulk
         self.partialfield = 'station'
         self.partialfielddb = 'station_id'
@@ -1219,26 +1243,37 @@ class HashedItemCache(CBORJoinCache):
         self.partialfield = 'eddbid'
         self.bulklimit = 8000
         self.dependants = []
+        self.snapshotattrs = ['eddb', 'eddbname', 'duphash']
         self.refresh()
 
 
 class SysIDCache2(HashedItemCache):
+    # Same lookups as HashedItemCache, but millions of rows (systems,
+    # bodies), so they're kept in the compact array based versions.
 
     def clearcache(self):
-        self.eddb = {}      # eddbid
-        self.edsm = {}
-        self.duphash = {}
+        self.eddb = CompactIndex()      # eddbid
+        self.edsm = CompactIndex()
+        self.duphash = CompactHashes()
         self.cacheloaded = False
 
+    def getsnapshotstate(self):
+        return {attr: getattr(self, attr).getstate()
+                for attr in self.snapshotattrs}
+
+    def loadsnapshotstate(self, state):
+        for attr in self.snapshotattrs:
+            getattr(self, attr).setstate(state[attr])
+
     def updateoradd(self, system):
         # system in good state
         # Check if system is known
         dbid = None
         if system['eddbid'] is not None:
-            if system['eddbid'] in self.eddb.keys():
+            if system['eddbid'] in self.eddb:
                 dbid = self.eddb[system['eddbid']]
             elif system['edsmid'] is not None:
-                if system['edsmid'] in self.edsm.keys():
+                if system['edsmid'] in self.edsm:
                     dbid = self.edsm[system['edsmid']]
         if dbid is None:
             self.addtobulkupdate(system, 'create')
@@ -1257,16 +1292,16 @@ class SysIDCache2(HashedItemCache):
                 return False
 
     def precreate(self, mylist):
-        eddbset = set([item['eddbid'] for item in mylist])
-        self.eddb.update(dict.fromkeys(eddbset))  # Find by eddb
-        edsmset = set([item['edsmid'] for item in mylist])
-        self.edsm.update(dict.fromkeys(edsmset))  # Find by edsm
+        # Size the indexes for the incoming chunk in one go,
+        # cacheloaditem fills them in.
+        self.eddb.reserve(len(self.eddb) + len(mylist))     # Find by eddb
+        self.edsm.reserve(len(self.edsm) + len(mylist))     # Find by edsm
         # Temp - workaround
         if 'pk' in mylist[0]:
-            duphashset = set([item['pk'] for item in mylist])
+            maxpk = max([item['pk'] for item in mylist])
         else:
-            duphashset = set([item['id'] for item in mylist])
-        self.duphash.update(dict.fromkeys(duphashset))   # Check if update required
+            maxpk = max([item['id'] for item in mylist])
+        self.duphash.reserve(maxpk)     # Check if update required
 
     def cacheloaditem(self, odict):
         # we must have a pk/id and a station
@@ -1294,6 +1329,7 @@ class SysIDCache2(HashedItemCache):
         # Setting a partial field will enable partial refresh after bulk
         self.partialfield = 'eddbid'
         self.bulklimit = 8000
+        self.snapshotattrs = ['eddb', 'edsm', 'duphash']
         self.refresh()
 
 
@@ -1301,16 +1337,9 @@ class MarketListingCache(CBORJoinCache):
 
     def duphash(self, data):
         # our own duphash version
-        # data is a list of dicts
-        hashdata = ''
-        for item in data:
-            for mykey in item:
-                hashdata += str(item[mykey])
-        hashdata = str(hashdata).encode('utf-8')
-        # print(data)
-        dig = hashlib.md5(hashdata).digest()  # b']A@*\xbcK*v\xb9q\x9d\x91\x...
-        b64 = base64.b64encode(dig)       # b'XUFAKrxLKna5cZ2REBfFkg=='
-        return b64.decode()[0:8]
+        # data is a list of dicts, hashed as a whole
+        return fingerprint.fingerprint(data,
+                                       self.bulkapi.get('fingerprintengine'))
 
     def checkhash(self, newdata):
         # newdata is a list of dicts
@@ -1324,7 +1353,7 @@ class MarketListingCache(CBORJoinCache):
         else:
             # Add the new duphash to the data
             for item in newdata:
-                item['dupash'] = newhash
+                item['duphash'] = newhash
             # And return a false because it doesn't match
             return False
 
@@ -1343,8 +1372,8 @@ class MarketListingCache(CBORJoinCache):
         # If it's not, we must assume it doesn't exist in the DB
         pklist = []
         station = inlist[0]['station']
-        if isstationincache(station) is True:
-            if checkhash(inlist) is True:
+        if self.isstationincache(station) is True:
+            if self.checkhash(inlist) is True:
                 # No update required because hash matches
                 return False
             else:
@@ -1354,26 +1383,8 @@ class MarketListingCache(CBORJoinCache):
                           if v is not None]
                 # Don't forget to remove the entries in the cache now!
                 self.items[station] = {}
-        # If necessary delete anything in the PK list
-        for pk in pklist:
-            if self.bulkmode is True:
-                mydelparams = pk
-                self.addtobulkupdate(mydelparams, 'delete')
-            else:
-                try:
-                    self.client.action(
-                                    self.schema,
-                                    [self.mylist, 'destroy'],
-                                    params={'pk': pk})
-                except Exception as e:
-                    printerror('Exception in %s MarketListing FoA'
-                               % self.mylist)
-                    printerror(str(e))
-                    printerror(myparams)
-                    return None
-        for commodity in inlist:
-            # sensiblise the data
-            myparams = {
+        # sensiblise the data
+        rows = [{
                 'station_id': station,   # Force here because of earlier assume
                 'commodity_id': commodity['commodity'],
                 'supply': commodity['supply'],
@@ -1381,24 +1392,41 @@ class MarketListingCache(CBORJoinCache):
                 'buy_price': commodity['buy_price'],
                 'sell_price': commodity['sell_price'],
                 'eddb_updated_at': commodity['eddb_updated_at'],
-                'duphash': commodity['duphash'],
-            }
-            if self.bulkmode is True:
-                self.addtobulkupdate(myparams, 'create')
+                'duphash': commodity.get('duphash'),
+            } for commodity in inlist]
+        if self.bulkmode is True:
+            # Whole set replace, the server only writes what changed
+            self.items[station] = {}
+            self.addtobulkupdate({'station': station, 'items': rows},
+                                 'replace')
+            for myparams in rows:
                 self.cacheloaditem(myparams)
-            else:
-                try:
-                    odict = self.client.action(
-                                    self.schema,
-                                    [self.mylist, 'create'],
-                                    params=myparams)
-                    self.cacheloaditem(odict)
-                except Exception as e:
-                    printerror('Exception in %s MarketListing FoA'
-                               % self.mylist)
-                    printerror(str(e))
-                    printerror(myparams)
-                    return None
+            return True
+        # If necessary delete anything in the PK list
+        for pk in pklist:
+            try:
+                self.client.action(
+                                self.schema,
+                                [self.mylist, 'destroy'],
+                                params={'pk': pk})
+            except Exception as e:
+                printerror('Exception in %s MarketListing FoA'
+                           % self.mylist)
+                printerror(str(e))
+                return None
+        for myparams in rows:
+            try:
+                odict = self.client.action(
+                                self.schema,
+                                [self.mylist, 'create'],
+                                params=myparams)
+                self.cacheloaditem(odict)
+            except Exception as e:
+                printerror('Exception in %s MarketListing FoA'
+                           % self.mylist)
+                printerror(str(e))
+                printerror(myparams)
+                return None
         return True
 
     def clearcache(self):
@@ -1459,52 +1487,44 @@ class MarketListingCache(CBORJoinCache):
         slumapi = slumber.API(bulkapi['url'],
                               format='cbor',
                               auth=(bulkapi['username'],
-                              bulkapi['password']))
-        response = getattr(slumapi.cbor, self.mylist).get(
-                            offset=0, limit=1)
-        count = response['count']       # Total number of records
-        printdebug('MarketlistCache:refreshhashes:dbcount:%d' % count)
+                              bulkapi['password']),
+                              compression=bulkapi.get('compression'))
+        count = None                    # The first page tells us
         totalcount = 0
         limit = 500000                  # These are small records, get lots
-        offset = 0                      # Start here
-        # rdict = self.getitemstorefresh()   # Need to do this always to populate
-                                           # dependants if necessary, but only
-                                           # used in partial refreshes
-        # mydict = {}
-        while (offset < count):
-            printdebug('Please wait. Loading. Loaded %d of %d....' % (
-                    offset, count), inplace=True)
+        after_pk = 0                    # Start here
+        while after_pk is not None:
+            if count is not None:
+                printdebug('Please wait. Loading. Loaded %d of %d....' % (
+                        totalcount, count), inplace=True)
             response = getattr(slumapi.cbor, self.mylist).get(
-                                offset=offset, limit=limit)
-            packedlist = response['results']
-            # Reconstruct the data
-            # [4, 'pk', 'edsmid', 'eddbid', 'duphash',
-            # (9397648, 60, 17, 'sENZY4K/'), ..etc..
-            mylist = []
-            if len(packedlist) > 0:
-                cols = packedlist.pop(0)
-                heads = [packedlist.pop(0) for i in range(0, cols)]
-                mylist = [{heads[il]:ol[il]
-                           for il in range(0, cols)}
-                          for ol in packedlist]
-                # Done - now I have a list of dicts
-            del packedlist      # free up the memory
+                                after_pk=after_pk, limit=limit)
+            if count is None:
+                count = response.get('count')
+                printdebug('MarketlistCache:refreshhashes:dbcount:%s' % count)
+            after_pk = response.get('last_pk')
+            hasmore = response.get('has_more')
+            mylist = unpackresults(response['results'])
+            del response        # free up the memory
+            if hasmore is False or len(mylist) < limit:
+                after_pk = None
             # Populate dict
             if len(mylist) > 0:
                 totalcount += len(mylist)
                 self.precreate(mylist)
                 for odict in mylist:
                     self.duphashdict[odict['station']] = odict['id']
-            offset += limit
 
     def initadd(self):
         # Can add init commands here.
         # Run just before refresh
-        self.bulkprocesses = 1      # Ensures DELETES are sent before POSTS
+        # Bulk changes are whole set replaces, no deletes to keep in order
+        self.bulkprocesses = 2
         # Setting a partial field will enable partial refresh after bulk
         self.partialfield = 'station'
         self.partialfielddb = 'station_id'
         self.lookupf = 'commodity'
+        self.snapshotattrs = None   # Only the hashes are loaded, no snapshot
         self.refreshhashes()
 
 
@@ -1762,9 +1782,15 @@ class KitItemCache(CBORJoinCache):
                 print(myparams)
             return lookupdict[item]['id']
 
+    def loadsnapshotstate(self, state):
+        # The other lookups share the dicts in ids, so rebuild them
+        for odict in state['ids'].values():
+            self.cacheloaditem(odict)
+
     def initadd(self):
         # Run just before refresh
         # Setting a partial field will enable partial refresh after bulk
+        self.snapshotattrs = ['ids']
         self.refresh()
 
 
@@ -1791,7 +1817,6 @@ class DBCache(object):
         self.volcanismtypes = ItemCache(client, schema, 'volcanismtypes')
         self.ringtypes = ItemCache(client, schema, 'ringtypes')
         self.rings = HashedItemCache(client, schema, bulkapi, 'rings')
-        #self.bodies = BodyCache(client, schema, bulkapi, 'bodies')
         self.bodies = SysIDCache2(client, schema, bulkapi, 'bodies')
         self.solidtypes = ItemCache(client, schema, 'solidtypes')
         self.materials = ItemCache(client, schema, 'materials')
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Shared bulk uploader for the caches in edacdb_cache.
+
+Rather than every cache forking its own bulk processes, each with its own
+slumber API and requests session, there's one uploader per bulk API. It's
+a thread pool sharing a single keep-alive session, so connections to the
+server are reused, and each target table has a bounded window of batches
+in flight. submit() blocks while a table's window is full, which is the
+backpressure, and hands back a Future for the job's reply.
+
+The uploads are almost all waiting on the server, so threads are plenty.
+
+A batch that fails on a 5xx (the server's DB was locked) or a dropped
+connection is retried with exponential backoff. If it still fails, or the
+server rejects it outright, it's written to the dead-letter spool rather
+than lost. Replay the spool with:
+
+    python edacdb_uploader.py --replay
+'''
+
+import os
+import sys
+import time
+import uuid
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cbor2 as cbor
+import requests
+from requests.adapters import HTTPAdapter
+import slumber
+from slumber.exceptions import HttpServerError
+
+DEBUG = True
+ERROR = True
+VERSION = '2.2 Beta'
+
+DEFAULTWORKERS = 8      # Uploads in flight across all tables
+DEFAULTWINDOW = 2       # Uploads in flight per table
+RETRIES = 6             # Attempts after the first before dead-lettering
+BATCHSECONDS = 2.0      # Commit time the batch sizes are tuned toward
+BATCHMAXBYTES = 16 * 1024 * 1024    # Whatever the rate, keep requests below
+BACKOFF = 0.5           # Seconds, doubled each retry
+BACKOFFMAX = 30
+
+# Where each job goes, (resource, method) by jobmode then jobtype.
+# 'replace' jobs all go to breplace/<jobtype>/
+JOBTARGETS = {
+    'create': {
+        'atmoscomposition': ('atmoscomposition', 'post'),
+        'materialcomposition': ('materialcomposition', 'post'),
+        'solidcomposition': ('solidcomposition', 'post'),
+        'rings': ('rings', 'post'),
+        'bodies': ('bodies', 'post'),
+        'stations': ('stations', 'post'),
+        'stationimports': ('stationimports', 'post'),
+        'stationexports': ('stationexports', 'post'),
+        'stationprohibited': ('stationprohibited', 'post'),
+        'stationeconomies': ('stationeconomies', 'post'),
+        'stationships': ('stationships', 'post'),
+        'stationmodules': ('bstationmodules', 'post'),
+        'systemids': ('bcreatesystems', 'post'),
+        'factions': ('factions', 'post'),
+    },
+    'update': {
+        'atmoscomposition': ('atmoscomposition', 'put'),
+        'materialcomposition': ('materialcomposition', 'put'),
+        'solidcomposition': ('solidcomposition', 'put'),
+        'rings': ('rings', 'put'),
+        'bodies': ('bodies', 'put'),
+        'stations': ('stations', 'put'),
+        'stationimports': ('stationimports', 'put'),
+        'stationexports': ('stationexports', 'put'),
+        'stationprohibited': ('stationprohibited', 'put'),
+        'stationeconomies': ('stationeconomies', 'put'),
+        'stationships': ('stationships', 'put'),
+        'stationmodules': ('bstationmodules', 'put'),
+        'systemids': ('bupdatesystems', 'post'),  # TODO bring this more into line
+    },
+    'delete': {
+        'stations': ('stations', 'delete'),
+        'stationimports': ('stationimports', 'delete'),
+        'stationexports': ('stationexports', 'delete'),
+        'stationprohibited': ('stationprohibited', 'delete'),
+        'stationeconomies': ('stationeconomies', 'delete'),
+        'stationships': ('stationships', 'delete'),
+        'stationmodules': ('stationmodules', 'delete'),
+    },
+}
+
+# Creates the server takes packed, [ncols, headers..., rows...]
+PACKEDJOBTYPES = ('systemids', )
+
+# Join tables with a bulk/breplace/ endpoint
+REPLACEJOBTYPES = ('stationimports', 'stationexports', 'stationprohibited',
+                   'stationeconomies', 'stationships', 'stationmodules',
+                   'marketlistings')
+
+
+def printdebug(mystring):
+    if DEBUG is True:
+        print("DEBUG edacdb_uploader: %s" % mystring)
+
+
+def printerror(mystring):
+    if ERROR is True:
+        print("ERROR edacdb_uploader: %s" % mystring)
+
+
+def requestbytes(myresource):
+    # Size of the body slumber last sent for this resource
+    resp = getattr(myresource, '_', None)
+    if (resp is None) or (resp.request.body is None):
+        return 0
+    return len(resp.request.body)
+
+
+def packrows(content):
+    # The reverse of edacdb_cache.unpackresults, a list of dicts with the
+    # same keys becomes [ncols, headers..., rows...] so the keys go once
+    # per batch rather than once per row. Returns None if the keys differ,
+    # a missing key isn't the same as None.
+    if len(content) == 0:
+        return None
+    headers = list(content[0])
+    keyset = set(headers)
+    if any(set(item) != keyset for item in content):
+        return None
+    return [len(headers)] + headers + [
+        [item[header] for header in headers] for item in content]
+
+
+def gettarget(slumapi, jobtype, jobmode):
+    # The slumber resource and method for a job
+    # 'replace' jobs all go to breplace/<jobtype>/
+    if jobmode == 'replace':
+        if jobtype not in REPLACEJOBTYPES:
+            raise ValueError('No replace target for %s' % jobtype)
+        return getattr(slumapi.breplace, jobtype), 'post'
+    target = JOBTARGETS.get(jobmode, {}).get(jobtype)
+    if target is None:
+        raise ValueError('No %s target for %s' % (jobmode, jobtype))
+    resource, method = target
+    return getattr(slumapi, resource), method
+
+
+def getpayload(jobtype, jobmode, content):
+    # What goes in the request body for a batch, None if nothing does
+    if jobmode == 'replace':
+        # content is a list of {'station': pk, 'items': [...]}
+        # sent as {station: [...]}, the server does the diff
+        if len(content) == 0:
+            return None
+        return {item['station']: item['items'] for item in content}
+    if jobmode == 'create' and jobtype in PACKEDJOBTYPES:
+        packed = packrows(content)
+        if packed is not None:
+            return packed
+    return content
+
+
+def countrows(jobmode, content):
+    # Rows in a batch, deletes can name the same pk twice
+    if jobmode == 'delete':
+        return len(set(content))
+    return len(content)
+
+
+def sendjob(slumapi, jobtype, jobmode, content):
+    # Sends one batch, returns whatever the server said and the number of
+    # bytes sent.
+    payload = getpayload(jobtype, jobmode, content)
+    if payload is None:
+        return None, 0
+    myresource, method = gettarget(slumapi, jobtype, jobmode)
+    return getattr(myresource, method)(payload), requestbytes(myresource)
+
+
+def checkreply(jobmode, rows, result):
+    # Turns the server's answer into the reply the caches expect,
+    # {'jobmode', 'result', 'complete'}. complete is False when the cache
+    # can't trust what it holds for this batch and should refresh.
+    if jobmode == 'create':
+        # Creates hand back the new rows packed, check they cover the batch
+        complete = (rows == 0) or (
+                    isinstance(result, dict)
+                    and (result.get('count', 0) >= rows))
+    elif jobmode == 'replace':
+        # Comes back with every row for those stations
+        complete = (rows == 0) or (
+                    isinstance(result, dict) and ('results' in result))
+    elif jobmode == 'update':
+        # Updates list any ids that weren't in the DB, the cache has
+        # already applied them so it must refresh
+        complete = not (isinstance(result, dict)
+                        and len(result.get('missing', [])) > 0)
+        if complete is not True:
+            printerror('%d updated rows were missing'
+                       % len(result['missing']))
+        result = None
+    elif jobmode == 'delete':
+        # The server reports how many went, check it's all
+        complete = True
+        if (isinstance(result, dict)
+                and (result.get('deleted', 0) < rows)):
+            printerror('Deleted %d of %d rows'
+                       % (result.get('deleted', 0), rows))
+            complete = False
+        result = None
+    else:
+        result = None
+        complete = True
+    return {'jobmode': jobmode, 'result': result, 'complete': complete}
+
+
+def runjob(slumapi, jobtype, jobmode, content):
+    result, nbytes = sendjob(slumapi, jobtype, jobmode, content)
+    reply = checkreply(jobmode, countrows(jobmode, content), result)
+    reply['bytes'] = nbytes
+    return reply
+
+
+def isretryable(exc):
+    # 5xx is the server giving up (mostly a locked SQLite DB), connection
+    # problems are worth another go too. 4xx means bad data, don't bother.
+    return isinstance(exc, (HttpServerError,
+                            requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout))
+
+
+def deadletter(bulkapi, jobtype, jobmode, content, error):
+    # Spools a failed batch so it can be replayed later.
+    # Returns the path written, or None if there's nowhere to write it.
+    spooldir = bulkapi.get('deadletterdir')
+    if spooldir is None:
+        printerror('No deadletterdir, %s %s batch of %d lost.'
+                   % (jobtype, jobmode, len(content)))
+        return None
+    os.makedirs(spooldir, exist_ok=True)
+    # Time first so a replay goes in the order they failed
+    path = os.path.join(spooldir, '%.6f-%s-%s-%s.cbor'
+                        % (time.time(), jobtype, jobmode, uuid.uuid4().hex))
+    temppath = path + '.tmp'
+    with open(temppath, 'wb') as f:
+        cbor.dump({
+            'jobtype': jobtype,
+            'jobmode': jobmode,
+            'content': content,
+            'error': str(error),
+            'saved': time.time(),
+        }, f)
+    os.replace(temppath, path)      # Never leave a half written one
+    printerror('%s %s batch of %d dead-lettered to %s'
+               % (jobtype, jobmode, len(content), path))
+    return path
+
+
+def deliverjob(slumapi, bulkapi, jobtype, jobmode, content, sizer=None):
+    # runjob with retries and backoff. Never raises, a batch that can't be
+    # delivered is dead-lettered and comes back incomplete so the cache
+    # refreshes.
+    # Timings go to the table's BatchSizer if it has one.
+    attempt = 0
+    while True:
+        try:
+            started = time.time()
+            reply = runjob(slumapi, jobtype, jobmode, content)
+            if sizer is not None:
+                sizer.record(len(content), time.time() - started,
+                             reply['bytes'])
+            return reply
+        except Exception as exc:
+            if (sizer is not None) and (attempt == 0):
+                sizer.backoff()     # Most likely too big for the DB lock
+            if isretryable(exc) and (attempt < RETRIES):
+                delay = min(BACKOFF * (2 ** attempt), BACKOFFMAX)
+                attempt += 1
+                printdebug('%s %s failed (%s), retry %d in %.1fs'
+                           % (jobtype, jobmode, exc, attempt, delay))
+                time.sleep(delay)
+                continue
+            printerror('%s %s failed: %s' % (jobtype, jobmode, exc))
+            reply = {'jobmode': jobmode, 'result': None, 'complete': False}
+            try:
+                reply['deadletter'] = deadletter(bulkapi, jobtype, jobmode,
+                                                 content, exc)
+            except Exception as spoolexc:
+                printerror('Could not dead-letter: %s' % spoolexc)
+            return reply
+
+
+class BatchSizer(object):
+    # Tunes one table's batch size toward a target commit time, from the
+    # rows per second and bytes per row its uploads have managed so far.
+    # Too big and the SQLite backed views sit in locked-DB retry loops,
+    # too small and it's all HTTP overhead.
+
+    def record(self, rows, seconds, nbytes):
+        if (rows == 0) or (seconds <= 0):
+            return
+        with self.lock:
+            self.batches += 1
+            self.seconds = self.smooth(self.seconds, seconds)
+            self.rowrate = self.smooth(self.rowrate, rows / seconds)
+            self.rowbytes = self.smooth(self.rowbytes, nbytes / rows)
+            target = self.rowrate * self.targetseconds
+            if self.rowbytes > 0:
+                target = min(target, self.maxbytes / self.rowbytes)
+            # No more than double or half in one go
+            target = max(self.size / 2, min(self.size * 2, target))
+            self.setsize(target)
+
+    def backoff(self):
+        # A batch failed, probably a locked DB, so halve
+        with self.lock:
+            self.setsize(self.size / 2)
+
+    def smooth(self, old, new):
+        if old is None:
+            return new
+        return old + (new - old) * self.alpha
+
+    def setsize(self, size):
+        size = int(max(self.minsize, min(self.maxsize, size)))
+        if size != self.size:
+            self.changes += 1
+        self.size = size
+
+    def describe(self):
+        if self.seconds is None:
+            return '%s:%d' % (self.jobtype, self.size)
+        return '%s:%d(%.1fs,%dB/row)' % (self.jobtype, self.size,
+                                         self.seconds, self.rowbytes or 0)
+
+    def __init__(self, jobtype, initial, targetseconds=None, maxbytes=None):
+        self.jobtype = jobtype
+        self.size = int(initial)
+        self.minsize = max(1, int(initial) // 64)
+        self.maxsize = int(initial) * 4
+        self.targetseconds = targetseconds or BATCHSECONDS
+        self.maxbytes = maxbytes or BATCHMAXBYTES
+        self.alpha = 0.3        # Smoothing, weight of the newest batch
+        self.seconds = None
+        self.rowrate = None
+        self.rowbytes = None
+        self.batches = 0
+        self.changes = 0
+        self.lock = threading.Lock()
+
+
+class BulkUploader(object):
+
+    def getsizer(self, jobtype, initial):
+        # One per table, shared by every cache bulk loading it
+        with self.lock:
+            if jobtype not in self.sizers:
+                self.sizers[jobtype] = BatchSizer(
+                                        jobtype, initial,
+                                        self.bulkapi.get('batchseconds'),
+                                        self.bulkapi.get('batchmaxbytes'))
+            return self.sizers[jobtype]
+
+    def describe(self):
+        # For the progress output, the tables that have uploaded something
+        return ' '.join([sizer.describe() for jobtype, sizer
+                         in sorted(self.sizers.items())
+                         if sizer.batches > 0])
+
+    def getwindow(self, jobtype, size=None):
+        # One semaphore per table, sized the first time it's asked for
+        with self.lock:
+            if jobtype not in self.windows:
+                if size is None:
+                    size = self.window
+                self.windows[jobtype] = threading.BoundedSemaphore(size)
+            return self.windows[jobtype]
+
+    def submit(self, jobtype, jobmode, content, window=None):
+        # Blocks while jobtype already has its window of uploads in flight
+        mywindow = self.getwindow(jobtype, window)
+        mywindow.acquire()
+        try:
+            future = self.executor.submit(deliverjob, self.slumapi,
+                                          self.bulkapi, jobtype, jobmode,
+                                          content,
+                                          self.sizers.get(jobtype))
+        except Exception:
+            mywindow.release()
+            raise
+        future.add_done_callback(lambda done: mywindow.release())
+        return future
+
+    def importmode(self, enabled):
+        # Asks the server to relax (or restore) its SQLite durability for a
+        # bulk load. It's only tuning, so a failure is reported and ignored.
+        try:
+            result = self.slumapi.importmode.post({'enabled': enabled})
+        except Exception as exc:
+            printerror('Could not set import mode: %s' % exc)
+            return None
+        printdebug('Import mode %s, %s holders.'
+                   % (result.get('importmode'), result.get('holders')))
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __init__(self, bulkapi, workers=None, window=None):
+        if workers is None:
+            workers = bulkapi.get('uploadworkers') or DEFAULTWORKERS
+        if window is None:
+            window = DEFAULTWINDOW
+        self.bulkapi = bulkapi
+        self.workers = workers
+        self.window = window
+        # One session, with a pool big enough for every worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.auth = (bulkapi['username'], bulkapi['password'])
+        self.slumapi = slumber.API(bulkapi['url'],
+                                   format='cbor',
+                                   session=self.session,
+                                   compression=bulkapi.get('compression'))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.windows = {}
+        self.sizers = {}
+        self.lock = threading.Lock()
+        printdebug('Bulk uploader for %s, %d workers.'
+                   % (bulkapi['url'], workers))
+
+
+uploaders = {}      # One per bulk API
+
+
+def getuploader(bulkapi):
+    key = (bulkapi['url'], bulkapi['username'])
+    if key not in uploaders:
+        uploaders[key] = BulkUploader(bulkapi)
+    return uploaders[key]
+
+
+def replay(bulkapi, spooldir=None):
+    # Re-sends every spooled batch, oldest first. Those that go through are
+    # removed, those that fail again are left (and re-spooled) for next time.
+    if spooldir is None:
+        spooldir = bulkapi.get('deadletterdir')
+    if (spooldir is None) or (os.path.isdir(spooldir) is False):
+        printdebug('Nothing to replay.')
+        return 0, 0
+    uploader = BulkUploader(bulkapi)
+    mybulkapi = dict(bulkapi)
+    mybulkapi['deadletterdir'] = None       # Don't spool the replays again
+    done = 0
+    failed = 0
+    for name in sorted(os.listdir(spooldir)):
+        if name.endswith('.cbor') is False:
+            continue
+        path = os.path.join(spooldir, name)
+        with open(path, 'rb') as f:
+            job = cbor.load(f)
+        reply = deliverjob(uploader.slumapi, mybulkapi, job['jobtype'],
+                           job['jobmode'], job['content'])
+        if 'deadletter' in reply:
+            failed += 1
+            printerror('Replay of %s failed, leaving it.' % name)
+        else:
+            done += 1
+            os.remove(path)
+            printdebug('Replayed %s' % name)
+    uploader.shutdown()
+    printdebug('Replayed %d batches, %d failed.' % (done, failed))
+    return done, failed
+
+
+if __name__ == '__main__':
+    import config
+    parser = argparse.ArgumentParser(description='EDAC bulk uploader.')
+    parser.add_argument('--replay', nargs='?', const='', default=None,
+                        metavar='DIR',
+                        help='Replay the dead-letter spool (or DIR).')
+    args = parser.parse_args()
+    if args.replay is None:
+        parser.print_help()
+        sys.exit(1)
+    bulkapi = {
+        'url': config.settings.edacapi('bulkapiurl'),
+        'username': config.settings.edacapi('apiusername'),
+        'password': config.settings.edacapi('apipassword'),
+        'deadletterdir': config.settings.edacapi('deadletterdir'),
+        'uploadworkers': config.settings.edacapi('uploadworkers'),
+    }
+    done, failed = replay(bulkapi, args.replay or None)
+    sys.exit(1 if failed > 0 else 0)
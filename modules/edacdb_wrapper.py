@@ -19,7 +19,6 @@ import time
 import base64
 import sys
 import gc
-import copy
 from multiprocessing import Process, Queue, JoinableQueue
 from coreapi.compat import b64encode
 from urllib import parse as parse
@@ -27,8 +26,12 @@ from urllib import parse as parse
 import math
 try:
     from modules.edacdb_cache import DBCache
+    from modules import fingerprint
+    from modules import edacdb_uploader
 except:
     from edacdb_cache import DBCache
+    import fingerprint
+    import edacdb_uploader
 import config
 
 # Just using django runserver at the moment
@@ -37,6 +40,14 @@ default_bulkapi = config.settings.edacapi('bulkapiurl')
 default_cborapi = config.settings.edacapi('cborapiurl')
 default_username = config.settings.edacapi('apiusername')
 default_password = config.settings.edacapi('apipassword')
+default_snapshotdir = config.settings.edacapi('snapshotdir')
+default_snapshotmaxage = config.settings.edacapi('snapshotmaxage')
+default_fingerprintengine = config.settings.edacapi('fingerprintengine')
+default_uploadworkers = config.settings.edacapi('uploadworkers')
+default_deadletterdir = config.settings.edacapi('deadletterdir')
+default_batchseconds = config.settings.edacapi('batchseconds')
+default_batchmaxbytes = config.settings.edacapi('batchmaxbytes')
+default_compression = config.settings.edacapi('compression')
 
 DEBUG = True
 ERROR = True
@@ -113,6 +124,23 @@ class SystemFilter(object):
 
 
 
+def systemfiltered(filteropt, system):
+    # Checks if we want this system
+    # We assume we don't
+    if filteropt.allobjects is True:
+        return False        # We want everything so get on with it
+    if filteropt.populated is True:
+        if system['is_populated'] is True:
+            return False
+    if filteropt.unpopulated is True:
+        if system['is_populated'] is True:
+            return False
+    if filteropt.aoi is True:
+        if filteropt.aoitest(system) is False:
+            return False
+    return True
+
+
 class EDACDB(object):
     # primary object
     def printaoistats(self):
@@ -124,21 +152,25 @@ class EDACDB(object):
 
 
     def startsystemidbulkmode(self):
+        self.importmode(True)
         self.cache.systemids.startbulkmode()
 
     def endsystemidbulkmode(self):
         self.cache.systemids.endbulkmode()
+        self.importmode(False)
+
+    def importmode(self, enabled):
+        # Server side SQLite durability is relaxed between start and end
+        # of each bulk mode, the calls must pair up.
+        return edacdb_uploader.getuploader(self.bulkapi).importmode(enabled)
+
+    def uploadstatus(self):
+        # Current bulk batch sizes, for the import progress lines
+        return edacdb_uploader.getuploader(self.bulkapi).describe()
 
     def duphash(self, data):
-        data = str(data).encode('utf-8')
-        #print(data)
-        dig = hashlib.md5(data).digest()  # b']A@*\xbcK*v\xb9q\x9d\x91\x10\x17\xc5\x92'
-        b64 = base64.b64encode(dig)       # b'XUFAKrxLKna5cZ2REBfFkg=='
-        return b64.decode()[0:8]          # JSON doesn't like bytes it seems
-                                          # XUFAKrxLKna5cZ2REBfFkg==
-        #return hashlib.md5(data).digest().encode("base64")
-        #return hashlib.md5(data).hexdigest()[0:15]
-        #b'iMjj8tMyETkJqEszZ-dZJQ=='
+        # data is the record (dict) itself, see fingerprint.py
+        return fingerprint.fingerprint(data, self.fingerprintengine)
 
     def create_fdevidmodule_in_db(self, moddict):
         # {'category': 'internal', 'edid': '128666704', 'class': '1',
@@ -203,13 +235,11 @@ class EDACDB(object):
                                  'name': commodity['category']['name']
                                  })
         commodity.pop('category_id')    # no longer required
-        hashdata = ""
-        for key in sorted(commodity.keys()):
-            hashdata += str(commodity[key])
-        commodity['duphash'] = self.duphash(hashdata)
+        commodity['duphash'] = self.duphash(commodity)
         result = self.cache.commodities.findoradd(commodity)
 
     def startstationbulkmode(self):
+        self.importmode(True)
         # The order matters
         self.cache.stations.startbulkmode()
         self.cache.stationimports.startbulkmode()
@@ -228,10 +258,12 @@ class EDACDB(object):
         self.cache.stationeconomies.endbulkmode()
         self.cache.stationships.endbulkmode()
         self.cache.stationmodules.endbulkmode()
+        self.importmode(False)
 
-    def create_eddb_station_in_db(self, istation):
-        station = copy.copy(istation)
+    def create_eddb_station_in_db(self, station):
         # Based on info from EDDB create or update a Station in DB
+        # station is changed in place and handed on to the cache, which
+        # keeps it, so don't reuse it after.
         #
         # Forign keys are system, faction, government, allegiance
         # state, stationtype
@@ -251,10 +283,7 @@ class EDACDB(object):
                                     'name': station.pop('type')
                                 })
         # Make a hash, including join data values
-        hashdata = ""
-        for key in sorted(station.keys()):
-            hashdata += str(station[key])
-        station['duphash'] = self.duphash(hashdata)
+        station['duphash'] = self.duphash(station)
         # Load the station (if required)
         newstationid = self.cache.stations.findoradd(station)
         if type(newstationid) is int:
@@ -262,7 +291,7 @@ class EDACDB(object):
         else:
             return True
 
-    def create_eddb_stationjoins_in_db(self, istation):
+    def create_eddb_stationjoins_in_db(self, station):
         # Based on info from EDDB create or update a Station in DB
         #
         # Forign keys are system, faction, government, allegiance
@@ -270,7 +299,6 @@ class EDACDB(object):
         # Make commodities                  # For new stations will require 2nd
                                             # run
         # Check for bulk station creation and cache readiness
-        station = copy.copy(istation)
         newstationid = self.cache.stations.getpkfromeddbid(station['eddbid'])
         # Pop any lists we need separated
         imports = station.pop('import_commodities')
@@ -346,6 +374,7 @@ class EDACDB(object):
         return changed
 
     def startbodybulkmode(self):
+        self.importmode(True)
         self.cache.bodies.startbulkmode()
         self.cache.atmoscomposition.startbulkmode()
         self.cache.solidcomposition.startbulkmode()
@@ -358,14 +387,16 @@ class EDACDB(object):
         self.cache.solidcomposition.endbulkmode()
         self.cache.materialcomposition.endbulkmode()
         self.cache.rings.endbulkmode()
+        self.importmode(False)
 
-    def create_eddb_body_in_db(self, ibody):
+    def create_eddb_body_in_db(self, body):
         # find or add will add to db if necessary and refresh
+        # body is changed in place and handed on to the cache, which
+        # keeps it, so don't reuse it after.
         # This replaces eddb lookups with our own
         # Simple bits first
         # Check if related system is in our DB
         # printdebug('Simple Lookups')
-        body = copy.copy(ibody)
         if self.cache.systemids.eddbidexists(body['system_id']) is False:
             # We will ASSUME we chose not to load this
             # printerror('EDDB System ID (%d) is unknown in EDDB bodies import.'
@@ -395,18 +426,7 @@ class EDACDB(object):
                                         })
         body.pop('volcanism_type_name')
         # Add body to DB if required:
-        hashdata = ""
-        for key in sorted(body.keys()):
-            if type(body[key]) is list:
-                for subitem in body[key]:
-                    if type(subitem) is dict:
-                        for subsubitem in sorted(subitem.keys()):
-                            hashdata += str(subitem[subsubitem])
-                    else:
-                        hashdata += str(body[key])
-            else:
-                hashdata += str(body[key])
-        body['duphash'] = self.duphash(hashdata)
+        body['duphash'] = self.duphash(body)    # Includes the lists
         atmoscomposition = body.pop('atmosphere_composition')
         solidcomposition = body.pop('solid_composition')
         materials = body.pop('materials')
@@ -418,8 +438,7 @@ class EDACDB(object):
             return True
         # print('Body ID: %d' % newitemid)
 
-    def create_eddb_bodyjoins_in_db(self, ibody):
-        body = copy.copy(ibody)
+    def create_eddb_bodyjoins_in_db(self, body):
         # Now we have a reference ID for the system we can update the
         # Composition tables
         # Skip these if newitemid is None
@@ -517,27 +536,11 @@ class EDACDB(object):
                     ring['eddb_created_at'] = ring.pop('created_at')
                     ring['eddb_updated_at'] = ring.pop('updated_at')
                     ring['related_body'] = newitemid
-                    hashdata = ""
-                    for key in sorted(ring.keys()):
-                        hashdata += str(ring[key])
-                    ring['duphash'] = self.duphash(hashdata)
+                    ring['duphash'] = self.duphash(ring)
                     result = self.cache.rings.findoradd(ring)
 
     def system_filter(self, system):
-        # Checks if we want this system
-        # We assume we don't
-        if self.filteropt.allobjects is True:
-            return False        # We want everything so get on with it
-        if self.filteropt.populated is True:
-            if system['is_populated'] is True:
-                return False
-        if self.filteropt.unpopulated is True:
-            if system['is_populated'] is True:
-                return False
-        if self.filteropt.aoi is True:
-            if self.filteropt.aoitest(system) is False:
-                return False
-        return True
+        return systemfiltered(self.filteropt, system)
 
     def create_system_in_db(self, system):
         # System is Dict
@@ -552,6 +555,13 @@ class EDACDB(object):
         if self.system_filter(system) is True:
             return False
         # print('System accepted for load: %s' % system['name'].encode('utf-8'))
+        # Hash before the lookups, so it can also be done in a worker
+        # process that doesn't have the caches (see eddb.Systems)
+        system['duphash'] = self.duphash(system)
+        return self.load_system_in_db(system)
+
+    def load_system_in_db(self, system):
+        # System has been filtered and hashed already
         # Do lookups
         # find or add will add to db if necessary and refresh
         system['security'] = self.cache.securitylevels.findoradd(system['security'])
@@ -563,11 +573,6 @@ class EDACDB(object):
         system['government'] = self.cache.governments.findoradd(system['government'])
         system['primary_economy'] = self.cache.economies.findoradd(system['primary_economy'])
         #print(system)
-        #
-        hashdata = ""
-        for key in sorted(system.keys()):
-            hashdata += str(system[key])
-        system['duphash'] = self.duphash(hashdata)
         #print(system['hash'])
         # return True if updated or added, else False
         return self.cache.systemids.updateoradd(system)
@@ -601,8 +606,17 @@ class EDACDB(object):
         self.bulkapi = {
             'url': bulkurl,
             'username': username,
-            'password': password
+            'password': password,
+            'snapshotdir': default_snapshotdir,     # None disables snapshots
+            'snapshotmaxage': default_snapshotmaxage,
+            'fingerprintengine': default_fingerprintengine,
+            'uploadworkers': default_uploadworkers,  # None for the default
+            'deadletterdir': default_deadletterdir,  # None loses failures
+            'batchseconds': default_batchseconds,
+            'batchmaxbytes': default_batchmaxbytes,
+            'compression': default_compression      # None, gzip or zstd
         }
+        self.fingerprintengine = default_fingerprintengine
         self.schema = self.client.get(self.dbapi)
         self.bulkschema = self.client.get(self.bulkapi['url'])
         self.filteropt = SystemFilter()
@@ -9,11 +9,19 @@ import json
 import ijson
 import time
 import gc
+import os
+import argparse
+import tempfile
+import cbor2 as cbor
+from collections import deque
+from multiprocessing import get_context
 from os.path import isfile
 try:
-    from modules.edacdb_wrapper import EDACDB
+    from modules.edacdb_wrapper import EDACDB, systemfiltered
+    from modules import fingerprint
 except:
-    from edacdb_wrapper import EDACDB
+    from edacdb_wrapper import EDACDB, systemfiltered
+    import fingerprint
 import config
 
 
@@ -91,6 +99,88 @@ def import_listings(filepath=listingsfile):
     "reserve_type": null
 '''
 
+def reshapesystem(item):
+    # Tidy up fields to match DB
+    item['eddbid'] = item.pop('id')
+    item['eddbdate'] = item.pop('updated_at')
+    item['coord_x'] = item.pop('x')
+    item['coord_y'] = item.pop('y')
+    item['coord_z'] = item.pop('z')
+    item['edsmid'] = item.pop('edsm_id')
+    if item['reserve_type'] is None:
+        item['reserve_type']  = ''
+    if item['simbad_ref'] is None:
+        item['simbad_ref'] = ''
+    # Gobble state_id as we already lookup on state
+    item.pop('state_id')
+    return item
+
+
+def systemsshard(task):
+    # Runs in a worker process. Parses the lines that start inside the
+    # byte range [start, end), reshapes, filters and hashes them, and
+    # hands back the systems worth looking at. No caches here, those are
+    # owned by the coordinator.
+    filepath, start, end, filteropt, engine = task
+    timestart = time.time()
+    aoistart = (filteropt.aoistatx, filteropt.aoistaty, filteropt.aoistatz,
+                filteropt.aoistatr, filteropt.aoistatn)
+    read = 0
+    systems = []
+    with open(filepath, 'rb') as myfile:
+        if start > 0:
+            # Skip the line that started in the previous shard, unless
+            # start is exactly at the beginning of a line.
+            myfile.seek(start - 1)
+            myfile.readline()
+        while myfile.tell() < end:
+            line = myfile.readline()
+            if not line:
+                break
+            read += 1
+            item = reshapesystem(json.loads(line.decode('utf-8')))
+            if systemfiltered(filteropt, item) is True:
+                continue
+            systems.append(item)
+    hashes = fingerprint.fingerprintmany(systems, engine)
+    for system, duphash in zip(systems, hashes):
+        system['duphash'] = duphash
+    return {
+        'read': read,
+        'systems': systems,
+        'seconds': time.time() - timestart,
+        'aoistats': (filteropt.aoistatx - aoistart[0],
+                     filteropt.aoistaty - aoistart[1],
+                     filteropt.aoistatz - aoistart[2],
+                     filteropt.aoistatr - aoistart[3],
+                     filteropt.aoistatn - aoistart[4]),
+    }
+
+
+class JoinSpool(object):
+    # Holds the join payloads of changed records until the parent rows
+    # have been flushed and have pks. Spooled to a temp file as CBOR so
+    # the bodies import doesn't have to keep them all in memory, and read
+    # back in the order they were added.
+
+    def __init__(self):
+        self.spoolfile = tempfile.TemporaryFile()
+        self.count = 0
+
+    def add(self, item):
+        cbor.dump(item, self.spoolfile)
+        self.count += 1
+
+    def __iter__(self):
+        self.spoolfile.seek(0)
+        decoder = cbor.CBORDecoder(self.spoolfile)
+        for i in range(0, self.count):
+            yield decoder.decode()
+
+    def close(self):
+        self.spoolfile.close()
+
+
 class Systems(object):
 
     ''' The systems JSON looks like this
@@ -145,10 +235,79 @@ class Systems(object):
             return myobj
 
 
-    def __init__(self, dbapi, filepath=systemsfile):
+    shardbytes = 8 * 1024 * 1024        # Size of each chunk of file per task
+
+    def loadparallel(self, filepath):
+        # Worker processes parse, reshape, filter and hash shards of the
+        # file (systemsshard). This process does the cache lookups and
+        # feeds the bulk queue, exactly as the single process path does.
+        # Only a couple of shards per worker are in flight at once so
+        # memory stays bounded, and shards are loaded in file order.
+        # Workers are spawned, not forked, the uploader's threads are
+        # already running and a fork could copy one of their locks held.
+        filesize = os.path.getsize(filepath)
+        engine = self.dbapi.fingerprintengine
+        tasks = [(filepath, start, min(start + self.shardbytes, filesize),
+                  self.dbapi.filteropt, engine)
+                 for start in range(0, filesize, self.shardbytes)]
+        printdebug('Loading %s in %d shards with %d workers.'
+                   % (filepath, len(tasks), self.workers))
+        self.shardstart = time.time()
+        self.workerseconds = 0.0
+        self.loadseconds = 0.0
+        self.accepted = 0
+        pending = deque()
+        with get_context('spawn').Pool(self.workers) as pool:
+            for task in tasks:
+                pending.append(pool.apply_async(systemsshard, (task,)))
+                if len(pending) >= self.workers * 2:
+                    self.loadshard(pending.popleft().get())
+            while len(pending) > 0:
+                self.loadshard(pending.popleft().get())
+        seconds = time.time() - self.shardstart
+        # Per stage rates. Worker time is summed over all workers, so
+        # parse/s is per worker, overall/s is what the pool achieved.
+        printdebug('Parse, filter and hash: %d systems, %d/s per worker, '
+                   '%d/s overall.' % (self.systems_count,
+                   self.systems_count / max(self.workerseconds, 0.001),
+                   self.systems_count / max(seconds, 0.001)))
+        printdebug('Lookup and queue: %d systems passed the filter, '
+                   '%d/s (%.1fs).'
+                   % (self.accepted,
+                      self.accepted / max(self.loadseconds, 0.001),
+                      self.loadseconds))
+        printdebug('Total: %d systems in %.1fs, %d/s.'
+                   % (self.systems_count, seconds,
+                      self.systems_count / max(seconds, 0.001)))
+
+    def loadshard(self, result):
+        # Coordinator side of loadparallel, one shard's worth of systems
+        self.systems_count += result['read']
+        self.accepted += len(result['systems'])
+        self.workerseconds += result['seconds']
+        filteropt = self.dbapi.filteropt
+        filteropt.aoistatx += result['aoistats'][0]
+        filteropt.aoistaty += result['aoistats'][1]
+        filteropt.aoistatz += result['aoistats'][2]
+        filteropt.aoistatr += result['aoistats'][3]
+        filteropt.aoistatn += result['aoistats'][4]
+        loadstart = time.time()
+        for system in result['systems']:
+            if self.dbapi.load_system_in_db(system) is True:
+                self.systems_changed += 1
+        self.loadseconds += time.time() - loadstart
+        seconds = time.time() - self.shardstart
+        print('Read %d systems (%d/s), changed %d(%d/s) %s          \r' % (
+                self.systems_count, self.systems_count / seconds,
+                self.systems_changed, self.systems_changed / seconds,
+                self.dbapi.uploadstatus()),
+                end='')
+
+    def __init__(self, dbapi, filepath=systemsfile, workers=1):
         if type(dbapi) is not EDACDB:
             printerror('dbapi must be of type EDACDB()')
             return False
+        self.workers = workers          # More than 1 uses loadparallel
         self.systems = {}
         self.systems_count = 0
         self.systems_changed = 0
@@ -219,35 +378,26 @@ class Systems(object):
             self.timestart = time.clock()
             self.dbapi.startsystemidbulkmode()
             if True:
-                with open(filepath, 'r', encoding='utf-8') as myfile:
-                    for line in myfile:
-                        item = json.loads(line)
-                        self.systems_count += 1
-                        # Tidy up fields to match DB
-                        item['eddbid'] = item.pop('id')
-                        item['eddbdate'] = item.pop('updated_at')
-                        item['coord_x'] = item.pop('x')
-                        item['coord_y'] = item.pop('y')
-                        item['coord_z'] = item.pop('z')
-                        item['edsmid'] = item.pop('edsm_id')
-                        if item['reserve_type'] is None:
-                            item['reserve_type']  = ''
-                        if item['simbad_ref'] is None:
-                            item['simbad_ref'] = ''
-                        # Gobble state_id as we already lookup on state
-                        item.pop('state_id')
-                        if self.dbapi.create_system_in_db(item) is True:
-                            self.systems_changed += 1
-                        if self.systems_count % 10000 == 0:
-                            seconds = int(time.clock() - self.timestart)
-                            srate = (self.systems_count + 1) / (seconds + 1)
-                            crate = (self.systems_changed + 1) / (seconds + 1)
-                            print('Read %d systems (%d/s), changed %d(%d/s)              \r' % (
-                                    self.systems_count, srate,
-                                    self.systems_changed, crate),
-                                    end='')
-                    myfile.close
-                    # bulkself.dbapi.create_system_bulk_flush()
+                if self.workers > 1:
+                    self.loadparallel(filepath)
+                else:
+                    with open(filepath, 'r', encoding='utf-8') as myfile:
+                        for line in myfile:
+                            item = reshapesystem(json.loads(line))
+                            self.systems_count += 1
+                            if self.dbapi.create_system_in_db(item) is True:
+                                self.systems_changed += 1
+                            if self.systems_count % 10000 == 0:
+                                seconds = int(time.clock() - self.timestart)
+                                srate = (self.systems_count + 1) / (seconds + 1)
+                                crate = (self.systems_changed + 1) / (seconds + 1)
+                                print('Read %d systems (%d/s), changed %d(%d/s) %s          \r' % (
+                                        self.systems_count, srate,
+                                        self.systems_changed, crate,
+                                        self.dbapi.uploadstatus()),
+                                        end='')
+                        myfile.close
+                        # bulkself.dbapi.create_system_bulk_flush()
                 seconds = int(time.clock() - self.timestart)
                 srate = (self.systems_count + 1) / (seconds + 1)
                 crate = (self.systems_changed + 1) / (seconds + 1)
@@ -290,67 +440,78 @@ class Bodies(object):
             printdebug('%s found. Starting to load EDDB Bodies data.' % filepath)
             self.timestart = time.clock()
             if True:    # Eventually this will be a try
-                self.changedbodyid = set([])
-                for x in range(0, 2):    # Two passes to enable bulk methods
-                    with open(filepath, 'r', encoding='utf-8') as myfile:
-                        self.dbapi.startbodybulkmode()
-                        for line in myfile:
-                            item = json.loads(line)
-                            self.bodies_count += 1
-                            # Tidy up fields to match DB
-                            # print(item)
-                            item['eddbid'] = item.pop('id')
-                            if x == 0:
-                                item['eddb_created_at'] = item.pop('created_at')
-                                item['eddb_updated_at'] = item.pop('updated_at')
-                                # These are Ints for me
-                                if item['catalogue_hd_id'] == '':
-                                    item['catalogue_hd_id'] = None
-                                elif type(item['catalogue_hd_id']) is str:
-                                    item['catalogue_hd_id'] = int(item['catalogue_hd_id'].replace(',', '').replace('.', ''))
-                                #
-                                if item['catalogue_hipp_id'] == '':
-                                    item['catalogue_hipp_id'] = None
-                                elif type(item['catalogue_hipp_id']) is str:
-                                    item['catalogue_hipp_id'] = int(item['catalogue_hipp_id'].replace(',', '').replace('.', ''))
-                                # str cannot be Null in DB
-                                if item['catalogue_gliese_id'] is None:
-                                    item['catalogue_gliese_id'] = ''
-                                # str cannot be Null in DB
-                                if item['luminosity_sub_class'] is None:
-                                    item['luminosity_sub_class'] = ''
-                                # str cannot be Null in DB
-                                if item['full_spectral_class'] is None:
-                                    item['full_spectral_class'] = ''
-                                # str cannot be Null in DB
-                                if item['luminosity_class'] is None:
-                                    item['luminosity_class'] = ''
-                                # str cannot be Null in DB
-                                if item['spectral_class'] is None:
-                                    item['spectral_class'] = ''
-                                #
-                                if self.dbapi.create_eddb_body_in_db(item) is True:
-                                    self.bodies_changed += 1
-                                    self.changedbodyid.add(item['eddbid'])
-                            elif x == 1:
-                                if self.bodies_changed == 0:
-                                    continue
-                                # Second pass update changed or
-                                # added station joins
-                                if item['eddbid'] in self.changedbodyid:
-                                    if self.dbapi.create_eddb_bodyjoins_in_db(item) is True:
-                                        self.stations_changed += 1
-                            if self.bodies_changed % 100 == 0:
-                                seconds = int(time.clock() - self.timestart)
-                                srate = (self.bodies_count + 1) / (seconds + 1)
-                                crate = (self.bodies_changed + 1) / (seconds + 1)
-                                print('Read %d bodies (%d/s), changed %d(%d/s)              \r' % (
-                                        self.bodies_count, srate,
-                                        self.bodies_changed, crate),
-                                        end='')
-                        myfile.close
-                        #self.dbapi.create_system_bulk_flush()
-                        self.dbapi.endbodybulkmode()
+                # One parse of the file. Changed bodies' composition and
+                # ring lists are spooled until the bodies have been
+                # flushed and we know their pks.
+                joinspool = JoinSpool()
+                with open(filepath, 'r', encoding='utf-8') as myfile:
+                    self.dbapi.startbodybulkmode()
+                    for line in myfile:
+                        item = json.loads(line)
+                        self.bodies_count += 1
+                        # Tidy up fields to match DB
+                        # print(item)
+                        item['eddbid'] = item.pop('id')
+                        item['eddb_created_at'] = item.pop('created_at')
+                        item['eddb_updated_at'] = item.pop('updated_at')
+                        # These are Ints for me
+                        if item['catalogue_hd_id'] == '':
+                            item['catalogue_hd_id'] = None
+                        elif type(item['catalogue_hd_id']) is str:
+                            item['catalogue_hd_id'] = int(item['catalogue_hd_id'].replace(',', '').replace('.', ''))
+                        #
+                        if item['catalogue_hipp_id'] == '':
+                            item['catalogue_hipp_id'] = None
+                        elif type(item['catalogue_hipp_id']) is str:
+                            item['catalogue_hipp_id'] = int(item['catalogue_hipp_id'].replace(',', '').replace('.', ''))
+                        # str cannot be Null in DB
+                        if item['catalogue_gliese_id'] is None:
+                            item['catalogue_gliese_id'] = ''
+                        # str cannot be Null in DB
+                        if item['luminosity_sub_class'] is None:
+                            item['luminosity_sub_class'] = ''
+                        # str cannot be Null in DB
+                        if item['full_spectral_class'] is None:
+                            item['full_spectral_class'] = ''
+                        # str cannot be Null in DB
+                        if item['luminosity_class'] is None:
+                            item['luminosity_class'] = ''
+                        # str cannot be Null in DB
+                        if item['spectral_class'] is None:
+                            item['spectral_class'] = ''
+                        #
+                        # The body goes to the cache as it is, so pick
+                        # out the joins first
+                        joins = {
+                            'eddbid': item['eddbid'],
+                            'atmosphere_composition': item['atmosphere_composition'],
+                            'solid_composition': item['solid_composition'],
+                            'materials': item['materials'],
+                            'rings': item['rings'],
+                        }
+                        if self.dbapi.create_eddb_body_in_db(item) is True:
+                            self.bodies_changed += 1
+                            joinspool.add(joins)
+                        if self.bodies_changed % 100 == 0:
+                            seconds = int(time.clock() - self.timestart)
+                            srate = (self.bodies_count + 1) / (seconds + 1)
+                            crate = (self.bodies_changed + 1) / (seconds + 1)
+                            print('Read %d bodies (%d/s), changed %d(%d/s) %s          \r' % (
+                                    self.bodies_count, srate,
+                                    self.bodies_changed, crate,
+                                    self.dbapi.uploadstatus()),
+                                    end='')
+                    myfile.close
+                    self.dbapi.endbodybulkmode()
+                # Bodies are in, now update changed or added body joins
+                if joinspool.count > 0:
+                    printdebug('Loading joins for %d changed bodies.'
+                               % joinspool.count)
+                    self.dbapi.startbodybulkmode()
+                    for item in joinspool:
+                        self.dbapi.create_eddb_bodyjoins_in_db(item)
+                    self.dbapi.endbodybulkmode()
+                joinspool.close()
                 seconds = int(time.clock() - self.timestart)
                 srate = (self.bodies_count + 1) / (seconds + 1)
                 crate = (self.bodies_changed + 1) / (seconds + 1)
@@ -443,51 +604,64 @@ class Stations(object):
                        % filepath)
             self.timestart = time.clock()
             if True:    # Eventually this will be a try
-                self.changedsysid = set([])
-                for x in range(0, 2):    # Two passes to enable bulk methods
-                    with open(filepath, 'r', encoding='utf-8') as myfile:
-                        self.dbapi.startstationbulkmode()
-                        for line in myfile:
-                            item = json.loads(line)
-                            self.stations_count += 1
-                            # Tidy up fields to match DB
-                            # print(item)
-                            item['eddbid'] = item.pop('id')
-                            if x == 0:
-                                # First pass check for changes,
-                                # add/update stations
-                                item['eddb_updated_at'] = item.pop('updated_at')
-                                item['eddb_shipyard_updated_at'] = item.pop('shipyard_updated_at')
-                                item['eddb_outfitting_updated_at'] = item.pop('outfitting_updated_at')
-                                item['eddb_market_updated_at'] = item.pop('market_updated_at')
-                                if item['max_landing_pad_size'] == 'None':
-                                    item['max_landing_pad_size'] = '0'
-                                elif item['max_landing_pad_size'] == None:
-                                    item['max_landing_pad_size'] = ''
-                                # item['eddbname'] = item.pop('name')
-                                #
-                                if self.dbapi.create_eddb_station_in_db(item) is True:
-                                    self.stations_changed += 1
-                                    self.changedsysid.add(item['eddbid'])
-                            elif x == 1:
-                                if self.stations_changed == 0:
-                                    continue
-                                # Second pass update changed or
-                                # added station joins
-                                if item['eddbid'] in self.changedsysid:
-                                    if self.dbapi.create_eddb_stationjoins_in_db(item) is True:
-                                        self.stations_changed += 1
-                            if self.stations_count % 100 == 0:
-                                seconds = int(time.clock() - self.timestart)
-                                srate = (self.stations_count + 1) / (seconds + 1)
-                                crate = (self.stations_changed + 1) / (seconds + 1)
-                                print('Read %d stations (%d/s), changed %d(%d/s)              \r' % (
-                                        self.stations_count, srate,
-                                        self.stations_changed, crate),
-                                        end='')
-                        myfile.close
-                        #self.dbapi.create_system_bulk_flush()
-                        self.dbapi.endstationbulkmode()
+                # One parse of the file. Changed stations' join lists are
+                # spooled until the stations have been flushed and we know
+                # their pks.
+                joinspool = JoinSpool()
+                with open(filepath, 'r', encoding='utf-8') as myfile:
+                    self.dbapi.startstationbulkmode()
+                    for line in myfile:
+                        item = json.loads(line)
+                        self.stations_count += 1
+                        # Tidy up fields to match DB
+                        # print(item)
+                        item['eddbid'] = item.pop('id')
+                        # Check for changes, add/update stations
+                        item['eddb_updated_at'] = item.pop('updated_at')
+                        item['eddb_shipyard_updated_at'] = item.pop('shipyard_updated_at')
+                        item['eddb_outfitting_updated_at'] = item.pop('outfitting_updated_at')
+                        item['eddb_market_updated_at'] = item.pop('market_updated_at')
+                        if item['max_landing_pad_size'] == 'None':
+                            item['max_landing_pad_size'] = '0'
+                        elif item['max_landing_pad_size'] == None:
+                            item['max_landing_pad_size'] = ''
+                        # item['eddbname'] = item.pop('name')
+                        #
+                        # The station goes to the cache as it is, so pick
+                        # out the joins first
+                        joins = {
+                            'eddbid': item['eddbid'],
+                            'import_commodities': item['import_commodities'],
+                            'export_commodities': item['export_commodities'],
+                            'prohibited_commodities': item['prohibited_commodities'],
+                            'economies': item['economies'],
+                            'selling_ships': item['selling_ships'],
+                            'selling_modules': item['selling_modules'],
+                        }
+                        if self.dbapi.create_eddb_station_in_db(item) is True:
+                            self.stations_changed += 1
+                            joinspool.add(joins)
+                        if self.stations_count % 100 == 0:
+                            seconds = int(time.clock() - self.timestart)
+                            srate = (self.stations_count + 1) / (seconds + 1)
+                            crate = (self.stations_changed + 1) / (seconds + 1)
+                            print('Read %d stations (%d/s), changed %d(%d/s) %s          \r' % (
+                                    self.stations_count, srate,
+                                    self.stations_changed, crate,
+                                    self.dbapi.uploadstatus()),
+                                    end='')
+                    myfile.close
+                    self.dbapi.endstationbulkmode()
+                # Stations are in, now update changed or added station joins
+                if joinspool.count > 0:
+                    printdebug('Loading joins for %d changed stations.'
+                               % joinspool.count)
+                    self.dbapi.startstationbulkmode()
+                    for item in joinspool:
+                        if self.dbapi.create_eddb_stationjoins_in_db(item) is True:
+                            self.stations_changed += 1
+                    self.dbapi.endstationbulkmode()
+                joinspool.close()
                 seconds = int(time.clock() - self.timestart)
                 srate = (self.stations_count + 1) / (seconds + 1)
                 crate = (self.stations_changed + 1) / (seconds + 1)
@@ -510,11 +684,15 @@ class Stations(object):
 if __name__ == '__main__':
     #import_listings()
     #print('Listings count is: %d' % listings_count)
+    parser = argparse.ArgumentParser(description='Load the EDDB dumps.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes used to parse systems.jsonl')
+    args = parser.parse_args()
     starttime = time.gmtime()
     print(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()))
     dbapi = EDACDB()
     # mydevids = FDevIDs(dbapi) this won't work yet
-    mysystems = Systems(dbapi)
+    mysystems = Systems(dbapi, workers=args.workers)
     mybodies = Bodies(dbapi)
     mycommodities = Commodities(dbapi)
     mystations = Stations(dbapi)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Record fingerprints, these are the duphash values stored against systems,
+bodies, stations, rings, commodities and market listings.
+
+A record (dict, list or a plain value) is encoded as canonical CBOR, so key
+order doesn't matter and nested lists/dicts are covered, then hashed down
+to a signed 64 bit int that fits a BigIntegerField.
+
+blake2b is in the standard library so it's the default. xxhash is faster
+but optional, if you switch engine every stored record will look changed
+(and be updated) once.
+'''
+
+import hashlib
+import cbor2 as cbor
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+VERSION = '2.2 Beta'
+
+DEFAULTENGINE = 'blake2b'
+
+
+def blake2b64(data):
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+def xxhash64(data):
+    return xxhash.xxh64(data).digest()
+
+
+ENGINES = {
+    'blake2b': blake2b64,
+}
+if xxhash is not None:
+    ENGINES['xxhash'] = xxhash64
+
+
+def getengine(engine=None):
+    if engine is None:
+        engine = DEFAULTENGINE
+    if engine not in ENGINES:
+        raise ValueError('Unknown fingerprint engine %s, have %s'
+                         % (engine, sorted(ENGINES.keys())))
+    return ENGINES[engine]
+
+
+def canonical(record):
+    return cbor.dumps(record, canonical=True)
+
+
+def fingerprint(record, engine=None):
+    digest = getengine(engine)(canonical(record))
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def fingerprintmany(records, engine=None):
+    # Batch version, the lookups are done once rather than per record
+    hashfunc = getengine(engine)
+    dumps = cbor.dumps
+    frombytes = int.from_bytes
+    return [frombytes(hashfunc(dumps(record, canonical=True)),
+                      'big', signed=True)
+            for record in records]
@@ -5,7 +5,9 @@ try:
 except ImportError:
     from urlparse import urlparse, urlsplit, urlunsplit
 
+from . import compress
 from . import exceptions
+from . import stream
 from .serialize import Serializer
 from .utils import url_join, iterator, copy_kwargs
 
@@ -86,7 +88,16 @@ class Resource(ResourceAttributesMixin, object):
 
         return self._get_resource(**kwargs)
 
-    def _request(self, method, data=None, files=None, params=None):
+    def _is_raw(self, data):
+        """
+        Bodies that are already encoded go as they are: bytes, a memoryview
+        or an iterator of byte chunks (sent chunked, never held whole).
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return True
+        return hasattr(data, "__next__")
+
+    def _request(self, method, data=None, files=None, params=None, content_type=None, stream=False):
         serializer = self._store["serializer"]
         format = self._store['format']
         url = self.url()
@@ -95,12 +106,32 @@ class Resource(ResourceAttributesMixin, object):
         headers = {"accept": serializer.get_content_type(format)}
         #print('_request Slumber headers are: %s' % headers)
 
+        encoding = self._store.get("compression")
+        if encoding is not None:
+            headers["accept-encoding"] = compress.accept_encoding(encoding)
+
         if not files:
-            headers["content-type"] = serializer.get_content_type(format)
-            if data is not None:
+            headers["content-type"] = content_type or serializer.get_content_type(format)
+            if isinstance(data, memoryview):
+                data = data.cast("B")   # So its len() is in bytes
+            elif data is not None and not self._is_raw(data):
                 data = serializer.dumps(data)
-
-        resp = self._store["session"].request(method, url, data=data, params=params, files=files, headers=headers)
+            # Only once the server has said it takes it
+            if (encoding is not None
+                    and isinstance(data, (bytes, bytearray, memoryview))
+                    and len(data) >= compress.MINSIZE
+                    and encoding in self._store["server_encodings"]):
+                data = compress.compress(bytes(data), encoding, self._store.get("compression_level"))
+                headers["content-encoding"] = encoding
+
+        resp = self._store["session"].request(method, url, data=data, params=params, files=files, headers=headers, stream=stream)
+
+        if encoding is not None:
+            accepted = compress.server_accepts(resp)
+            if accepted is not None:
+                # Shared by every resource of this API
+                self._store["server_encodings"].clear()
+                self._store["server_encodings"].update(accepted)
 
         if 400 <= resp.status_code <= 499:
             exception_class = exceptions.HttpNotFoundError if resp.status_code == 404 else exceptions.HttpClientError
@@ -122,27 +153,28 @@ class Resource(ResourceAttributesMixin, object):
         if resp.status_code in [204, 205]:
             return
 
-        if resp.headers.get("content-type", None) and resp.content:
+        content = compress.content(resp)
+        if resp.headers.get("content-type", None) and content:
             content_type = resp.headers.get("content-type").split(";")[0].strip()
 
             try:
                 stype = s.get_serializer(content_type=content_type)
             except exceptions.SerializerNotAvailable:
 
-                return resp.content
+                return content
 
             if stype.key == 'cbor':
-                return stype.loads(resp.content)
+                return stype.loads(content)
 
-            if type(resp.content) == bytes:
+            if type(content) == bytes:
                 try:
-                    encoding = requests.utils.guess_json_utf(resp.content)
-                    return stype.loads(resp.content.decode(encoding))
+                    encoding = requests.utils.guess_json_utf(content)
+                    return stype.loads(content.decode(encoding))
                 except:
-                    return resp.content
-            return stype.loads(resp.content)
+                    return content
+            return stype.loads(content)
         else:
-            return resp.content
+            return content
 
     def _process_response(self, resp):
         # TODO: something to expose headers and status
@@ -174,28 +206,41 @@ class Resource(ResourceAttributesMixin, object):
         resp = self._request("HEAD", params=kwargs)
         return self._process_response(resp)
 
-    def post(self, data=None, files=None, **kwargs):
-        resp = self._request("POST", data=data, files=files, params=kwargs)
+    # data can be anything the serializer takes, or an already encoded
+    # body (bytes, memoryview or an iterator of chunks), in which case
+    # content_type says what it is if it isn't the API's format.
+    def post(self, data=None, files=None, content_type=None, **kwargs):
+        resp = self._request("POST", data=data, files=files, params=kwargs, content_type=content_type)
         return self._process_response(resp)
 
-    def patch(self, data=None, files=None, **kwargs):
-        resp = self._request("PATCH", data=data, files=files, params=kwargs)
+    def patch(self, data=None, files=None, content_type=None, **kwargs):
+        resp = self._request("PATCH", data=data, files=files, params=kwargs, content_type=content_type)
         return self._process_response(resp)
 
-    def put(self, data=None, files=None, **kwargs):
-        resp = self._request("PUT", data=data, files=files, params=kwargs)
+    def put(self, data=None, files=None, content_type=None, **kwargs):
+        resp = self._request("PUT", data=data, files=files, params=kwargs, content_type=content_type)
         return self._process_response(resp)
 
-    def delete(self, data=None, **kwargs):
-        resp = self._request("DELETE", data=data, params=kwargs)
+    def delete(self, data=None, content_type=None, **kwargs):
+        resp = self._request("DELETE", data=data, params=kwargs, content_type=content_type)
         if 200 <= resp.status_code <= 299:
-            if resp.status_code == 204:
+            if (resp.status_code == 204) or (not resp.content):
                 return True
             else:
-                return True  # @@@ Should this really be True?
+                # Bulk deletes report back what they removed
+                return self._try_to_serialize_response(resp)
         else:
             return False
 
+    def iterate(self, method="GET", data=None, content_type=None, **kwargs):
+        """
+        Makes the request like get/post/etc, but streams the response back
+        as an iterator. A CBOR array is decoded an element at a time as it
+        arrives, anything else comes back as a single item.
+        """
+        resp = self._request(method, data=data, params=kwargs, content_type=content_type, stream=True)
+        return stream.iterresponse(resp, self._store["serializer"])
+
     def _get_resource(self, **kwargs):
         return self.__class__(**kwargs)
 
@@ -204,7 +249,13 @@ class API(ResourceAttributesMixin, object):
 
     resource_class = Resource
 
-    def __init__(self, base_url=None, auth=None, format=None, append_slash=True, session=None, serializer=None):
+    def __init__(self, base_url=None, auth=None, format=None, append_slash=True, session=None, serializer=None,
+                 compression=None, compression_level=None):
+        """
+        compression asks for compressed responses and, once the server says
+        it takes them, compresses request bodies: 'zstd', 'gzip' or True for
+        the best available. compression_level overrides the default level.
+        """
         # print('Using customised slumber')
         if serializer is None:
             serializer = Serializer(default=format)
@@ -223,6 +274,9 @@ class API(ResourceAttributesMixin, object):
             "append_slash": append_slash,
             "session": session,
             "serializer": serializer,
+            "compression": compress.choose(compression),
+            "compression_level": compression_level,
+            "server_encodings": set(),
         }
 
         # Do some Checks for Required Values
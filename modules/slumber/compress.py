@@ -0,0 +1,100 @@
+"""
+Content-Encoding negotiation for request and response bodies.
+
+Responses: Accept-Encoding asks for what we can decode. gzip is left to
+requests/urllib3 as usual, zstd is decoded here if urllib3 can't.
+
+Requests: bodies are only compressed once the server has said, with an
+Accept-Encoding response header (RFC 7694), that it takes that encoding.
+"""
+
+import gzip
+import io
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from urllib3.response import HTTPResponse
+    URLLIB3DECODERS = HTTPResponse.CONTENT_DECODERS
+except (ImportError, AttributeError):
+    URLLIB3DECODERS = ["gzip", "deflate"]
+
+MINSIZE = 1024      # Not worth compressing below this
+LEVELS = {"zstd": 3, "gzip": 6}
+
+
+def available():
+    """
+    Encodings we can do at all, best first.
+    """
+    if zstandard is not None:
+        return ["zstd", "gzip"]
+    return ["gzip"]
+
+
+def choose(compression):
+    """
+    The encoding to use for an API's compression option, True for the
+    best there is. None if we can't do it.
+    """
+    if compression is True:
+        return available()[0]
+    if compression in available():
+        return compression
+    return None
+
+
+def accept_encoding(encoding):
+    """
+    Accept-Encoding asking for encoding first.
+    """
+    encodings = [encoding] + [x for x in available() if x != encoding]
+    return ", ".join(encodings)
+
+
+def compress(data, encoding, level=None):
+    if level is None:
+        level = LEVELS[encoding]
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, level)
+
+
+def server_accepts(resp):
+    """
+    The request body encodings a response says the server takes, or
+    None if it doesn't say.
+    """
+    header = resp.headers.get("accept-encoding")
+    if header is None:
+        return None
+    return set(x.split(";")[0].strip().lower() for x in header.split(",") if x.strip())
+
+
+def undecoded_zstd(resp):
+    return (resp.headers.get("content-encoding", "").strip().lower() == "zstd"
+            and "zstd" not in URLLIB3DECODERS)
+
+
+def content(resp):
+    """
+    resp.content, decoded if urllib3 left it compressed.
+    """
+    data = resp.content
+    if data and undecoded_zstd(resp) and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def raw_reader(resp):
+    """
+    A file object reading a streamed response body, decoded. Buffered,
+    the CBOR decoder reads a few bytes at a time.
+    """
+    resp.raw.decode_content = True
+    if undecoded_zstd(resp) and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(resp.raw)
+    return io.BufferedReader(resp.raw, 65536)
@@ -0,0 +1,141 @@
+"""
+Incremental decoding of streamed responses.
+
+A CBOR array is decoded one element at a time straight off the socket,
+so neither the response bytes nor the whole decoded list are ever held
+in memory at once.
+"""
+
+import io
+import struct
+
+from . import compress
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class PushbackReader(io.RawIOBase):
+    """
+    Just enough of a file object for cbor2 to read from, but lets us
+    look at the next initial byte (is it the break code?) and put it
+    back before the decoder sees it.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pushback = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def unread(self, data):
+        self.pushback = data + self.pushback
+
+    def read(self, size=-1):
+        if len(self.pushback) == 0:
+            if size < 0:
+                return self.fp.read()
+            return self.fill(size)
+        if size < 0:
+            data = self.pushback + self.fp.read()
+            self.pushback = b''
+            return data
+        data = self.pushback[:size]
+        self.pushback = self.pushback[size:]
+        if len(data) < size:
+            data += self.fill(size - len(data))
+        return data
+
+    def fill(self, size):
+        # Decompressing readers can come back short, keep going to EOF
+        data = self.fp.read(size)
+        while 0 < len(data) < size:
+            more = self.fp.read(size - len(data))
+            if len(more) == 0:
+                break
+            data += more
+        return data
+
+
+def iterarray(fp, strict=True):
+    """
+    Decodes a top level CBOR array from a file like object, yielding one
+    element at a time. Works for both definite and indefinite (streamed)
+    arrays. Only the array header and the break code are read here, the
+    elements are left to the cbor2 decoder.
+
+    Anything other than an array raises ValueError, or with strict=False
+    is yielded as a single item.
+    """
+    reader = PushbackReader(fp)
+    initial = reader.read(1)
+    if len(initial) == 0:
+        return
+    major = initial[0] >> 5
+    info = initial[0] & 31
+    decoder = cbor2.CBORDecoder(reader)
+    if major != 4:
+        if strict:
+            raise ValueError('Expected a CBOR array, got major type %d' % major)
+        reader.unread(initial)
+        yield decoder.decode()
+        return
+    if info == 31:
+        length = None       # Indefinite, runs until the break code
+    elif info < 24:
+        length = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        length = struct.unpack('>' + {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}[size],
+                               reader.read(size))[0]
+    else:
+        raise ValueError('Invalid CBOR array header')
+    if length is None:
+        while True:
+            nextbyte = reader.read(1)
+            if nextbyte == b'\xff' or len(nextbyte) == 0:
+                break
+            reader.unread(nextbyte)
+            yield decoder.decode()
+    else:
+        for i in range(0, length):
+            yield decoder.decode()
+
+
+def iterresponse(resp, serializer):
+    """
+    Iterates a response made with stream=True. CBOR is decoded as it
+    arrives, an array an element at a time and anything else as a single
+    item. Other formats are read and loaded whole, then handled the same.
+    The response is closed once the iterator is done with.
+    """
+    try:
+        if resp.status_code in [204, 205]:
+            return
+        content_type = resp.headers.get("content-type", "").split(";")[0].strip()
+        if content_type == "application/cbor" and cbor2 is not None:
+            for item in iterarray(compress.raw_reader(resp), strict=False):
+                yield item
+            return
+        content = compress.content(resp)
+        if not content:
+            return
+        data = serializer.get_serializer(content_type=content_type).loads(content)
+        if isinstance(data, list):
+            for item in data:
+                yield item
+        else:
+            yield data
+    finally:
+        resp.close()
@@ -11,6 +11,7 @@ import urllib.request
 import shutil
 from gzip import GzipFile
 import config
+import fingerprint
 from os.path import isfile
 
 
@@ -166,11 +167,7 @@ def listallheadings(myfile):
     return myresults
 
 def duphash(data):
-    data = str(data).encode('utf-8')
-    #print(data)
-    dig = hashlib.md5(data).digest()  # b']A@*\xbcK*v\xb9q\x9d\x91\x10\x17\xc5\x92'
-    b64 = base64.b64encode(dig)       # b'XUFAKrxLKna5cZ2REBfFkg=='
-    return b64.decode()[0:8]
+    return fingerprint.fingerprint(data)
 
 def comparefirstlines(file01, file02):
     print('JSON Load to compare first line of two files')